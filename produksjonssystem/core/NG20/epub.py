@@ -6,11 +6,12 @@ import re
 import tempfile
 import zipfile
 import logging
-import subprocess
 
 from typing import Union, List, Dict
 from lxml import etree as ElementTree
 
+from core.utils.epubcheck import Epubcheck
+
 namespaces = {"opf": "http://www.idpf.org/2007/opf", "epub": "http://www.idpf.org/2007/ops", "html": "http://www.w3.org/1999/xhtml"}
 
 
@@ -303,33 +304,26 @@ def get_metadata(source: str) -> Dict[str, List[str]]:
 
 
 def epubcheck(path: str) -> bool:
-    options = []
-    if os.path.isdir(path):
-        options = ["--mode", "exp"]
-    elif not os.path.isfile(path):
+    if not os.path.isdir(path) and not os.path.isfile(path):
         raise FileNotFoundError(f"{path} is neither a file nor a directory")
 
-    epubcheck_home = os.getenv("EPUBCHECK_HOME")
-    if not epubcheck_home:
+    if not os.getenv("EPUBCHECK_HOME"):
         logging.error("The environment variable EPUBCHECK_HOME is not set, using default: /opt/epubcheck")
-        epubcheck_home = "/opt/epubcheck"
-
-    command = ["java", "-Xss4096k", "-jar", f"{epubcheck_home}/epubcheck.jar", *options, path]
 
     logging.debug("Running Epubcheck")
 
-    process: Union[subprocess.CompletedProcess, subprocess.CalledProcessError]
-    try:
-        process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=False, cwd=epubcheck_home, timeout=600, check=True)
-    except subprocess.CalledProcessError as e:
-        logging.exception("Epubcheck failed")
-        process = e
+    # runs in a resident JVM when possible, and supports both zipped and unzipped EPUBs
+    result = Epubcheck.validate([path])[path]
+
+    for message in (result["report"]["messages"] if result["report"] else []):
+        if message.get("severity") in ["FATAL", "ERROR", "WARNING"]:
+            logging.info(Epubcheck.format_message(message))
 
     logging.debug("---- stdout: ----")
-    logging.info(process.stdout.decode("utf-8"))
+    logging.info(result["stdout"])
     logging.debug("-----------------")
     logging.debug("---- stderr: ----")
-    logging.info(process.stderr.decode("utf-8"))
+    logging.info(result["stderr"])
     logging.debug("-----------------")
 
-    return process.returncode == 0
+    return bool(result["success"])
@@ -3,8 +3,6 @@
 
 import logging
 import os
-import pickle
-import tempfile
 import threading
 import time
 import traceback
@@ -12,8 +10,9 @@ from collections import OrderedDict
 from pathlib import Path
 from threading import RLock, Thread
 
-from core.config import Config
+from core.utils.checksum_store import ChecksumStore
 from core.utils.filesystem import Filesystem
+from core.utils.inotify import Inotify
 from core.utils.report import Report
 
 
@@ -37,9 +36,16 @@ class Directory():
     status_text = None
     starting = None
     inactivity_timeout = None
-    cache_file = None
+    checksum_store = None
     last_availability_check_time = None
     suggested_for_rescan = None
+    event_backend = None  # Inotify instance when change notifications are available, otherwise None (polling)
+    restart_event_backend = None
+    last_full_scan_time = None
+
+    # When change notifications are available, the whole directory is only
+    # rescanned this often (in seconds), to catch any events that were missed.
+    full_scan_interval = 600
 
     # static variables
     _static_lock = RLock()  # lock for changing the static variables
@@ -59,6 +65,7 @@ class Directory():
         self.inactivity_timeout = inactivity_timeout
         self.last_availability_check_time = 0
         self.suggested_for_rescan = []
+        self.last_full_scan_time = 0
 
         self._md5_lock = RLock()
         with self._md5_lock:
@@ -163,24 +170,17 @@ class Directory():
             return self._initialize_checksums()
 
     def _initialize_checksums(self):
-        cache_dir = Config.get("cache_dir", None)
-        if not cache_dir:
-            cache_dir = os.getenv("CACHE_DIR", os.path.join(tempfile.gettempdir(), "prodsys-cache"))
-            if not os.path.isdir(cache_dir):
-                os.makedirs(cache_dir, exist_ok=True)
-            Config.set("cache_dir", cache_dir)
-
-        self.cache_file = None
+        cache_dir = Filesystem.cache_dir()
+
+        if self.checksum_store:
+            self.checksum_store.close()
+        self.checksum_store = None
         if not self.dir_id_is_generated:
-            self.cache_file = os.path.join(cache_dir, "dir.{}.md5.pickle".format(self.dir_id))
-            if os.path.isfile(self.cache_file):
-                try:
-                    with open(self.cache_file, 'rb') as f:
-                        self._md5 = pickle.load(f)
-                except Exception as e:
-                    logging.exception("Cache file found, but could not parse it", e)
-            else:
-                logging.debug("Can't find cache file")
+            self.checksum_store = ChecksumStore(os.path.join(cache_dir, "dir.{}.md5.v{}.sqlite".format(self.dir_id, Filesystem.checksum_version)))
+            # All checksums are loaded at once, not lazily for each book: the scan below and the monitor loop
+            # go through all books anyway. This runs in the monitor thread of each directory,
+            # so directories don't wait for each other while starting.
+            self._md5 = self.checksum_store.load()
 
         if self._md5:
             logging.debug("Loaded directory status from cache file, doing a partial rescan")
@@ -201,6 +201,7 @@ class Directory():
                 del self._md5[book]
 
         md5_count = 0
+        added = []
         self.status_text = "0 / {}".format(len(dir_list))
         for book in dir_list:
             if not self.shouldRun:
@@ -209,40 +210,39 @@ class Directory():
             if book not in self._md5:
                 logging.debug("{} is in directory but not in cache: adding to cache".format(book))
                 self._update_md5(book)
+                added.append(book)
             md5_count += 1
             self.status_text = "{} / {}".format(md5_count, len(dir_list))
             if md5_count == 1 or md5_count % 100 == 0:
                 logging.info(self.status_text)
-            if md5_count % 10 == 0:
-                self.store_checksums(while_starting=True)  # if for some reason the system crashes, we don't have to start all over again
+            if len(added) >= 10:
+                # if for some reason the system crashes, we don't have to start all over again
+                self.store_checksums(while_starting=True, books=added)
+                added = []
 
         self.store_checksums(while_starting=True)
         self.starting = False
         self.status_text = None
         return
 
-    def store_checksums(self, while_starting=False):
+    def store_checksums(self, while_starting=False, books=None):
         if not while_starting and self.is_starting():
             # Cache is not complete yet. Cache will not be saved
             return
 
         with self._md5_lock:
-            return self._store_checksums()
+            return self._store_checksums(books=books)
 
-    def _store_checksums(self):
-        if not self.cache_file:
-            # No cache file defined. Cannot cache directory checksums
+    def _store_checksums(self, books=None):
+        if not self.checksum_store:
+            # No checksum store defined. Cannot cache directory checksums
             return
 
-        if not os.path.exists(os.path.dirname(self.cache_file)):
-            os.makedirs(os.path.dirname(self.cache_file))
-
         if len(self._md5) == 0:
             # No checksums in cache. Cache will not be saved
             return
 
-        with open(self.cache_file, 'wb') as f:
-            pickle.dump(self._md5, f, -1)
+        self.checksum_store.store(self._md5, books=books)
 
     def is_starting(self):
         return self.starting
@@ -294,6 +294,11 @@ class Directory():
         with self._md5_lock:
             self.suggested_for_rescan.append(name)
 
+    def get_checksum(self, name):
+        """Deep checksum of a book in this directory, or None if the book is not known (yet)"""
+        with self._md5_lock:
+            return self._md5[name]["deep"] if name in self._md5 else None
+
     def _update_md5(self, name):
         assert self.dir_path is not None, "Cannot get MD5 checksum for {} when there is no input directory".format(name)
 
@@ -313,7 +318,115 @@ class Directory():
                 "modified": modified,
             }
 
+    def start_event_backend(self):
+        self.restart_event_backend = False
+
+        backend = os.getenv("DIRECTORY_EVENT_BACKEND", "inotify").lower()
+        if backend != "inotify":
+            logging.info("Change notifications are disabled, polling {}".format(self.dir_path))
+            return
+
+        if not Inotify.is_supported(self.dir_path):
+            logging.info("Change notifications are not available for {}, polling instead".format(self.dir_path))
+            return
+
+        try:
+            self.event_backend = Inotify(self.dir_path)
+            logging.info("Using change notifications for {}".format(self.dir_path))
+        except Exception:
+            logging.exception("Could not start watching {} for changes, polling instead".format(self.dir_path))
+            self.event_backend = None
+
+    def stop_event_backend(self):
+        if self.event_backend:
+            self.event_backend.close()
+            self.event_backend = None
+
+    def _wait_for_changes(self):
+        """
+        Wait for books to change.
+
+        Returns the names of books that may have changed, or None if
+        the whole directory should be rescanned.
+        """
+        if not self.event_backend:
+            time.sleep(1)  # unless anything has recently changed, give the system time to breathe between each iteration
+            return None
+
+        try:
+            changed = self.event_backend.read_events(timeout=1)
+        except Exception:
+            logging.exception("Could not read change notifications for {}, polling instead".format(self.dir_path))
+            self.stop_event_backend()
+            return None
+
+        if changed is None:
+            if self.event_backend.root_removed:
+                # the directory was removed or unmounted; poll until it's back, then start listening for changes again
+                logging.info("{} was removed, polling until it's available again".format(self.dir_path))
+                self.stop_event_backend()
+                self.restart_event_backend = True
+                self.last_availability_check_time = 0  # don't use cached availability
+            else:
+                logging.info("Some change notifications for {} were lost, rescanning the directory".format(self.dir_path))
+            return None
+
+        changed = set(book for book in changed if Filesystem.is_book_name(self.dir_path, book))
+
+        if time.time() - self.last_full_scan_time > self.full_scan_interval:
+            # time for a full rescan, make sure that the changed books are deep-scanned as part of it
+            with self._md5_lock:
+                self.suggested_for_rescan.extend(changed)
+            return None
+
+        if self.suggested_for_rescan:
+            with self._md5_lock:
+                for book_id in self.suggested_for_rescan:
+                    if os.path.exists(os.path.join(self.dir_path, book_id)):
+                        changed.add(book_id)
+                    else:
+                        # if book is a file, then it can have a file extension
+                        for name in list(self._md5.keys()) + Filesystem.list_book_dir(self.dir_path):
+                            if Path(name).stem == book_id:
+                                changed.add(name)
+                self.suggested_for_rescan = []
+
+        return changed
+
+    def _rescan_books(self, books):
+        """Check the books reported as changed by the event backend"""
+        for book in sorted(books):
+            if not self.shouldRun:
+                break  # break loop if we're shutting down the system
+
+            with self._md5_lock:
+                path = os.path.join(self.dir_path, book)
+
+                if not os.path.exists(path):
+                    if book in self._md5:
+                        self.notify_book_event_handlers(book, "deleted")
+                        logging.debug("book deleted: {}".format(book))
+                        del self._md5[book]
+                    continue
+
+                if book not in self._md5:
+                    self._update_md5(book)
+                    self.notify_book_event_handlers(book, "created")
+                    logging.debug("book created: {}".format(book))
+                    continue
+
+                deep_md5, _ = Filesystem.path_md5(path=path, shallow=False, expect=self._md5[book]["deep"])
+                self._md5[book]["deep_checked"] = int(time.time())
+                if deep_md5 != self._md5[book]["deep"]:
+                    self._md5[book]["modified"] = int(time.time())
+                    self._update_md5(book)
+                    self.notify_book_event_handlers(book, "modified")
+                    logging.debug("book modified: {}".format(book))
+
     def _monitor_book_events_thread(self):
+        # start listening for changes before scanning the directory, so that no changes are lost while starting
+        self.start_event_backend()
+
         self.initialize_checksums()
 
         while self.shouldRun:
@@ -335,12 +448,24 @@ class Directory():
                         time.sleep(0.1)  # a small nap
                         continue
 
-                time.sleep(1)  # unless anything has recently changed, give the system time to breathe between each iteration
+                changed = self._wait_for_changes()
 
                 if not self.is_available():
                     time.sleep(5)
                     continue
 
+                if changed is not None:
+                    # only check the books we've been notified about, a full rescan is done every self.full_scan_interval seconds
+                    if changed:
+                        self._rescan_books(changed)
+                        self.store_checksums()
+                    continue
+
+                if self.restart_event_backend:
+                    self.start_event_backend()
+
+                self.last_full_scan_time = time.time()
+
                 dirlist = Filesystem.list_book_dir(self.dir_path)
                 sorted_dirlist = []
                 should_deepscan = []
@@ -425,9 +550,11 @@ class Directory():
                         if not self.shouldRun:
                             break  # break loop if we're shutting down the system
 
+                        # books suggested for rescan are most likely changed, so don't reuse checksums for those
                         deep_md5, _ = Filesystem.path_md5(path=os.path.join(self.dir_path, book),
                                                           shallow=False,
-                                                          expect=self._md5[book]["deep"] if book in self._md5 else None)
+                                                          expect=self._md5[book]["deep"] if book in self._md5 else None,
+                                                          memoize=book not in should_deepscan)
                         if book not in self._md5:
                             self._update_md5(book)
                         else:
@@ -448,3 +575,7 @@ class Directory():
                                           recipients=[])
                 except Exception:
                     logging.exception("Could not e-mail exception")
+
+        self.stop_event_backend()
+        if self.checksum_store:
+            self.checksum_store.close()
@@ -5,6 +5,8 @@ from flask import jsonify
 
 import core.server
 from core.config import Config
+from core.utils.http_client import HttpClient, ResponseCache
+from core.utils.scheduler import Scheduler
 
 
 system_shouldRun_False_Since = None
@@ -21,6 +23,9 @@ def health():
     head["memory_used"] = memory_used
     head["memory_used_human_readable"] = human_readable_bytes(memory_used)
     head["version"] = os.getenv("PRODSYS_VERSION", "unknown")
+    head["http"] = HttpClient.metrics()
+    head["http_cache"] = {name: cache.metrics() for name, cache in ResponseCache.caches.items()}
+    head["scheduler"] = Scheduler.get_status()
 
     healthy = False
     if Config.get("system.shouldRun", False):
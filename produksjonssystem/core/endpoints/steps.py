@@ -205,12 +205,12 @@ def progress_report(uids):
             title = group_pipeline.get_group_title()
             pipeline_id = group_pipeline.get_group_id()
 
-            queue = group_pipeline.get_queue()
-            queue_created = len([book for book in queue if Pipeline.get_main_event(book) == "created"]) if queue else 0
-            queue_deleted = len([book for book in queue if Pipeline.get_main_event(book) == "deleted"]) if queue else 0
-            queue_modified = len([book for book in queue if Pipeline.get_main_event(book) == "modified"]) if queue else 0
-            queue_triggered = len([book for book in queue if Pipeline.get_main_event(book) == "triggered"]) if queue else 0
-            queue_autotriggered = len([book for book in queue if Pipeline.get_main_event(book) == "autotriggered"]) if queue else 0
+            queue_counts = group_pipeline.get_queue_counts()
+            queue_created = queue_counts.get("created", 0)
+            queue_deleted = queue_counts.get("deleted", 0)
+            queue_modified = queue_counts.get("modified", 0)
+            queue_triggered = queue_counts.get("triggered", 0)
+            queue_autotriggered = queue_counts.get("autotriggered", 0)
 
             queue_string = {
                 "created": queue_created,
@@ -220,7 +220,7 @@ def progress_report(uids):
                 "autotriggered": queue_autotriggered
             }
 
-            queue_size = len(queue) if queue else 0
+            queue_size = group_pipeline.get_queue_size()
 
             book = Metadata.pipeline_book_shortname(group_pipeline)
 
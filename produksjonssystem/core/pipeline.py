@@ -17,6 +17,7 @@ import tempfile
 import threading
 import time
 import traceback
+from contextlib import contextmanager
 from copy import deepcopy
 from threading import RLock, Thread
 
@@ -24,9 +25,12 @@ from dotmap import DotMap
 
 from core.config import Config
 from core.directory import Directory
+from core.utils.book_queue import BookQueue
 from core.utils.filesystem import Filesystem
+from core.utils.inotify import Inotify
 from core.utils.metadata import Metadata
 from core.utils.report import DummyReport, Report
+from core.utils.scheduler import Scheduler
 
 if sys.version_info[0] != 3 or sys.version_info[1] < 5:
     print("# This script requires Python version 3.5+")
@@ -46,10 +50,23 @@ class Pipeline():
     _dir_trigger_obj = None  # store TemporaryDirectory object in instance so that it's not cleaned up
     pipelines = []
 
-    # The current book
-    book = None
+    # The current book (see the book property)
+    _book = None
     considering_retry_book = None
 
+    # Books are processed by this many worker threads concurrently.
+    # Each worker has its own book and utils (see _workers).
+    max_workers = 1
+    _workers = None  # thread => {"book": …, "utils": …, "progress_start": …, "manual": …, "waiting": …}
+    _worker_count = 0  # number of worker threads started (used for naming the threads)
+
+    # When True, a worker waiting for an external job (see waiting_for_external_job) is temporarily
+    # replaced by another worker, so that other books can be processed while the job is queued.
+    # At most max_waiting_workers workers are replaced at the same time, so there are never more
+    # than max_workers + max_waiting_workers workers in total.
+    release_worker_while_waiting = False
+    max_waiting_workers = 2
+
     # Directories
     dir_in_obj = None
     dir_out_obj = None
@@ -85,17 +102,18 @@ class Pipeline():
     _triggerDirThread = None
 
     # dynamic (reset on stop(), changes over time)
-    _queue = None
+    _queue = None  # BookQueue
+    _queue_condition = None  # notified when books are added to or removed from the queue
+    _stop_event = None  # set when the pipeline is stopped
     _md5 = None
     threads = None
     watchdogs = None
     progress_text = None
     progress_log = None
-    progress_start = None
     expected_processing_time = 60  # can be overridden in each pipeline
 
-    # utility classes; reconfigured every time a book is processed to simplify function signatures
-    utils = None
+    # utility classes; reconfigured every time a book is processed to simplify function signatures (see the utils property)
+    _utils = None
 
     # email settings
     email_settings = None
@@ -108,6 +126,10 @@ class Pipeline():
     labels = []
     publication_format = None
 
+    # Which resources this pipeline mostly uses: "cpu", "dp2" or "io" (see Scheduler).
+    # Used to limit the number of books processed concurrently across all pipelines.
+    resource_class = "io"
+
     def __init__(self,
                  retry_all=False,
                  retry_missing=False,
@@ -118,6 +140,7 @@ class Pipeline():
                  during_working_hours=None,
                  during_night_and_weekend=None,
                  only_when_idle=None,
+                 max_workers=None,
                  _uid=None,
                  _gid=None,
                  _title=None,
@@ -133,6 +156,10 @@ class Pipeline():
         if _group_title:
             self.group_title = _group_title
 
+        self._workers = {}
+        if max_workers:
+            self.max_workers = max_workers
+
         self.utils = DotMap()
         self.utils.report = None
         self.utils.filesystem = None
@@ -155,13 +182,119 @@ class Pipeline():
         self.should_retry_only_when_idle = only_when_idle if isinstance(only_when_idle, bool) else False
 
         self._queue_lock = RLock()
+        self._queue_condition = threading.Condition(self._queue_lock)
+        self._stop_event = threading.Event()
         self._md5_lock = RLock()
         if self.get_group_id() not in Pipeline._group_locks:
-            Pipeline._group_locks[self.get_group_id()] = {"lock": RLock(), "current-uid": None}
+            Pipeline._group_locks[self.get_group_id()] = {"condition": threading.Condition(), "current-uid": None, "workers": 0, "waiting": set()}
         with self._queue_lock:
-            self._queue = []
+            self._queue = BookQueue(Pipeline.get_main_event)
         super().__init__()
 
+    @property
+    def book(self):
+        """
+        The book that is being processed.
+
+        In a worker thread, this is the book handled by that worker. In other threads
+        (for instance when reporting status), this is one of the books being processed.
+        """
+        worker = self._workers.get(threading.current_thread()) if self._workers else None
+        if worker is not None:
+            return worker["book"]
+        if self._book is None and self._workers:
+            for worker in list(self._workers.values()):
+                if worker["book"]:
+                    return worker["book"]
+        return self._book
+
+    @book.setter
+    def book(self, book):
+        worker = self._workers.get(threading.current_thread()) if self._workers else None
+        if worker is not None:
+            worker["book"] = book
+        else:
+            self._book = book
+
+    @property
+    def utils(self):
+        """Utility classes for the book that is being processed (see the book property)."""
+        worker = self._workers.get(threading.current_thread()) if self._workers else None
+        if worker is not None:
+            return worker["utils"]
+        if self._book is None and self._workers:
+            for worker in list(self._workers.values()):
+                if worker["book"]:
+                    return worker["utils"]
+        return self._utils
+
+    @utils.setter
+    def utils(self, utils):
+        worker = self._workers.get(threading.current_thread()) if self._workers else None
+        if worker is not None:
+            worker["utils"] = utils
+        else:
+            self._utils = utils
+
+    def _new_worker(self):
+        return {"book": None, "utils": DotMap(report=None, filesystem=None), "progress_start": -1, "manual": False, "waiting": False}
+
+    def _start_workers(self):
+        """
+        Start worker threads until there are max_workers workers that are not waiting for external jobs.
+
+        There are never more than max_workers + max_waiting_workers workers in total.
+        """
+        with self._queue_lock:
+            while (len([worker for worker in self._workers.values() if not worker["waiting"]]) < max(1, self.max_workers)
+                   and len(self._workers) < max(1, self.max_workers) + max(0, self.max_waiting_workers)):
+                self._worker_count += 1
+                name = "book in {}".format(self.uid) + (" #{}".format(self._worker_count) if self._worker_count > 1 else "")
+                thread = Thread(target=self._handle_book_events_thread, name=name)
+                thread.setDaemon(True)
+                self._workers[thread] = self._new_worker()
+                self.threads.append(thread)
+                thread.start()
+                if self._bookHandlerThread is None:
+                    self._bookHandlerThread = thread
+
+    @contextmanager
+    def waiting_for_external_job(self):
+        """
+        Use while the current book is waiting for a job that runs elsewhere (for instance on a Pipeline 2 engine).
+
+        When release_worker_while_waiting is True, the scheduler slot is released and another worker is
+        started, so that the next book can be processed in the meantime. The scheduler slot is acquired
+        again when done waiting, and the extra worker stops when there are more workers than max_workers.
+        If max_waiting_workers workers are already waiting, the worker is kept and no worker is started.
+        """
+        worker = self._workers.get(threading.current_thread()) if self._workers else None
+        replace = self.release_worker_while_waiting and worker is not None and self.shouldRun
+        if replace:
+            with self._queue_condition:
+                replace = len([w for w in self._workers.values() if w["waiting"]]) < self.max_waiting_workers
+                if replace:
+                    worker["waiting"] = True
+                    self._start_workers()
+        if not replace:
+            yield
+            return
+
+        if self.resource_class:
+            Scheduler.release(self.resource_class)
+        try:
+            yield
+        finally:
+            if self.resource_class:
+                Scheduler.acquire(self.resource_class, manual=worker["manual"])
+            with self._queue_condition:
+                worker["waiting"] = False
+                self._queue_condition.notify_all()  # let the extra worker stop
+
+    def get_active_books(self):
+        """The books that are currently being processed by the workers."""
+        return [worker["book"] for worker in list(self._workers.values()) if worker["book"]] if self._workers else []
+
     def start_common(self, inactivity_timeout=10, dir_in=None, dir_out=None, dir_reports=None, email_settings=None, dir_base=None, config=None):
         if not dir_in:
             dir_in = os.environ.get("DIR_IN")
@@ -217,7 +350,6 @@ class Pipeline():
         # progress variable for this pipeline instance
         self.progress_text = ""
         self.progress_log = []
-        self.progress_start = -1
 
         # make dirs available from static contexts
         if not Pipeline.dirs:
@@ -309,6 +441,7 @@ class Pipeline():
         self.progress_text = ""
 
         self.shouldHandleBooks = True
+        self._stop_event.clear()
 
         if self.dir_in is not None:
             if (self.retry_all):
@@ -328,10 +461,7 @@ class Pipeline():
         self._bookTriggerThread.start()
         self.threads.append(self._bookTriggerThread)
 
-        self._bookHandlerThread = Thread(target=self._handle_book_events_thread, name="book in {}".format(self.uid))
-        self._bookHandlerThread.setDaemon(True)
-        self._bookHandlerThread.start()
-        self.threads.append(self._bookHandlerThread)
+        self._start_workers()
 
         if not Pipeline._triggerDirThread:
             Pipeline._triggerDirThread = Thread(target=Pipeline._trigger_dir_thread, name="trigger dir monitor")
@@ -348,16 +478,15 @@ class Pipeline():
         # Remove autotriggered books, as these may have mistakenly been added
         # because of a network station becoming unavailable.
         with self._queue_lock:
-            new_queue = []
-            for book in self._queue:
-                if Pipeline.get_main_event(book) != "autotriggered":
-                    new_queue.append(book)
-            if len(new_queue) < len(self._queue):
+            removed = self._queue.remove_if(lambda book: Pipeline.get_main_event(book) == "autotriggered")
+            if removed:
                 logging.info("Removed {} books from the queue that may have been added because the network station was unavailable.".format(
-                    len(self._queue) - len(new_queue)))
-                self._queue = new_queue
+                    len(removed)))
 
         self.shouldRun = False
+        self._stop_event.set()
+        with self._queue_condition:
+            self._queue_condition.notify_all()
 
         logging.info("Pipeline \"" + str(self.title) + "\" stopped")
 
@@ -378,13 +507,13 @@ class Pipeline():
 
     def join(self):
         with self._queue_lock:
-            self._queue = []
+            self._queue.clear()
 
         if self.dir_in is not None:
             Directory.stop(self.dir_in)
 
         if self.threads:
-            for thread in self.threads:
+            for thread in list(self.threads):
                 if thread:
                     logging.debug("joining {}".format(thread.name))
                     thread.join(timeout=60)
@@ -397,7 +526,7 @@ class Pipeline():
         while is_alive:
             is_alive = False
             if self.threads:
-                for thread in self.threads:
+                for thread in list(self.threads):
                     if thread and thread != threading.current_thread() and thread.is_alive():
                         if time.time() - join_start_time > 60 * 50:
                             logging.info("Pipeline thread is still running (we've waited too long, let's ignore it): {}".format(thread.name))
@@ -409,7 +538,7 @@ class Pipeline():
 
     def is_healthy(self):
         if self.threads:
-            for thread in self.threads:
+            for thread in list(self.threads):
                 if thread and thread != threading.current_thread():
                     if not thread.is_alive():
                         # found thread that is not running
@@ -448,12 +577,41 @@ class Pipeline():
         else:
             return None
 
+    def _enter_group(self):
+        """Wait until no other pipeline in the same group is processing books."""
+        group = Pipeline._group_locks[self.get_group_id()]
+        with group["condition"]:
+            # let other pipelines in the group have their turn before starting more workers of this pipeline
+            while (group["current-uid"] not in [None, self.uid]
+                    or group["current-uid"] == self.uid and group["waiting"] - {self.uid}):
+                group["waiting"].add(self.uid)
+                group["condition"].wait(timeout=60)
+            group["waiting"].discard(self.uid)
+            group["current-uid"] = self.uid
+            group["workers"] += 1
+
+    def _leave_group(self):
+        group = Pipeline._group_locks[self.get_group_id()]
+        with group["condition"]:
+            group["workers"] -= 1
+            if group["workers"] <= 0:
+                group["workers"] = 0
+                group["current-uid"] = None
+            group["condition"].notify_all()
+
     def trigger(self, name, auto=True):
         self._add_book_to_queue(name, "autotriggered" if auto else "triggered")
 
     def get_queue(self):
         with self._queue_lock:
-            return deepcopy(self._queue)
+            return deepcopy(list(self._queue)) if self._queue is not None else None
+
+    def get_queue_size(self):
+        return len(self._queue) if self._queue is not None else 0
+
+    def get_queue_counts(self):
+        """Number of books in the queue, grouped by main event (see get_main_event)"""
+        return self._queue.counts() if self._queue is not None else {}
 
     def get_state(self):
         if self.shouldRun and not self.running:
@@ -501,17 +659,21 @@ class Pipeline():
         while len(self.progress_log) < 10:
             self.progress_log.append({"start": 0, "end": self.expected_processing_time})
 
+        # when processing of the oldest book currently being processed started (-1 if no book is being processed)
+        workers = list(self._workers.values()) if self._workers else []
+        progress_start = min([worker["progress_start"] for worker in workers if worker["progress_start"] >= 0] or [-1])
+
         if self.progress_text:
             return self.progress_text
 
-        elif self.progress_start >= self.progress_log[-1]["end"]:
+        elif progress_start >= 0:
 
             average_duration = 0
             for p in self.progress_log:
                 average_duration += p["end"] - p["start"]
             average_duration /= 10
 
-            duration = time.time() - self.progress_start
+            duration = time.time() - progress_start
 
             percentage = math.floor((1 - math.exp(-duration/average_duration/2)) * 100)
             return "{} %".format(percentage)
@@ -557,23 +719,37 @@ class Pipeline():
 
     def _add_book_to_queue(self, name, event_type):
         with self._queue_lock:
-            book_in_queue = False
-            for item in self._queue:
-                if item['name'] == name:
-                    book_in_queue = True
-                    if event_type != "autotriggered":
-                        item['last_event'] = int(time.time())
-                    if event_type not in item['events']:
-                        item['events'].append(event_type)
-                    break
-            if not book_in_queue:
-                self._queue.append({
-                     'name': name,
-                     'source': os.path.join(self.dir_in, name) if self.dir_in is not None else None,
-                     'events': [event_type],
-                     'last_event': int(time.time())
-                })
+            if self._queue.add(name, event_type, source=os.path.join(self.dir_in, name) if self.dir_in is not None else None):
                 logging.debug("added book to queue: " + name)
+            self._queue_condition.notify_all()
+
+    def _sleep(self, seconds):
+        """Sleep for the given number of seconds, or until the pipeline is stopped"""
+        self._stop_event.wait(seconds)
+
+    @staticmethod
+    def _watch_trigger_dir(path):
+        """Get change notifications for a trigger directory, if possible"""
+        try:
+            if Inotify.is_supported(path):
+                return Inotify(path)
+        except Exception:
+            logging.exception("Could not watch trigger directory, checking it regularly instead: {}".format(path))
+        return None
+
+    @staticmethod
+    def _wait_for_trigger_files(watch, timeout):
+        """Wait until something changes in the trigger directory (if watched), or `timeout` seconds has passed"""
+        if watch is None:
+            time.sleep(timeout)
+            return watch
+        try:
+            watch.read_events(timeout=timeout)
+            return watch
+        except Exception:
+            logging.exception("Could not read change notifications for trigger directory, checking it regularly instead")
+            watch.close()
+            return None
 
     def watchdog_bark(self):
         self.watchdogs[threading.current_thread()] = time.time()
@@ -588,9 +764,12 @@ class Pipeline():
         trigger_dir = os.path.join(trigger_dir, "dirs")
 
         dirs = None
+        watch = None
 
         while True:
-            time.sleep(5)
+            if watch is None and dirs:
+                watch = Pipeline._watch_trigger_dir(trigger_dir)
+            watch = Pipeline._wait_for_trigger_files(watch, 5)
 
             ready = 0
             for pipeline in Pipeline.pipelines:
@@ -644,13 +823,18 @@ class Pipeline():
                             for pipeline in Pipeline.pipelines:
                                 if pipeline.uid in dirs[relpath]:
                                     pipeline.trigger(name, auto=autotriggered)
+        if watch:
+            watch.close()
         if _trigger_dir_obj:
             _trigger_dir_obj.cleanup()
 
     def _monitor_book_triggers_thread(self):
+        watch = None
         self.watchdog_bark()
         while self.shouldRun:
-            time.sleep(5)
+            if watch is None and self.dir_trigger and os.path.isdir(self.dir_trigger):
+                watch = Pipeline._watch_trigger_dir(self.dir_trigger)
+            watch = Pipeline._wait_for_trigger_files(watch, 5)
             self.watchdog_bark()
 
             if not os.path.isdir(self.dir_trigger):
@@ -678,12 +862,15 @@ class Pipeline():
                     except Exception:
                         logging.exception("An error occured while trying to delete triggerfile: " + triggerfile)
 
+        if watch:
+            watch.close()
+
     def _retry_all_books_thread(self):
         last_retry = 0
 
         self.watchdog_bark()
         while self.shouldRun:
-            time.sleep(5)
+            self._sleep(5)
             self.watchdog_bark()
 
             if not self.dirsAvailable():
@@ -692,6 +879,7 @@ class Pipeline():
             retry_interval = 2 * 60 * 60  # 2 hours
 
             if time.time() - last_retry < retry_interval:
+                self._sleep(min(60, retry_interval - (time.time() - last_retry)))  # nothing to do for a while
                 continue
 
             last_retry = time.time()
@@ -705,7 +893,7 @@ class Pipeline():
 
         self.watchdog_bark()
         while self.shouldRun:
-            time.sleep(5)
+            self._sleep(5)
             self.watchdog_bark()
 
             if not self.dirsAvailable():
@@ -716,17 +904,15 @@ class Pipeline():
             last_retry = {}  # { "[path]": [last-retry] }
 
             if time.time() - last_rescan < rescan_interval:
+                self._sleep(min(60, rescan_interval - (time.time() - last_rescan)))  # nothing to do for a while
                 continue
 
             # Check if there are autotriggered books already in the queue,
             # and if so, wait 60 seconds until checking again.
             # If there are autotriggered books in the queue, then we want
             # the pipeline to finish processing them before we add more.
-            with self._queue_lock:
-                for book in self._queue:
-                    if Pipeline.get_main_event(book) == "autotriggered":
-                        last_rescan += 60
-                        continue
+            if self.get_queue_counts().get("autotriggered"):
+                last_rescan += 60
 
             last_rescan = time.time()
 
@@ -802,71 +988,65 @@ class Pipeline():
             self.considering_retry_book = None
 
     def _handle_book_events_thread(self):
+        with self._queue_lock:
+            if threading.current_thread() not in self._workers:
+                self._workers[threading.current_thread()] = self._new_worker()
+
+        retired = False
         self.watchdog_bark()
         while self.shouldRun:
+            with self._queue_lock:
+                # stop this worker if it was started while another worker was waiting for an external job, and that worker is done waiting
+                if len([worker for worker in self._workers.values() if not worker["waiting"]]) > max(1, self.max_workers):
+                    retired = True
+                    break
+
             self.running = True
             self.watchdog_bark()
 
             if not self.dirsAvailable():
-                time.sleep(5)
+                self._sleep(5)
                 continue
 
             self.book = None
 
             try:
                 if self.dir_out_obj is not None and not self.dir_out_obj.is_available():
-                    time.sleep(5)
+                    self._sleep(5)
                     continue
 
                 if self.dir_in is not None and not os.path.isdir(self.dir_in):
                     # when base dir is not available we should stop watching the directory,
                     # this just catches a potential race condition
-                    time.sleep(1)
+                    self._sleep(1)
                     continue
 
                 with self._queue_lock:
-                    # list all books where no book event have occured very recently (self._inactivity_timeout)
-                    books = [b for b in self._queue if int(time.time()) - b["last_event"] > self._inactivity_timeout]
-
-
-                    # COMMENTED OUT TO TRY A NEW AUTOTRIGGERED METHOD
-
-                    # process books that were started manually first (manual trigger or book modification)
-                    # process autotriggered books in the order they were cataloged in
-           #         books_autotriggered = [b for b in books if Pipeline.get_main_event(b) == "autotriggered"]
-           #         autotriggered_identifiers = [b["name"] for b in books]
-            #        autotriggered_identifiers = Metadata.sort_identifiers(autotriggered_identifiers)
-             #       books_autotriggered_sorted = []
-             #       for identifier in autotriggered_identifiers:
-              #          for b in books_autotriggered:
-               #             if b["name"] == identifier:
-                #                books_autotriggered_sorted.append(b)
-                 #               break
-                  #  books_autotriggered = books_autotriggered_sorted
-
-                    books_autotriggered = [b for b in books if Pipeline.get_main_event(b) == "autotriggered"]
-                    books_autotriggered = sorted(books_autotriggered, key=lambda b: b["last_event"], reverse=False)  # process recently autotriggered books last
-
-                    books_manual = [b for b in books if Pipeline.get_main_event(b) != "autotriggered"]
-                    books_manual = sorted(books_manual, key=lambda b: b["last_event"], reverse=True)  # process recently modified books first
-                    books = books_manual
-                    if self.should_handle_autotriggered_books():
-                        # Don't handle autotriggered books unless should_handle_autotriggered_books() returns True
-                        # This will make sure that certain pipelines only retry books
-                        # during working hours, and make sure that certain other pipelines
-                        # only process books outside of working hours.
-                        books.extend(books_autotriggered)
-
-                    if books:
-                        logging.info("queue: " + ", ".join(
-                            [b["name"] for b in books][:5]) + (", ... ( " + str(len(books) - 5) + " more )" if len(books) > 5 else ""))
-
-                    self.book = None
-                    if len(books):
-                        self.book = books[0]
-
-                        new_queue = [b for b in self._queue if b is not self.book]
-                        self._queue = new_queue
+                    # Process books that were started manually first (manual trigger or book modification),
+                    # most recently modified books first. Then process autotriggered books, in the order
+                    # they were autotriggered. Books are only processed when no book event have occured
+                    # very recently (self._inactivity_timeout).
+                    #
+                    # Don't handle autotriggered books unless should_handle_autotriggered_books() returns True
+                    # This will make sure that certain pipelines only retry books
+                    # during working hours, and make sure that certain other pipelines
+                    # only process books outside of working hours.
+                    #
+                    # Don't process the same book in multiple workers at the same time.
+                    self.book = self._queue.pop(self._inactivity_timeout,
+                                                include_autotriggered=self.should_handle_autotriggered_books(),
+                                                exclude=[b["name"] for b in self.get_active_books()])
+
+                    if self.book:
+                        logging.info("processing: {}".format(self.book["name"])
+                                     + (" ( {} more in queue )".format(len(self._queue)) if len(self._queue) else ""))
+
+                    elif self.shouldRun:
+                        # Wait until a book is added to the queue, a book in the queue is ready to be processed,
+                        # or another worker is done with a book. Check regularly anyway, as for instance
+                        # should_handle_autotriggered_books() depends on the time of day.
+                        seconds_until_ready = self._queue.seconds_until_ready(self._inactivity_timeout)
+                        self._queue_condition.wait(timeout=min(60, seconds_until_ready) if seconds_until_ready is not None else 60)
 
                 if self.book:
                     # Determine order of creation/deletion, as well as type of book event
@@ -892,22 +1072,25 @@ class Pipeline():
                         book_metadata = Metadata.get_metadata_from_book(self.utils.report, self.book["source"] if self.book["source"] else self.book["name"])
 
                         try:
-                            self.progress_start = time.time()
+                            progress_start = time.time()
+                            self._workers[threading.current_thread()]["progress_start"] = progress_start
+                            self._workers[threading.current_thread()]["manual"] = event != "autotriggered"
                             self.utils.report.debug("Started: {}".format(time.strftime("%Y-%m-%d %H:%M:%S")))
 
-                            with Pipeline._group_locks[self.get_group_id()]["lock"]:
-                                Pipeline._group_locks[self.get_group_id()]["current-uid"] = self.uid
-
-                                if event == "created":
-                                    result = self.on_book_created()
+                            self._enter_group()
+                            try:
+                                with Scheduler.slot(self.resource_class, manual=event != "autotriggered"):
+                                    if event == "created":
+                                        result = self.on_book_created()
 
-                                elif event == "deleted":
-                                    result = self.on_book_deleted()
+                                    elif event == "deleted":
+                                        result = self.on_book_deleted()
 
-                                else:
-                                    result = self.on_book_modified()
+                                    else:
+                                        result = self.on_book_modified()
 
-                                Pipeline._group_locks[self.get_group_id()]["current-uid"] = None
+                            finally:
+                                self._leave_group()
 
                         except Exception:
                             self.utils.report.error("An error occured while handling the book")
@@ -915,9 +1098,6 @@ class Pipeline():
                             logging.exception("An error occured while handling the book")
 
                         finally:
-                            if Pipeline._group_locks[self.get_group_id()]["current-uid"] == self.uid:
-                                Pipeline._group_locks[self.get_group_id()]["current-uid"] = None
-
                             try:
                                 Metadata.add_production_info(self.utils.report,
                                                              book_metadata["identifier"],
@@ -939,13 +1119,15 @@ class Pipeline():
                                 self.utils.report.should_email = False
 
                             progress_end = time.time()
-                            self.progress_log.append({"start": self.progress_start, "end": progress_end})
+                            self.progress_log.append({"start": progress_start, "end": progress_end})
+                            self._workers[threading.current_thread()]["progress_start"] = -1
                             self.utils.report.debug("Finished: {}".format(time.strftime("%Y-%m-%d %H:%M:%S")))
 
-                            if self.stopAfterNJobs > 0:
-                                self.stopAfterNJobs -= 1
-                            if self.stopAfterNJobs == 0:
-                                self.stop()
+                            with self._queue_lock:
+                                if self.stopAfterNJobs > 0:
+                                    self.stopAfterNJobs -= 1
+                                if self.stopAfterNJobs == 0:
+                                    self.stop()
 
                             try:
                                 self.utils.report.email(Report.filterEmailAddresses(self.email_settings["recipients"],
@@ -969,12 +1151,22 @@ class Pipeline():
                                           traceback.format_exc(), self.email_settings["recipients"])
                 except Exception:
                     logging.exception("Could not e-mail exception")
+                self._sleep(1)
 
             finally:
+                if self.book:
+                    with self._queue_condition:
+                        self.book = None
+                        self._queue_condition.notify_all()  # other workers may be waiting for this book to finish
                 self.book = None
-                time.sleep(1)
 
-        self.running = False
+        with self._queue_lock:
+            del self._workers[threading.current_thread()]
+            if retired:
+                self.threads.remove(threading.current_thread())
+                self.watchdogs.pop(threading.current_thread(), None)
+            if not self._workers:
+                self.running = False
 
     def daily_report(self, message):
         report_daily = Report(self)
@@ -1152,7 +1344,10 @@ class DummyPipeline(Pipeline):
         self.utils = DotMap()
         self.utils.report = DummyReport(self)
         self.utils.filesystem = Filesystem(self)
+        self._workers = {}
         self._queue_lock = RLock()
+        self._queue_condition = threading.Condition(self._queue_lock)
+        self._stop_event = threading.Event()
         self._md5_lock = RLock()
         self.shouldRun = False
         self.book = None
@@ -1186,6 +1381,7 @@ class DummyPipeline(Pipeline):
     def stop(self, *args, **kwargs):
         self.shouldRun = False
         self.running = False
+        self._stop_event.set()
 
     def run(self, *args, **kwargs):
         self.start(*args, **kwargs)
@@ -11,7 +11,7 @@ import time
 from graphviz import Digraph
 
 from core.directory import Directory
-from core.pipeline import DummyPipeline, Pipeline
+from core.pipeline import DummyPipeline
 from core.utils.filesystem import Filesystem
 from core.utils.metadata import Metadata
 
@@ -88,13 +88,13 @@ class Plotter():
             title = group_pipeline.get_group_title()
             pipeline_id = group_pipeline.get_group_id()  # re.sub(r"[^a-z\d]", "", title.lower())
 
-            queue = group_pipeline.get_queue()
+            queue_counts = group_pipeline.get_queue_counts()
 
-            queue_created = len([book for book in queue if Pipeline.get_main_event(book) == "created"]) if queue else 0
-            queue_deleted = len([book for book in queue if Pipeline.get_main_event(book) == "deleted"]) if queue else 0
-            queue_modified = len([book for book in queue if Pipeline.get_main_event(book) == "modified"]) if queue else 0
-            queue_triggered = len([book for book in queue if Pipeline.get_main_event(book) == "triggered"]) if queue else 0
-            queue_autotriggered = len([book for book in queue if Pipeline.get_main_event(book) == "autotriggered"]) if queue else 0
+            queue_created = queue_counts.get("created", 0)
+            queue_deleted = queue_counts.get("deleted", 0)
+            queue_modified = queue_counts.get("modified", 0)
+            queue_triggered = queue_counts.get("triggered", 0)
+            queue_autotriggered = queue_counts.get("autotriggered", 0)
             queue_string = []
             if queue_created:
                 queue_string.append("nye:"+str(queue_created))
@@ -108,11 +108,9 @@ class Plotter():
                 queue_string.append("autotrigget:"+str(queue_autotriggered))
             queue_string = ", ".join(queue_string)
 
-            queue_size = 0
-            if queue:
-                queue_size = len(queue)
-                if not group_pipeline.should_handle_autotriggered_books():
-                    queue_size -= queue_autotriggered
+            queue_size = group_pipeline.get_queue_size()
+            if queue_size and not group_pipeline.should_handle_autotriggered_books():
+                queue_size -= queue_autotriggered
             book = Metadata.pipeline_book_shortname(group_pipeline)
 
             relpath_in = None
@@ -1,12 +1,11 @@
 import logging
 import os
 
-import requests
-
 from datetime import datetime
 
 from core.config import Config
 from core.directory import Directory
+from core.utils.http_client import HttpClient
 from core.utils.report import Report
 
 
@@ -98,7 +97,7 @@ class Bibliofil:
 
         # get the appropriate book identifier(s)
         logging.info("{}/editions/{}?edition-metadata=all".format(Config.get("nlb_api_url"), identifier))
-        response = requests.get("{}/editions/{}?edition-metadata=all".format(Config.get("nlb_api_url"), identifier))
+        response = HttpClient.get("{}/editions/{}?edition-metadata=all".format(Config.get("nlb_api_url"), identifier))
         if response.status_code == 200:
             data = response.json()['data']
             library = data["library"]
@@ -184,7 +183,7 @@ class Bibliofil:
                 'Content-Type': "application/json",
                 }
             logging.info(url)
-            response = requests.request("GET", url, headers=headers, params=params)
+            response = HttpClient.get(url, headers=headers, params=params)
             data = response.json()
             editions = data["data"]
             return editions
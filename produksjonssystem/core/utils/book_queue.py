@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+
+import heapq
+import itertools
+import threading
+import time
+
+
+class BookQueue():
+    """
+    Queue of book events for a pipeline.
+
+    Books are stored as dicts: {"name": …, "source": …, "events": […], "last_event": …}.
+    Books are only handed out when no filesystem event (created, modified or deleted) has
+    occured for a while (the inactivity timeout). Triggered books are handed out immediately.
+    Manually triggered and modified books are handed out first, most recently changed first.
+    Autotriggered books are handed out last, oldest first.
+    """
+
+    filesystem_events = ["created", "modified", "deleted"]
+
+    def __init__(self, get_main_event):
+        self._get_main_event = get_main_event
+        self._lock = threading.RLock()
+        self._sequence = itertools.count()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._books = {}  # name => book
+            self._entries = {}  # name => {"sequence": …, "version": …, "main_event": …, "last_filesystem_event": …}
+            self._pending = []  # heap of books waiting for the inactivity timeout: (last_filesystem_event, sequence, name, version)
+            self._ready_manual = []  # heap of books ready to be processed: (-last_event, sequence, name, version)
+            self._ready_auto = []  # heap of autotriggered books ready to be processed: (last_event, sequence, name, version)
+            self._counts = {}  # main event => number of books
+
+    def __len__(self):
+        return len(self._books)
+
+    def __contains__(self, name):
+        return name in self._books
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._books.values()))
+
+    def counts(self):
+        """Number of books in the queue, grouped by main event (see Pipeline.get_main_event)"""
+        with self._lock:
+            return dict(self._counts)
+
+    def add(self, name, event_type, source=None):
+        """Add a book event to the queue. Returns True if the book was not already in the queue."""
+        with self._lock:
+            book = self._books.get(name)
+            is_new = book is None
+            if is_new:
+                book = {
+                    'name': name,
+                    'source': source,
+                    'events': [event_type],
+                    'last_event': int(time.time())
+                }
+                self._books[name] = book
+                self._entries[name] = {"sequence": next(self._sequence), "version": 0, "main_event": None, "last_filesystem_event": 0}
+            else:
+                if event_type != "autotriggered":
+                    book['last_event'] = int(time.time())
+                if event_type not in book['events']:
+                    book['events'].append(event_type)
+
+            if event_type in BookQueue.filesystem_events:
+                self._entries[name]["last_filesystem_event"] = book['last_event']
+            self._update(name)
+            return is_new
+
+    def remove(self, name):
+        with self._lock:
+            if name not in self._books:
+                return None
+            self._count(self._entries[name]["main_event"], -1)
+            del self._entries[name]
+            return self._books.pop(name)
+
+    def remove_if(self, predicate):
+        """Remove all books matching `predicate`. Returns the removed books."""
+        with self._lock:
+            return [self.remove(book["name"]) for book in list(self._books.values()) if predicate(book)]
+
+    def pop(self, inactivity_timeout, include_autotriggered=True, exclude=None):
+        """
+        Remove and return the next book that should be processed, or None if there are no books ready.
+
+        Books with a name in `exclude` are skipped (but kept in the queue).
+        """
+        with self._lock:
+            self._promote(inactivity_timeout)
+
+            heaps = [self._ready_manual]
+            if include_autotriggered:
+                heaps.append(self._ready_auto)
+
+            for heap in heaps:
+                skipped = []
+                book = None
+                while heap:
+                    entry = heapq.heappop(heap)
+                    if not self._is_current(entry):
+                        continue
+                    if exclude and entry[2] in exclude:
+                        skipped.append(entry)
+                        continue
+                    book = self.remove(entry[2])
+                    break
+                for entry in skipped:
+                    heapq.heappush(heap, entry)
+                if book is not None:
+                    return book
+
+            return None
+
+    def seconds_until_ready(self, inactivity_timeout):
+        """Number of seconds until the next book waiting for the inactivity timeout is ready, or None if no books are waiting"""
+        with self._lock:
+            if not self._pending:
+                return None
+            return max(0, self._pending[0][0] + inactivity_timeout + 1 - time.time())
+
+    def _update(self, name):
+        book = self._books[name]
+        entry = self._entries[name]
+
+        main_event = self._get_main_event(book)
+        if main_event != entry["main_event"]:
+            self._count(entry["main_event"], -1)
+            self._count(main_event, 1)
+            entry["main_event"] = main_event
+
+        entry["version"] += 1
+        heapq.heappush(self._pending, (entry["last_filesystem_event"], entry["sequence"], name, entry["version"]))
+
+        if len(self._pending) + len(self._ready_manual) + len(self._ready_auto) > 2 * len(self._books) + 100:
+            self._compact()
+
+    def _count(self, main_event, delta):
+        if main_event is None:
+            return
+        self._counts[main_event] = self._counts.get(main_event, 0) + delta
+        if self._counts[main_event] <= 0:
+            del self._counts[main_event]
+
+    def _is_current(self, entry):
+        return entry[2] in self._entries and self._entries[entry[2]]["version"] == entry[3]
+
+    def _promote(self, inactivity_timeout):
+        """Move books where no event has occured for a while from the pending heap to the ready heaps"""
+        now = int(time.time())
+        while self._pending and now - self._pending[0][0] > inactivity_timeout:
+            entry = heapq.heappop(self._pending)
+            if not self._is_current(entry):
+                continue
+            _, sequence, name, version = entry
+            last_event = self._books[name]["last_event"]
+            if self._entries[name]["main_event"] == "autotriggered":
+                heapq.heappush(self._ready_auto, (last_event, sequence, name, version))
+            else:
+                heapq.heappush(self._ready_manual, (-last_event, sequence, name, version))
+
+    def _compact(self):
+        """Remove outdated entries from the heaps"""
+        self._pending = [entry for entry in self._pending if self._is_current(entry)]
+        self._ready_manual = [entry for entry in self._ready_manual if self._is_current(entry)]
+        self._ready_auto = [entry for entry in self._ready_auto if self._is_current(entry)]
+        heapq.heapify(self._pending)
+        heapq.heapify(self._ready_manual)
+        heapq.heapify(self._ready_auto)
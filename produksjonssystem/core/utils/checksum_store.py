@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import sqlite3
+import threading
+
+
+class ChecksumStore():
+    """Persistent storage of book checksums for a directory, backed by SQLite"""
+
+    fields = ["shallow", "shallow_checked", "deep", "deep_checked", "modified"]
+
+    def __init__(self, path):
+        self.path = path
+        self._connection = None
+        self._stored = {}  # what we believe is in the database: book => checksums
+        self._lock = threading.RLock()
+
+    def _connect(self):
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")  # still atomic and consistent in WAL mode
+            self._connection.execute("CREATE TABLE IF NOT EXISTS checksums ("
+                                     "book TEXT PRIMARY KEY, "
+                                     "shallow TEXT, "
+                                     "shallow_checked INTEGER, "
+                                     "deep TEXT, "
+                                     "deep_checked INTEGER, "
+                                     "modified REAL)")
+            self._connection.commit()
+        return self._connection
+
+    def load(self):
+        """
+        Returns the stored checksums, as a dict: book => checksums
+
+        Everything is loaded with a single query, since the directory goes through all books when starting anyway.
+        """
+        with self._lock:
+            try:
+                rows = self._connect().execute("SELECT book, {} FROM checksums".format(", ".join(ChecksumStore.fields))).fetchall()
+            except sqlite3.DatabaseError:
+                logging.exception("Could not read checksums from {}, starting with an empty cache".format(self.path))
+                self.close()
+                for suffix in ["", "-wal", "-shm"]:
+                    if os.path.exists(self.path + suffix):
+                        os.remove(self.path + suffix)
+                rows = []
+
+            self._stored = {row[0]: dict(zip(ChecksumStore.fields, row[1:])) for row in rows}
+            return {book: dict(self._stored[book]) for book in self._stored}
+
+    def store(self, checksums, books=None):
+        """
+        Write the entries in `checksums` that differ from what is stored, and remove the entries that are gone.
+
+        If `books` is given, only those books are compared.
+        """
+        with self._lock:
+            if books is None:
+                changed = [book for book in checksums if self._stored.get(book) != checksums[book]]
+                deleted = [book for book in self._stored if book not in checksums]
+            else:
+                changed = [book for book in books if book in checksums and self._stored.get(book) != checksums[book]]
+                deleted = [book for book in books if book in self._stored and book not in checksums]
+            if not changed and not deleted:
+                return
+
+            connection = self._connect()
+            with connection:  # one transaction: either everything or nothing is written
+                connection.executemany("INSERT OR REPLACE INTO checksums (book, {}) VALUES (?, {})".format(
+                                           ", ".join(ChecksumStore.fields), ", ".join(["?"] * len(ChecksumStore.fields))),
+                                       [[book] + [checksums[book].get(field) for field in ChecksumStore.fields] for book in changed])
+                connection.executemany("DELETE FROM checksums WHERE book = ?", [[book] for book in deleted])
+
+            for book in changed:
+                self._stored[book] = dict(checksums[book])
+            for book in deleted:
+                del self._stored[book]
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+            self._connection = None
@@ -3,27 +3,29 @@
 import pathlib
 import logging
 import base64
+import concurrent.futures
 import datetime
 import hashlib
+import heapq
 import hmac
+import itertools
 import os
 import random
 import re
 import shutil
 import subprocess
 import tempfile
+import threading
 import time
 import traceback
 import urllib
-import zipfile
+import uuid
 
 import psutil
-import requests
 from lxml import etree as ElementTree
-from requests_toolbelt.multipart.encoder import MultipartEncoder
 
-from core.utils.timeout_lock import TimeoutLock
 from core.utils.filesystem import Filesystem
+from core.utils.http_client import HttpClient
 
 
 class DaisyPipelineJob():
@@ -42,17 +44,15 @@ class DaisyPipelineJob():
     priority = None
     found_pipeline_version = None
     found_script_version = None
+    future = None  # resolved with the final status of the job
+    _monitored_job = None
 
     # treat these as class variables, specific for local jobs
-    pid = None
-    start_lock = TimeoutLock()
     dp2_home = None
     dp2_cli = None
 
     # treat these as class variables
     engines = None
-    engine_lock = TimeoutLock()
-    engine_jobs = None  # for cleaning up old jobs
 
     dp2_ws_namespace = {"d": 'http://www.daisy.org/ns/pipeline/data'}
 
@@ -74,14 +74,8 @@ class DaisyPipelineJob():
                     "JAVA_HOME is not set! It should be set to a Java 8 installation, for instance:\n"
                     + "export \"/usr/lib/jvm/java-8-openjdk-amd64\""
                 )
-            # commenting out the local engine as we use remote engines running on docker.
-            """DaisyPipelineJob.engines.append({
-                "endpoint": "http://localhost:8181/ws",
-                "authentication": "false",
-                "key": "none",
-                "secret": "none",
-                "local": True,
-            })"""
+            # local engines are disabled by default, as we use remote engines running on docker (see LOCAL_PIPELINE2_ENGINES).
+            DaisyPipelineJob.engines.extend(DaisyPipelineLocalEngines.start())
         else:
             DaisyPipelineJob.dp2_cli = None
 
@@ -99,149 +93,6 @@ class DaisyPipelineJob():
                     "local": False,
                 })
 
-    @staticmethod
-    def local_stop_engine(pipeline):
-        procs = DaisyPipelineJob.local_list_processes()
-        for p in procs:
-            try:
-                pipeline.utils.report.debug("Stopping: {}".format(p))
-                p.terminate()
-            except psutil.NoSuchProcess:
-                pass
-            except psutil.AccessDenied:
-                pipeline.utils.report.debug("Could not kill Pipeline 2 instance (PID: {})".format(p.pid))
-        gone, alive = psutil.wait_procs(procs,
-                                        timeout=10,
-                                        callback=lambda p: pipeline.utils.report.warn("Lokal Pipeline 2-process {} terminerte med koden {}".format(
-                                            p,
-                                            p.returncode
-                                        )))
-        if len(alive) > 0:
-            pipeline.utils.report.warn("Dreper {} gjenværende Pipeline 2-prosesser som ikke ble terminert".format(len(alive)))
-        for p in alive:
-            pipeline.utils.report.debug("Killing: {}".format(p))
-            try:
-                p.kill()
-            except psutil.NoSuchProcess:
-                pass
-            except psutil.AccessDenied:
-                pipeline.utils.report.debug("Could not kill Pipeline 2 instance (PID: {})".format(p.pid))
-        DaisyPipelineJob.pid = None
-        time.sleep(1)
-        pipeline.utils.report.debug("Pipeline 2 processes after stopping/killing: {}".format(len(DaisyPipelineJob.local_list_processes())))
-
-    def local_start_engine(self, retries=10):
-        running = False
-        self.pipeline.utils.report.debug("[local_start_engine] trying to acquire DP2 start lock")
-        with DaisyPipelineJob.start_lock.acquire_timeout(3000) as locked:
-            if locked:
-                self.pipeline.utils.report.debug("[local_start_engine] acquired DP2 start lock")
-                while not running and retries > 0:
-                    if not self.pipeline.shouldRun:
-                        break  # exit this function if we're shutting down the system
-
-                    retries -= 1
-                    procs = DaisyPipelineJob.local_list_processes()
-                    if DaisyPipelineJob.pid:
-                        procs = [p for p in procs if p.pid != DaisyPipelineJob.pid]  # keep DaisyPipelineJob.pid
-                    if len(procs) > 0:
-                        self.pipeline.utils.report.debug("found at least one unexpected Pipeline 2 instance")
-                        for p in procs:
-                            try:
-                                self.pipeline.utils.report.debug("Stopping: {}".format(p))
-                                p.terminate()
-                            except psutil.NoSuchProcess:
-                                pass
-                            except psutil.AccessDenied:
-                                self.pipeline.utils.report.debug("Could not kill Pipeline 2 instance (PID: {})".format(p.pid))
-                        gone, alive = psutil.wait_procs(procs,
-                                                        timeout=10,
-                                                        callback=lambda p: self.pipeline.utils.report.warn(
-                                                            "Pipeline 2-prosess {} terminerte med koden {}".format(
-                                                                p,
-                                                                p.returncode
-                                                            )))
-                        if len(alive) > 0:
-                            self.pipeline.utils.report.warn("Dreper {} gjenstående Pipeline 2-prosesser som ikke terminerte".format(len(alive)))
-                        for p in alive:
-                            self.pipeline.utils.report.debug("Killing: {}".format(p))
-                            try:
-                                p.kill()
-                            except psutil.NoSuchProcess:
-                                pass
-                            except psutil.AccessDenied:
-                                self.pipeline.utils.report.debug("Could not kill Pipeline 2 instance (PID: {})".format(p.pid))
-                        time.sleep(1)
-                        self.pipeline.utils.report.debug("Pipeline 2 processes after stopping/killing: {}".format(len(DaisyPipelineJob.local_list_processes())))
-
-                    procs = DaisyPipelineJob.local_list_processes()
-                    running = len(procs) == 1
-                    if len(procs) == 0:
-                        self.pipeline.utils.report.debug("no running DP2 process")
-                        lockfiles = [
-                            os.path.join(DaisyPipelineJob.dp2_home, "data", "db", "db.lck"),
-                            os.path.join(DaisyPipelineJob.dp2_home, "data", "db", "dbex.lck")
-                        ]
-                        for lockfile in lockfiles:
-                            if os.path.isfile(lockfile):
-                                try:
-                                    os.remove(lockfile)
-                                except Exception:
-                                    self.pipeline.utils.report.debug(traceback.format_exc())
-                                    self.pipeline.utils.report.debug("Could not remove Pipeline 2 lockfile")
-                        try:
-                            # start engine if it's not started already
-                            self.pipeline.utils.report.info("Starter lokal instans av Pipeline 2…")
-                            process = self.pipeline.utils.filesystem.run([DaisyPipelineJob.dp2_cli, "help"], shell=True, cwd=DaisyPipelineJob.dp2_home)
-                            if process.returncode != 0:
-                                self.pipeline.utils.report.error("En feil oppstod når Pipeline 2 forsøkte å starte")
-                                continue
-
-                        except subprocess.TimeoutExpired:
-                            self.pipeline.utils.report.info("Oppstart av Pipeline 2 tok for lang tid og ble derfor stoppet")
-                            continue
-
-                        except subprocess.CalledProcessError:
-                            self.pipeline.utils.report.debug(traceback.format_exc(), preformatted=True)
-                            self.pipeline.utils.report.warn("En feil oppstod når Pipeline 2 startet. Vi venter noen sekunder og prøver igjen...")
-                            time.sleep(5)
-                            try:
-                                # start engine if it's not started already
-                                self.pipeline.utils.report.info("Starter lokal instans av Pipeline 2…")
-                                process = self.pipeline.utils.filesystem.run([DaisyPipelineJob.dp2_cli, "help"], shell=True, cwd=DaisyPipelineJob.dp2_home)
-                                if process.returncode != 0:
-                                    self.pipeline.utils.report.error("En feil oppstod når Pipeline 2 startet")
-                                    continue
-
-                            except subprocess.TimeoutExpired:
-                                self.pipeline.utils.report.info("Oppstart av Pipeline 2 tok for lang tid og ble derfor stoppet")
-                                continue
-
-                            except subprocess.CalledProcessError:
-                                self.pipeline.utils.report.debug(traceback.format_exc(), preformatted=True)
-                                self.pipeline.utils.report.error("En feil oppstod når Pipeline 2 forsøkte å starte")
-                                continue
-
-                        # Save PID for Pipeline 2 engine
-                        procs = DaisyPipelineJob.local_list_processes()
-                        if procs:
-                            self.pipeline.utils.report.debug("found newly started process")
-                            DaisyPipelineJob.pid = procs[0].pid
-                            running = True
-                        else:
-                            self.pipeline.utils.report.debug("newly started process not found")
-
-                        time.sleep(5)  # Wait a few seconds after starting Pipeline 2 before releasing the lock
-
-                self.pipeline.utils.report.debug("[local_start_engine] releasing DP2 start lock")
-                return running
-
-            else:
-                self.pipeline.utils.report.error("Ventet for lenge på tilgang til Pipeline 2")
-                self.pipeline.utils.report.debug("[local_start_engine] could not acquire DP2 start lock")
-
-        return False
-
     def __init__(self, pipeline, script, arguments, context={}, priority="medium", pipeline_and_script_version=None):
         if isinstance(pipeline_and_script_version, tuple):
             pipeline_and_script_version = [pipeline_and_script_version]
@@ -254,223 +105,196 @@ class DaisyPipelineJob():
         self.pipeline_and_script_version = pipeline_and_script_version
 
     def __enter__(self):
+        if self.start():
+            self.wait()
+        return self
+
+    def start(self):
+        """
+        Choose an engine and post the job.
+
+        Returns a future that is resolved with the final status of the job when it is done,
+        or None if the job could not be started.
+        """
         DaisyPipelineJob.init_environment()
 
         self._dir_output_obj = tempfile.TemporaryDirectory(prefix="produksjonssystem-", suffix="-daisy-pipeline-output")
         self.dir_output = self._dir_output_obj.name
 
-        if self.choose_engine():
-            try:
-                self.post_job()
-
-                self.status = "IDLE"
-                idle_start = time.time()
-                running_start = time.time()
-                idle_timeout = 3600 * 2.5
-                running_timeout = 3600 * 2
-                timed_out = False
-                engine_died = False
-                while not timed_out and self.status in ["IDLE", "RUNNING"]:
+        if not self.choose_engine():
+            self.pipeline.utils.report.error("Pipeline 2 er ikke tilgjengelig")
+            return None
+
+        try:
+            self.post_job()
+            self.status = "IDLE"
+            self._monitored_job = DaisyPipelineMonitor.watch(self.engine, self.job_id)
+            self.future = self._monitored_job["future"]
+            if self.engine["local"]:
+                self.future.add_done_callback(lambda future, engine=self.engine: DaisyPipelineLocalEngines.job_finished(engine))
+            return self.future
+
+        except Exception:
+            if self.engine["local"] and self.future is None:
+                DaisyPipelineLocalEngines.job_finished(self.engine)
+            self.pipeline.utils.report.debug(traceback.format_exc(), preformatted=True)
+            self.pipeline.utils.report.error("En feil oppstod ved kjøring av Pipeline 2-jobben (" + str(self.job_id) + ")")
+            self.status = None
+            return None
+
+    def wait(self):
+        """Wait for the job to finish, and get the log and results"""
+        try:
+            idle_start = time.time()
+            running_start = time.time()
+            idle_timeout = 3600 * 2.5
+            running_timeout = 3600 * 2
+            timed_out = False
+            with self.pipeline.waiting_for_external_job():  # lets the pipeline process other books while waiting
+                while not timed_out and not self.future.done():
                     if not self.pipeline.shouldRun:
                         self.pipeline.utils.report.error("Systemet er i ferd med å slå seg av, og Pipeline 2-jobben ble derfor ikke ferdig.")
+                        DaisyPipelineMonitor.unwatch(self._monitored_job)
                         self.status = None
-                        break
+                        return
 
-                    timed_out = self.status == "IDLE" and time.time() - idle_start > idle_timeout or time.time() - running_start > running_timeout
-                    time.sleep(5)
+                    try:
+                        self.future.result(timeout=5)
+                    except concurrent.futures.TimeoutError:
+                        pass
+
+                    if self.status != self._monitored_job["status"]:
+                        self.status = self._monitored_job["status"]
+                        self.pipeline.utils.report.debug("Pipeline 2 status: " + str(self.status))
 
                     if self.status == "IDLE":
                         self.pipeline.watchdog_bark()  # keep pipeline alive while waiting in queue
                         running_start = time.time()
 
-                    is_alive = False
-                    for retry in range(10):
-                        is_alive = DaisyPipelineJob.is_alive(self.engine)
-                        if is_alive:
-                            break
-                        time.sleep(5)
-                    if not is_alive:
-                        engine_died = True
-                        self.pipeline.utils.report.error("Pipeline 2 kjører ikke lenger. Avbryter…")
-                        break
-
-                    # get job status
-                    self.pipeline.utils.report.debug("Getting job status")
-                    self.get_status()
-
-                    self.pipeline.utils.report.debug("Pipeline 2 status: " + self.status)
-
-                if timed_out:
-                    self.pipeline.utils.report.error("Pipeline 2 brukte for lang tid")
-                    self.status = None
-
-                    # if we're using a local engine, we should stop the engine as it might have crashed
-                    if self.engine["local"]:
-                        DaisyPipelineJob.local_stop_engine(self.pipeline)
-
-                elif engine_died:
-                    pass  # Nothing we can do
+                    timed_out = self.status == "IDLE" and time.time() - idle_start > idle_timeout or time.time() - running_start > running_timeout
 
-                else:
-                    # get job log (the run method will log stdout/stderr as debug output)
-                    self.pipeline.utils.report.debug("Getting job log")
-                    self.pipeline.utils.report.debug(self.get_log())
+            if timed_out:
+                DaisyPipelineMonitor.unwatch(self._monitored_job)
+                self.pipeline.utils.report.error("Pipeline 2 brukte for lang tid")
+                self.status = None
 
-                    # get job results
-                    self.pipeline.utils.report.debug("Getting job results")
-                    self.get_results()
+                # if we're using a local engine, we should restart the engine as it might have crashed
+                if self.engine["local"]:
+                    DaisyPipelineLocalEngines.restart(self.engine)
+                return
 
-            except subprocess.TimeoutExpired:
-                self.pipeline.utils.report.error("Pipeline 2-jobben {} tok for lang tid og ble derfor stoppet".format(self.job_id))
-                self.status = None
+            self.status = self.future.result()
+            if self._monitored_job["engine_died"]:
+                self.pipeline.utils.report.error("Pipeline 2 kjører ikke lenger. Avbryter…")
+                return  # Nothing we can do
 
-            except Exception:
-                self.pipeline.utils.report.debug(traceback.format_exc(), preformatted=True)
-                self.pipeline.utils.report.error("En feil oppstod ved kjøring av Pipeline 2-jobben (" + str(self.job_id) + ")")
-                self.status = None
+            # get job log (the run method will log stdout/stderr as debug output)
+            self.pipeline.utils.report.debug("Getting job log")
+            self.pipeline.utils.report.debug(self.get_log())
 
-        else:
-            self.pipeline.utils.report.error("Pipeline 2 er ikke tilgjengelig")
+            # get job results
+            self.pipeline.utils.report.debug("Getting job results")
+            self.get_results()
 
-        return self
+        except subprocess.TimeoutExpired:
+            self.pipeline.utils.report.error("Pipeline 2-jobben {} tok for lang tid og ble derfor stoppet".format(self.job_id))
+            self.status = None
 
-    def choose_engine(self, use_local=False):
-        self.pipeline.utils.report.debug("[choose_engine] trying to aquire DP2 engine lock")
-        with DaisyPipelineJob.engine_lock.acquire_timeout(600) as locked:
-            if locked:
-                self.pipeline.utils.report.debug("[choose_engine] aquired DP2 engine lock")
-
-                self.engine = None
-                min_queue_size = float('Inf')
-                has_local = False
-
-                # always start a local engine, even if we're not using it (Pipeline 2 Web UI currently depends on having it running)
-                # we should remove this when we've moved the Web UI over to using another Pipeline 2 instance.
-                local_engines = [e for e in DaisyPipelineJob.engines if e["local"]]
-                if len(local_engines) > 0 and not DaisyPipelineJob.is_alive(local_engines[0]):
-                    self.local_start_engine()
-
-                (self.found_pipeline_version, self.found_script_version) = (None, None)
-
-                for (pipeline_version, script_version) in self.pipeline_and_script_version:
-                    if (pipeline_version, script_version) != self.pipeline_and_script_version[0]:
-                        self.pipeline.utils.report.warning("Desired version of Pipeline 2 engine and version of script not found.")
-                        self.pipeline.utils.report.warning(
-                            "Trying Pipeline 2 engine version '{}' and script version '{}' instead…".format(pipeline_version, script_version)
-                        )
-
-                    for engine in DaisyPipelineJob.engines:
-                        if not self.pipeline.shouldRun:
-                            self.pipeline.utils.report.error("Systemet er i ferd med å slå seg av, og Pipeline 2-jobben ble derfor ikke startet.")
-                            self.status = None
-                            break
-
-                        if engine["local"]:
-                            has_local = True
-
-                        if engine["local"] and not use_local:
-                            # we're looking for remote engines: skip local engines
-                            continue
-
-                        if not engine["local"] and use_local:
-                            # we're looking for local engines: skip remote engines
-                            continue
-
-                        if not self.script_available(engine, pipeline_version=pipeline_version, script_version=script_version):
-                            # desired script is not available or engine is not available: don't use this engine
-                            continue
-
-                        queue_size = self.get_queue_size(engine)
-                        if queue_size < min_queue_size:
-                            # smaller queue than any previously found: use this engine
-                            self.engine = engine
-                            (self.found_pipeline_version, self.found_script_version) = (pipeline_version, script_version)
-                        if queue_size == 0:
-                            # empty queue: no point checking other engines
-                            break
-
-                    if self.engine:
-                        break  # if we've found an appropriate engine, don't try alternative versions
-
-                # Only start a local engine if no other engine is available
-                if not self.engine and has_local:
-                    self.pipeline.utils.report.warning("No remote version of the Pipeline 2 engine with the desired engine and script version were found.")
-                    self.pipeline.utils.report.warning("Trying local Pipeline 2 engine instead…")
-
-                    if self.local_start_engine():
-                        self.choose_engine(use_local=True)
-
-                if self.engine:
-                    self.pipeline.utils.report.info("Bruker Pipeline 2-instans på: {}".format(self.engine["endpoint"]))
-                    self.pipeline.utils.report.info("Pipeline 2-versjon: {}".format(self.found_pipeline_version))
-                    self.pipeline.utils.report.info("Versjon av {}: {}".format(self.script, self.found_script_version))
-                else:
-                    self.pipeline.utils.report.warning("Fant ingen brukbar Pipeline 2-instans")
+        except Exception:
+            self.pipeline.utils.report.debug(traceback.format_exc(), preformatted=True)
+            self.pipeline.utils.report.error("En feil oppstod ved kjøring av Pipeline 2-jobben (" + str(self.job_id) + ")")
+            self.status = None
+
+    def choose_engine(self, wait_for_local=True):
+        self.engine = None
+        min_queue_size = float('Inf')
+        has_local = False
+
+        (self.found_pipeline_version, self.found_script_version) = (None, None)
+
+        for (pipeline_version, script_version) in self.pipeline_and_script_version:
+            if (pipeline_version, script_version) != self.pipeline_and_script_version[0]:
+                self.pipeline.utils.report.warning("Desired version of Pipeline 2 engine and version of script not found.")
+                self.pipeline.utils.report.warning(
+                    "Trying Pipeline 2 engine version '{}' and script version '{}' instead…".format(pipeline_version, script_version)
+                )
 
-                self.pipeline.utils.report.debug("[choose_engine] releasing DP2 engine lock")
-                return self.engine is not None
+            for engine in DaisyPipelineJob.engines:
+                if not self.pipeline.shouldRun:
+                    self.pipeline.utils.report.error("Systemet er i ferd med å slå seg av, og Pipeline 2-jobben ble derfor ikke startet.")
+                    self.status = None
+                    break
+
+                if engine["local"]:
+                    has_local = True
+
+                if engine["local"] and not DaisyPipelineLocalEngines.is_ready(engine):
+                    # local engine is starting or restarting: don't use this engine
+                    continue
+
+                if not self.script_available(engine, pipeline_version=pipeline_version, script_version=script_version):
+                    # desired script is not available or engine is not available: don't use this engine
+                    continue
+
+                queue_size = self.get_queue_size(engine)
+                if queue_size < min_queue_size:
+                    # smaller queue than any previously found: use this engine
+                    self.engine = engine
+                    min_queue_size = queue_size
+                    (self.found_pipeline_version, self.found_script_version) = (pipeline_version, script_version)
+                if queue_size == 0:
+                    # empty queue: no point checking other engines
+                    break
+
+            if self.engine:
+                break  # if we've found an appropriate engine, don't try alternative versions
+
+        # If no engine is available, wait for a local engine to finish starting
+        if not self.engine and has_local and wait_for_local:
+            self.pipeline.utils.report.warning("No ready Pipeline 2 engine with the desired engine and script version were found.")
+            self.pipeline.utils.report.warning("Waiting for a local Pipeline 2 engine to start…")
+
+            if DaisyPipelineLocalEngines.wait_until_ready(self.pipeline):
+                return self.choose_engine(wait_for_local=False)
+
+        if self.engine and self.engine["local"] and not DaisyPipelineLocalEngines.job_started(self.engine):
+            # the local engine started restarting after we chose it: choose again
+            return self.choose_engine(wait_for_local=wait_for_local)
+
+        if self.engine:
+            DaisyPipelineEngines.add_dispatched_job(self.engine)
+            self.pipeline.utils.report.info("Bruker Pipeline 2-instans på: {}".format(self.engine["endpoint"]))
+            self.pipeline.utils.report.info("Pipeline 2-versjon: {}".format(self.found_pipeline_version))
+            self.pipeline.utils.report.info("Versjon av {}: {}".format(self.script, self.found_script_version))
+        else:
+            self.pipeline.utils.report.warning("Fant ingen brukbar Pipeline 2-instans")
 
-            else:
-                self.pipeline.utils.report.error("Ventet for lenge på tilgang til Pipeline 2")
-                self.pipeline.utils.report.debug("[choose_engine] could not aquire DP2 engine lock")
-                return None
+        return self.engine is not None
 
     def script_available(self, engine, pipeline_version, script_version):
-        alive = None
-        scripts = None
-
-        try:
-            self.pipeline.utils.report.debug(DaisyPipelineJob.encode_url(engine, "/alive", {}))
-            alive = requests.get(DaisyPipelineJob.encode_url(engine, "/alive", {}))
-            if alive.ok:
-                alive = str(alive.content, 'utf-8')
-                alive = ElementTree.XML(alive.split("?>")[-1])
-            else:
-                alive = None
-        except Exception:
-            alive = None
+        capabilities = DaisyPipelineEngines.get_capabilities(engine)
 
-        if alive is None:
+        if not capabilities["alive"]:
             self.pipeline.utils.report.warning("Pipeline 2 kjører ikke på: {}".format(engine["endpoint"]))
             return False
 
-        # find engine version
-        engine_pipeline_version = alive.attrib.get("version")
-
         # test for correct engine version
-        if pipeline_version is not None and pipeline_version != engine_pipeline_version:
+        if pipeline_version is not None and pipeline_version != capabilities["version"]:
             self.pipeline.utils.report.debug("Incorrect version of Pipeline 2. Looking for {} but found {}.".format(pipeline_version,
-                                                                                                                    engine_pipeline_version))
+                                                                                                                    capabilities["version"]))
             return False
 
-        try:
-            scripts = requests.get(DaisyPipelineJob.encode_url(engine, "/scripts", {}))
-            if scripts.ok:
-                scripts = str(scripts.content, 'utf-8')
-                scripts = ElementTree.XML(scripts.split("?>")[-1])
-            else:
-                scripts = None
-        except Exception:
-            scripts = None
-
-        if scripts is None:
+        if capabilities["scripts"] is None:
             self.pipeline.utils.report.warning("Klarte ikke å hente liste over skript fra Pipeline 2 på: {}".format(engine["endpoint"]))
             return False
 
-        # find script
-        engine_script = scripts.xpath("/d:scripts/d:script[@id='{}']".format(self.script), namespaces=DaisyPipelineJob.dp2_ws_namespace)
-        engine_script = engine_script[0] if len(engine_script) else None
-
         # test if script was found
-        if engine_script is None:
+        if self.script not in capabilities["scripts"]:
             self.pipeline.utils.report.debug("Script not found: {}".format(self.script))
             return False
 
-        # find script version
-        engine_script_version = engine_script.xpath("d:version", namespaces=DaisyPipelineJob.dp2_ws_namespace) if len(engine_script) else None
-        engine_script_version = engine_script_version[0].text if len(engine_script_version) else None
-
         # test if script version is correct
+        engine_script_version = capabilities["scripts"][self.script]
         if script_version is not None and script_version != engine_script_version:
             self.pipeline.utils.report.debug("Incorrect version of Pipeline 2. Looking for {} but found {}.".format(script_version,
                                                                                                                     engine_script_version))
@@ -486,7 +310,7 @@ class DaisyPipelineJob():
         self.pipeline.utils.report.debug("Posting job")
 
         script_href = DaisyPipelineJob.encode_url(self.engine, "/scripts/{}".format(self.script), {})
-        response = requests.get(script_href)
+        response = HttpClient.get(script_href)
         response = str(response.content, 'utf-8')
         script = ElementTree.XML(response.split("?>")[-1])
 
@@ -548,59 +372,25 @@ class DaisyPipelineJob():
                         option_xml += "<item value=\"{}\"/>".format(value)
                 option_xml += "</option>"
                 jobRequest.append(ElementTree.XML(option_xml))
-        # Temporary files
-        jobRequest_file_obj = tempfile.NamedTemporaryFile(suffix=".xml")
-        context_file_obj = tempfile.NamedTemporaryFile(suffix=".zip")
-
-        multipart_fields = {}
-
-        response = None
-        jobRequest_file = None
-        context_file = None
-
-        try:  # use `try`/`except` instead of `with` for `open`ing the files
-
-            # Save jobRequest as a file
-            jobRequest_path = jobRequest_file_obj.name
-            jobRequest_document = ElementTree.ElementTree(jobRequest)
-            jobRequest_document.write(jobRequest_path, xml_declaration=True, encoding='UTF-8', pretty_print=True)
-            jobRequest_file = open(jobRequest_path, 'rb')
-            multipart_fields["job-request"] = ('jobRequest.xml', jobRequest_file, 'application/xml')
-            with open(jobRequest_path) as f:
-                self.pipeline.utils.report.debug("Job request: " + "".join(f.readlines()))
+        jobRequest_document = ElementTree.tostring(jobRequest, xml_declaration=True, encoding='UTF-8', pretty_print=True)
+        self.pipeline.utils.report.debug("Job request: " + jobRequest_document.decode('utf-8'))
 
-            # URL to POST to
-            url = DaisyPipelineJob.encode_url(self.engine, "/jobs", {})
+        # URL to POST to
+        url = DaisyPipelineJob.encode_url(self.engine, "/jobs", {})
 
-            # If there's a context, zip it and POST the request as a multipart request
-            if self.context and not self.engine["local"]:
-                context_path = context_file_obj.name
-                """Zip the contents of `dir`"""
-                with zipfile.ZipFile(context_path, 'w') as archive:
-                    for href in self.context:
-                        file = self.context[href]
-                        self.pipeline.utils.report.debug("zipping context: " + href + " from " + str(file))
-                        archive.write(str(file), href, compress_type=zipfile.ZIP_DEFLATED)
+        if self.context and not self.engine["local"]:
+            # If there's a context, zip it and POST the request as a multipart request.
+            # The zip file is generated while it is being sent, so it is never stored on disk.
+            boundary = uuid.uuid4().hex
+            response = HttpClient.post(url,
+                                       data=self.multipart_body(boundary, jobRequest_document),
+                                       headers={"Content-Type": "multipart/form-data; boundary={}".format(boundary)},
+                                       timeout=600)
 
-                context_file = open(context_path, 'rb')
-                multipart_fields["job-data"] = ('context.zip', context_file, 'application/zip')
+        else:  # there's no context documents; do a normal POST
+            response = HttpClient.post(url, data=jobRequest_document, headers={"Content-Type": "application/xml"}, timeout=600)
 
-                multipart = MultipartEncoder(fields=multipart_fields)
-
-                response = requests.post(url, data=multipart, headers={"Content-Type": multipart.content_type})
-
-            else:  # there's no context documents; do a normal POST
-                response = requests.post(url, data=jobRequest_file, headers={"Content-Type": "application/xml"})
-
-            response = str(response.content, 'utf-8')
-
-        finally:
-            try:
-                if jobRequest_file is not None:
-                    jobRequest_file.close()
-            finally:
-                if context_file is not None:
-                    context_file.close()
+        response = str(response.content, 'utf-8')
 
         try:
             job = ElementTree.XML(response.split("?>")[-1])
@@ -611,10 +401,22 @@ class DaisyPipelineJob():
 
         return self.job_id
 
+    def multipart_body(self, boundary, jobRequest_document):
+        """Generate the multipart body for a job request with context, as a stream of bytes"""
+        yield ("--{}\r\n".format(boundary)
+               + "Content-Disposition: form-data; name=\"job-request\"; filename=\"jobRequest.xml\"\r\n"
+               + "Content-Type: application/xml\r\n\r\n").encode('utf-8')
+        yield jobRequest_document
+        yield ("\r\n--{}\r\n".format(boundary)
+               + "Content-Disposition: form-data; name=\"job-data\"; filename=\"context.zip\"\r\n"
+               + "Content-Type: application/zip\r\n\r\n").encode('utf-8')
+        yield from Filesystem.zip_stream(self.pipeline.utils.report, self.context)
+        yield "\r\n--{}--\r\n".format(boundary).encode('utf-8')
+
     def get_status(self):
         url = DaisyPipelineJob.encode_url(self.engine, "/jobs/{}".format(self.job_id), {})
         try:
-            response = requests.get(url)
+            response = HttpClient.get(url)
             if not response.ok:
                 return self.status  # avoid failing if there's a single failed status request (return previous response instead)
         except Exception:
@@ -629,44 +431,55 @@ class DaisyPipelineJob():
         return self.status
 
     def delete_job(self, engine, job_id):
-        self.pipeline.utils.report.debug("[delete_job] trying to aquire DP2 engine lock")
-        with DaisyPipelineJob.engine_lock.acquire_timeout(600) as locked:
-            if locked:
-                self.pipeline.utils.report.debug("[delete_job] aquired DP2 engine lock")
-                url = DaisyPipelineJob.encode_url(engine, "/jobs/{}".format(job_id), {})
-                try:
-                    response = requests.delete(url)
-
-                    if response.ok:
-                        self.pipeline.utils.report.debug("Job deleted: {} @ {}".format(job_id, engine["endpoint"]))
-                    else:
-                        self.pipeline.utils.report.warning("Klarte ikke å slette Pipeline 2-jobb: {} @ {}".format(job_id, engine["endpoint"]))
+        url = DaisyPipelineJob.encode_url(engine, "/jobs/{}".format(job_id), {})
+        try:
+            response = HttpClient.delete(url)
 
-                    self.pipeline.utils.report.debug("[delete_job] releasing DP2 engine lock")
-                    return response.ok
+            if response.ok:
+                self.pipeline.utils.report.debug("Job deleted: {} @ {}".format(job_id, engine["endpoint"]))
+            else:
+                self.pipeline.utils.report.warning("Klarte ikke å slette Pipeline 2-jobb: {} @ {}".format(job_id, engine["endpoint"]))
 
-                except Exception:
-                    self.pipeline.utils.report.exception("Klarte ikke å slette Pipeline 2-jobb: {} @ {}".format(job_id, engine["endpoint"]))
-                    self.pipeline.utils.report.debug("[delete_job] releasing DP2 engine lock")
-                    return False
+            return response.ok
 
-            else:
-                self.pipeline.utils.report.error("Ventet for lenge på tilgang til Pipeline 2")
-                self.pipeline.utils.report.debug("[delete_job] could not aquire DP2 engine lock")
-                return False
+        except Exception:
+            self.pipeline.utils.report.exception("Klarte ikke å slette Pipeline 2-jobb: {} @ {}".format(job_id, engine["endpoint"]))
+            return False
 
     def get_log(self):
         url = DaisyPipelineJob.encode_url(self.engine, "/jobs/{}/log".format(self.job_id), {})
-        response = requests.get(url)
+        response = HttpClient.get(url)
         return str(response.content, 'utf-8')
 
     def get_results(self):
+        url = DaisyPipelineJob.encode_url(self.engine, "/jobs/{}/result".format(self.job_id), {})
+
+        # extract the results while they are downloaded
+        try:
+            with HttpClient.get(url, stream=True) as r:
+                r.raw.decode_content = True
+                Filesystem.unzip_stream(self.pipeline.utils.report, r.raw, self.dir_output)
+            return
+
+        except Exception:
+            # for instance a ZIP feature we can't extract while streaming (ValueError), or a truncated
+            # or corrupt download (EOFError, zipfile.BadZipFile, zlib.error, connection errors)
+            self.pipeline.utils.report.debug(traceback.format_exc(), preformatted=True)
+            self.pipeline.utils.report.debug("Klarte ikke å pakke ut resultatet fra Pipeline 2 mens det ble lastet ned. Laster ned på nytt…")
+
+            # remove anything that was extracted before it failed
+            for name in os.listdir(self.dir_output):
+                path = os.path.join(self.dir_output, name)
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+
+        # if that fails, download the results to a temporary file first, and then extract them
         result_obj = tempfile.NamedTemporaryFile(prefix="daisy-pipeline-results-", suffix=".zip")
         result = result_obj.name
 
-        url = DaisyPipelineJob.encode_url(self.engine, "/jobs/{}/result".format(self.job_id), {})
-
-        with requests.get(url, stream=True) as r:
+        with HttpClient.get(url, stream=True) as r:
             with open(result, 'wb') as f:
                 shutil.copyfileobj(r.raw, f)
 
@@ -677,59 +490,13 @@ class DaisyPipelineJob():
     def is_alive(engine):
         url = DaisyPipelineJob.encode_url(engine, "/alive", {})
         try:
-            response = requests.get(url)
+            response = HttpClient.get(url)
             return response.ok
         except Exception:
             return False
 
     def get_queue_size(self, engine):
-        url = DaisyPipelineJob.encode_url(engine, "/jobs", {})
-        try:
-            response = requests.get(url)
-            if not response.ok:
-                return 10  # assume many jobs instead of failing
-        except Exception:
-            return 10  # assume many jobs instead of failing
-
-        response = str(response.content, 'utf-8')
-        xml = ElementTree.XML(response.split("?>")[-1])
-
-        queue_size = 0
-        jobs = xml.xpath("/d:jobs/d:job", namespaces=DaisyPipelineJob.dp2_ws_namespace)
-        job_ids = []
-        for job in jobs:
-            job_ids.append(job.attrib.get("id"))
-
-            # possible Pipeline 2 job statuses: IDLE, RUNNING, SUCCESS, ERROR, FAIL
-            if job.attrib.get("status") in ["IDLE", "RUNNING"]:
-                queue_size += 1
-
-        self.delete_old_jobs(engine, job_ids)
-
-        return queue_size
-
-    def delete_old_jobs(self, engine, job_ids):
-        # initialize engine_jobs if necessary
-        if DaisyPipelineJob.engine_jobs is None:
-            DaisyPipelineJob.engine_jobs = {}
-        if engine["endpoint"] not in DaisyPipelineJob.engine_jobs:
-            DaisyPipelineJob.engine_jobs[engine["endpoint"]] = {}
-
-        # add newly found jobs
-        for job_id in job_ids:
-            if job_id not in DaisyPipelineJob.engine_jobs[engine["endpoint"]]:
-                DaisyPipelineJob.engine_jobs[engine["endpoint"]][job_id] = time.time()
-
-        # remove jobs that are no longer present in the engine
-        for job_id in list(DaisyPipelineJob.engine_jobs[engine["endpoint"]].keys()):
-            if job_id not in job_ids:
-                del DaisyPipelineJob.engine_jobs[engine["endpoint"]][job_id]
-
-        # delete old jobs
-        for job_id in DaisyPipelineJob.engine_jobs[engine["endpoint"]]:
-            age = time.time() - DaisyPipelineJob.engine_jobs[engine["endpoint"]][job_id]
-            if age > 3600*3:
-                self.delete_job(engine, job_id)
+        return DaisyPipelineEngines.get_queue_size(engine)
 
     @staticmethod
     def encode_url(engine, endpoint, parameters):
@@ -779,3 +546,559 @@ class DaisyPipelineJob():
                 pass
         procs = list(sorted(procs, key=lambda p: p.create_time()))
         return procs
+
+
+class DaisyPipelineEngines():
+    """
+    Cached information about the Pipeline 2 engines.
+
+    The version of each engine and the scripts it provides are cached for `capabilities_ttl` seconds
+    (or `unavailable_ttl` seconds if the engine did not respond). The queue size of each engine is
+    updated in the background. No lock is held while talking to the engines, so that jobs can
+    be dispatched to engines from several threads at the same time.
+    """
+
+    capabilities_ttl = 600
+    unavailable_ttl = 30
+    refresh_interval = 15
+    old_job_age = 3600 * 3  # delete jobs that are older than this
+
+    # treat as class variables
+    _lock = threading.RLock()  # only held while reading or updating the cache
+    _engines = {}  # endpoint => cached information about the engine
+    _thread = None
+
+    @staticmethod
+    def _entry(engine):
+        with DaisyPipelineEngines._lock:
+            if engine["endpoint"] not in DaisyPipelineEngines._engines:
+                DaisyPipelineEngines._engines[engine["endpoint"]] = {
+                    "capabilities": None,
+                    "capabilities_checked": 0,
+                    "queue_size": None,
+                    "dispatched": 0,  # jobs sent to the engine since the queue size was updated
+                    "jobs": {},  # job id => when we first saw the job
+                }
+            entry = DaisyPipelineEngines._engines[engine["endpoint"]]
+            entry["engine"] = engine
+
+            if DaisyPipelineEngines._thread is None or not DaisyPipelineEngines._thread.is_alive():
+                DaisyPipelineEngines._thread = threading.Thread(target=DaisyPipelineEngines._run, name="dp2 engines", daemon=True)
+                DaisyPipelineEngines._thread.start()
+
+            return entry
+
+    @staticmethod
+    def get_capabilities(engine):
+        """Returns a dict with "alive", "version" (of the engine) and "scripts" (script id => script version)"""
+        entry = DaisyPipelineEngines._entry(engine)
+        capabilities = entry["capabilities"]
+        ttl = DaisyPipelineEngines.capabilities_ttl if capabilities and capabilities["alive"] else DaisyPipelineEngines.unavailable_ttl
+        if capabilities is None or time.time() - entry["capabilities_checked"] > ttl:
+            capabilities = DaisyPipelineEngines._fetch_capabilities(engine)
+            with DaisyPipelineEngines._lock:
+                entry["capabilities"] = capabilities
+                entry["capabilities_checked"] = time.time()
+        return capabilities
+
+    @staticmethod
+    def invalidate(engine):
+        """Forget what we know about an engine, for instance because it has stopped responding"""
+        entry = DaisyPipelineEngines._entry(engine)
+        with DaisyPipelineEngines._lock:
+            entry["capabilities_checked"] = 0
+            entry["queue_size"] = None
+
+    @staticmethod
+    def get_queue_size(engine):
+        """Number of queued and running jobs in the engine, including jobs we have just sent to it"""
+        entry = DaisyPipelineEngines._entry(engine)
+        if entry["queue_size"] is None:
+            DaisyPipelineEngines._refresh_queue(entry)
+        with DaisyPipelineEngines._lock:
+            return (entry["queue_size"] if entry["queue_size"] is not None else 10) + entry["dispatched"]  # assume many jobs if unknown
+
+    @staticmethod
+    def add_dispatched_job(engine):
+        """Count a job that is sent to an engine, so that the next job is sent to another engine if that one has a shorter queue"""
+        entry = DaisyPipelineEngines._entry(engine)
+        with DaisyPipelineEngines._lock:
+            entry["dispatched"] += 1
+
+    @staticmethod
+    def _fetch_capabilities(engine):
+        capabilities = {"alive": False, "version": None, "scripts": None}
+
+        try:
+            alive = HttpClient.get(DaisyPipelineJob.encode_url(engine, "/alive", {}), timeout=30)
+            if not alive.ok:
+                return capabilities
+            alive = ElementTree.XML(str(alive.content, 'utf-8').split("?>")[-1])
+        except Exception:
+            return capabilities
+
+        capabilities["alive"] = True
+        capabilities["version"] = alive.attrib.get("version")
+
+        try:
+            scripts = HttpClient.get(DaisyPipelineJob.encode_url(engine, "/scripts", {}), timeout=30)
+            if not scripts.ok:
+                return capabilities
+            scripts = ElementTree.XML(str(scripts.content, 'utf-8').split("?>")[-1])
+        except Exception:
+            return capabilities
+
+        capabilities["scripts"] = {}
+        for script in scripts.xpath("/d:scripts/d:script", namespaces=DaisyPipelineJob.dp2_ws_namespace):
+            version = script.xpath("d:version", namespaces=DaisyPipelineJob.dp2_ws_namespace)
+            capabilities["scripts"][script.attrib.get("id")] = version[0].text if len(version) else None
+
+        return capabilities
+
+    @staticmethod
+    def _refresh_queue(entry):
+        engine = entry["engine"]
+        try:
+            response = HttpClient.get(DaisyPipelineJob.encode_url(engine, "/jobs", {}), timeout=30)
+            if not response.ok:
+                return
+            xml = ElementTree.XML(str(response.content, 'utf-8').split("?>")[-1])
+        except Exception:
+            return
+
+        queue_size = 0
+        job_ids = []
+        for job in xml.xpath("/d:jobs/d:job", namespaces=DaisyPipelineJob.dp2_ws_namespace):
+            job_ids.append(job.attrib.get("id"))
+
+            # possible Pipeline 2 job statuses: IDLE, RUNNING, SUCCESS, ERROR, FAIL
+            if job.attrib.get("status") in ["IDLE", "RUNNING"]:
+                queue_size += 1
+
+        with DaisyPipelineEngines._lock:
+            entry["queue_size"] = queue_size
+            entry["dispatched"] = 0
+
+            # remember when we first saw each job, and forget jobs that are no longer present in the engine
+            entry["jobs"] = {job_id: entry["jobs"].get(job_id, time.time()) for job_id in job_ids}
+            old_jobs = [job_id for job_id in entry["jobs"] if time.time() - entry["jobs"][job_id] > DaisyPipelineEngines.old_job_age]
+
+        # delete old jobs
+        for job_id in old_jobs:
+            try:
+                response = HttpClient.delete(DaisyPipelineJob.encode_url(engine, "/jobs/{}".format(job_id), {}), timeout=30)
+                if response.ok:
+                    logging.debug("Old job deleted: {} @ {}".format(job_id, engine["endpoint"]))
+            except Exception:
+                logging.exception("Klarte ikke å slette Pipeline 2-jobb: {} @ {}".format(job_id, engine["endpoint"]))
+
+    @staticmethod
+    def _run():
+        while True:
+            time.sleep(DaisyPipelineEngines.refresh_interval)
+
+            with DaisyPipelineEngines._lock:
+                entries = list(DaisyPipelineEngines._engines.values())
+
+            for entry in entries:
+                try:
+                    if DaisyPipelineEngines.get_capabilities(entry["engine"])["alive"]:
+                        DaisyPipelineEngines._refresh_queue(entry)
+                except Exception:
+                    logging.exception("Klarte ikke å oppdatere informasjon om Pipeline 2 på: {}".format(entry["engine"]["endpoint"]))
+
+
+class DaisyPipelineLocalEngines():
+    """
+    Supervisor for a pool of warm local Pipeline 2 engines.
+
+    `size` engines are started in the background and kept running, so that jobs
+    don't have to wait for an engine to start. The engines are health-checked
+    regularly, and restarted when they stop responding. An idle engine is restarted
+    after `max_jobs` jobs, or when it uses more than `max_memory` MB of memory.
+    """
+
+    size = int(os.getenv("LOCAL_PIPELINE2_ENGINES", "0"))
+    first_port = int(os.getenv("LOCAL_PIPELINE2_PORT", "8181"))
+    max_jobs = int(os.getenv("LOCAL_PIPELINE2_MAX_JOBS", "100"))
+    max_memory = int(os.getenv("LOCAL_PIPELINE2_MAX_MEMORY", "4096"))  # in MB
+    health_check_interval = 30
+    startup_check_interval = 2
+    startup_timeout = 300
+
+    # treat as class variables
+    _condition = threading.Condition()  # notified when the state of an engine changes
+    _engines = []  # list of {"engine", "process", "state", "active_jobs", "jobs", "started", "restart"}
+    _thread = None
+    _stopping = False
+
+    @staticmethod
+    def start():
+        """Start the supervisor (if it's not already started), and return the local engines"""
+        if DaisyPipelineLocalEngines.size <= 0 or not os.path.isfile(DaisyPipelineLocalEngines.executable()):
+            return []
+
+        with DaisyPipelineLocalEngines._condition:
+            if not DaisyPipelineLocalEngines._engines:
+                for i in range(DaisyPipelineLocalEngines.size):
+                    DaisyPipelineLocalEngines._engines.append({
+                        "engine": {
+                            "endpoint": "http://localhost:{}/ws".format(DaisyPipelineLocalEngines.first_port + i),
+                            "authentication": "false",
+                            "key": "none",
+                            "secret": "none",
+                            "local": True,
+                        },
+                        "process": None,
+                        "state": "stopped",  # stopped, starting, ready or recycling
+                        "active_jobs": 0,
+                        "jobs": 0,
+                        "started": None,
+                        "restart": False,
+                    })
+
+            if not DaisyPipelineLocalEngines._stopping and (DaisyPipelineLocalEngines._thread is None
+                                                            or not DaisyPipelineLocalEngines._thread.is_alive()):
+                DaisyPipelineLocalEngines._thread = threading.Thread(target=DaisyPipelineLocalEngines._run, name="dp2 local engines", daemon=True)
+                DaisyPipelineLocalEngines._thread.start()
+
+            return [local["engine"] for local in DaisyPipelineLocalEngines._engines]
+
+    @staticmethod
+    def executable():
+        return os.path.join(DaisyPipelineJob.dp2_home, "bin", "pipeline2")
+
+    @staticmethod
+    def _find(engine):
+        for local in DaisyPipelineLocalEngines._engines:
+            if local["engine"]["endpoint"] == engine["endpoint"]:
+                return local
+        return None
+
+    @staticmethod
+    def is_ready(engine):
+        with DaisyPipelineLocalEngines._condition:
+            local = DaisyPipelineLocalEngines._find(engine)
+            return local is not None and local["state"] == "ready"
+
+    @staticmethod
+    def job_started(engine):
+        """Register that a job is sent to the engine. Returns False if the engine is no longer ready."""
+        with DaisyPipelineLocalEngines._condition:
+            local = DaisyPipelineLocalEngines._find(engine)
+            if local is None or local["state"] != "ready":
+                return False
+            local["active_jobs"] += 1
+            local["jobs"] += 1
+            return True
+
+    @staticmethod
+    def job_finished(engine):
+        with DaisyPipelineLocalEngines._condition:
+            local = DaisyPipelineLocalEngines._find(engine)
+            if local is not None and local["active_jobs"] > 0:
+                local["active_jobs"] -= 1
+                DaisyPipelineLocalEngines._condition.notify_all()
+
+    @staticmethod
+    def restart(engine):
+        """Restart the engine as soon as possible, for instance because a job on it has timed out"""
+        with DaisyPipelineLocalEngines._condition:
+            local = DaisyPipelineLocalEngines._find(engine)
+            if local is not None:
+                local["restart"] = True
+                DaisyPipelineLocalEngines._condition.notify_all()
+
+    @staticmethod
+    def wait_until_ready(pipeline, timeout=None):
+        """Wait until at least one local engine is ready. Returns False if none are ready within the timeout."""
+        deadline = time.time() + (timeout if timeout is not None else DaisyPipelineLocalEngines.startup_timeout)
+        with DaisyPipelineLocalEngines._condition:
+            while not any(local["state"] == "ready" for local in DaisyPipelineLocalEngines._engines):
+                if not pipeline.shouldRun or DaisyPipelineLocalEngines._stopping or time.time() >= deadline:
+                    return False
+                pipeline.watchdog_bark()
+                DaisyPipelineLocalEngines._condition.wait(timeout=min(5, max(0, deadline - time.time())))
+            return True
+
+    @staticmethod
+    def stop_all():
+        with DaisyPipelineLocalEngines._condition:
+            DaisyPipelineLocalEngines._stopping = True
+            DaisyPipelineLocalEngines._condition.notify_all()
+            engines = list(DaisyPipelineLocalEngines._engines)
+        for local in engines:
+            DaisyPipelineLocalEngines._stop(local)
+
+    @staticmethod
+    def _run():
+        # stop engines left behind by a previous run of the production system
+        DaisyPipelineLocalEngines._stop_processes(DaisyPipelineJob.local_list_processes())
+
+        while True:
+            with DaisyPipelineLocalEngines._condition:
+                if DaisyPipelineLocalEngines._stopping:
+                    return
+                engines = list(DaisyPipelineLocalEngines._engines)
+
+            for local in engines:
+                try:
+                    DaisyPipelineLocalEngines._check(local)
+                except Exception:
+                    logging.exception("Klarte ikke å sjekke lokal Pipeline 2 på: {}".format(local["engine"]["endpoint"]))
+
+            with DaisyPipelineLocalEngines._condition:
+                starting = any(local["state"] in ["stopped", "starting"] for local in DaisyPipelineLocalEngines._engines)
+                restart = any(local["restart"] for local in DaisyPipelineLocalEngines._engines)
+                if not DaisyPipelineLocalEngines._stopping and not restart:
+                    DaisyPipelineLocalEngines._condition.wait(timeout=DaisyPipelineLocalEngines.startup_check_interval
+                                                              if starting else DaisyPipelineLocalEngines.health_check_interval)
+
+    @staticmethod
+    def _check(local):
+        engine = local["engine"]
+        process_running = local["process"] is not None and local["process"].poll() is None
+
+        if local["state"] == "stopped" or local["restart"]:
+            if local["restart"]:
+                logging.info("Starter lokal Pipeline 2 på nytt: {}".format(engine["endpoint"]))
+            DaisyPipelineLocalEngines._stop(local)
+            DaisyPipelineLocalEngines._start(local)
+
+        elif local["state"] == "starting":
+            if DaisyPipelineJob.is_alive(engine):
+                logging.info("Lokal Pipeline 2 er klar: {}".format(engine["endpoint"]))
+                DaisyPipelineEngines.invalidate(engine)
+                DaisyPipelineLocalEngines._set_state(local, "ready")
+            elif not process_running or time.time() - local["started"] > DaisyPipelineLocalEngines.startup_timeout:
+                logging.warning("Lokal Pipeline 2 startet ikke: {}".format(engine["endpoint"]))
+                DaisyPipelineLocalEngines._stop(local)
+
+        elif local["state"] == "ready":
+            if not process_running or not DaisyPipelineJob.is_alive(engine):
+                logging.warning("Lokal Pipeline 2 kjører ikke lenger: {}".format(engine["endpoint"]))
+                DaisyPipelineEngines.invalidate(engine)
+                DaisyPipelineLocalEngines._stop(local)
+                return
+
+            memory = DaisyPipelineLocalEngines._memory(local)
+            if local["jobs"] < DaisyPipelineLocalEngines.max_jobs and memory < DaisyPipelineLocalEngines.max_memory:
+                return
+
+            # recycle the engine when it's idle
+            with DaisyPipelineLocalEngines._condition:
+                if local["active_jobs"] > 0:
+                    return
+                local["state"] = "recycling"
+            logging.info("Starter lokal Pipeline 2 på nytt etter {} jobber og {} MB minnebruk: {}".format(local["jobs"], memory, engine["endpoint"]))
+            DaisyPipelineLocalEngines._stop(local)
+            DaisyPipelineLocalEngines._start(local)
+
+    @staticmethod
+    def _set_state(local, state):
+        with DaisyPipelineLocalEngines._condition:
+            local["state"] = state
+            DaisyPipelineLocalEngines._condition.notify_all()
+
+    @staticmethod
+    def _start(local):
+        port = local["engine"]["endpoint"].split(":")[-1].split("/")[0]
+        data = os.path.join(DaisyPipelineJob.dp2_home, "data-{}".format(port))
+
+        for lockfile in [os.path.join(data, "db", "db.lck"), os.path.join(data, "db", "dbex.lck")]:
+            if os.path.isfile(lockfile):
+                try:
+                    os.remove(lockfile)
+                except Exception:
+                    logging.exception("Could not remove Pipeline 2 lockfile")
+
+        env = dict(os.environ)
+        env["PIPELINE2_WS_PORT"] = port
+        env["PIPELINE2_WS_LOCALFS"] = "true"
+        env["PIPELINE2_WS_AUTHENTICATION"] = "false"
+        env["PIPELINE2_DATA"] = data
+
+        logging.info("Starter lokal instans av Pipeline 2 på: {}".format(local["engine"]["endpoint"]))
+        local["process"] = subprocess.Popen([DaisyPipelineLocalEngines.executable(), "remote"],
+                                            cwd=DaisyPipelineJob.dp2_home,
+                                            env=env,
+                                            stdout=subprocess.DEVNULL,
+                                            stderr=subprocess.DEVNULL,
+                                            start_new_session=True)
+        with DaisyPipelineLocalEngines._condition:
+            local["started"] = time.time()
+            local["jobs"] = 0
+            local["restart"] = False
+            local["state"] = "starting"
+            DaisyPipelineLocalEngines._condition.notify_all()
+
+    @staticmethod
+    def _stop(local):
+        DaisyPipelineLocalEngines._set_state(local, "stopped")
+        process = local["process"]
+        local["process"] = None
+        if process is None:
+            return
+
+        procs = []
+        try:
+            procs = [psutil.Process(process.pid)]
+            procs += procs[0].children(recursive=True)
+        except psutil.NoSuchProcess:
+            pass
+        DaisyPipelineLocalEngines._stop_processes(procs)
+        process.poll()  # avoid leaving a zombie process
+
+    @staticmethod
+    def _stop_processes(procs):
+        for p in procs:
+            try:
+                logging.debug("Stopping: {}".format(p))
+                p.terminate()
+            except psutil.NoSuchProcess:
+                pass
+            except psutil.AccessDenied:
+                logging.debug("Could not kill Pipeline 2 instance (PID: {})".format(p.pid))
+        gone, alive = psutil.wait_procs(procs, timeout=10)
+        if len(alive) > 0:
+            logging.warning("Dreper {} gjenværende Pipeline 2-prosesser som ikke ble terminert".format(len(alive)))
+        for p in alive:
+            logging.debug("Killing: {}".format(p))
+            try:
+                p.kill()
+            except psutil.NoSuchProcess:
+                pass
+            except psutil.AccessDenied:
+                logging.debug("Could not kill Pipeline 2 instance (PID: {})".format(p.pid))
+
+    @staticmethod
+    def _memory(local):
+        """Memory used by the engine (resident set size, in MB)"""
+        try:
+            process = psutil.Process(local["process"].pid)
+            procs = [process] + process.children(recursive=True)
+        except (psutil.NoSuchProcess, AttributeError):
+            return 0
+        memory = 0
+        for p in procs:
+            try:
+                memory += p.memory_info().rss
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                pass
+        return memory // (1024 * 1024)
+
+
+class DaisyPipelineMonitor():
+    """
+    Keeps track of the status of all running Pipeline 2 jobs, from a single thread.
+
+    Instead of each pipeline thread polling its own job, all jobs are polled from one thread
+    using one HTTP connection pool. Jobs are polled often right after they are posted, and then
+    with exponential backoff up to `max_interval` seconds. Each job has a future that is
+    resolved with the final status of the job ("SUCCESS", "ERROR" or "FAIL"), or None if
+    the engine stopped responding.
+    """
+
+    min_interval = 1
+    max_interval = 30
+    engine_timeout = 60  # consider the engine dead if it does not respond for this many seconds
+
+    # treat as class variables
+    _condition = threading.Condition()
+    _queue = []  # heap of (next poll time, sequence number, job)
+    _sequence = itertools.count()
+    _thread = None
+
+    @staticmethod
+    def watch(engine, job_id):
+        """
+        Start keeping track of a job.
+
+        Returns a dict with "status" (the latest known status), "engine_died" and "future".
+        """
+        job = {
+            "engine": engine,
+            "job_id": job_id,
+            "status": "IDLE",
+            "engine_died": False,
+            "future": concurrent.futures.Future(),
+            "interval": DaisyPipelineMonitor.min_interval,
+            "failing_since": None,
+        }
+        with DaisyPipelineMonitor._condition:
+            DaisyPipelineMonitor._schedule(job, time.time() + DaisyPipelineMonitor.min_interval)
+            if DaisyPipelineMonitor._thread is None or not DaisyPipelineMonitor._thread.is_alive():
+                DaisyPipelineMonitor._thread = threading.Thread(target=DaisyPipelineMonitor._run, name="dp2 monitor", daemon=True)
+                DaisyPipelineMonitor._thread.start()
+            DaisyPipelineMonitor._condition.notify_all()
+        return job
+
+    @staticmethod
+    def unwatch(job):
+        """Stop keeping track of a job"""
+        job["future"].cancel()
+
+    @staticmethod
+    def _schedule(job, when):
+        heapq.heappush(DaisyPipelineMonitor._queue, (when, next(DaisyPipelineMonitor._sequence), job))
+
+    @staticmethod
+    def _run():
+        while True:
+            with DaisyPipelineMonitor._condition:
+                while not DaisyPipelineMonitor._queue or DaisyPipelineMonitor._queue[0][0] > time.time():
+                    timeout = DaisyPipelineMonitor._queue[0][0] - time.time() if DaisyPipelineMonitor._queue else None
+                    DaisyPipelineMonitor._condition.wait(timeout=timeout)
+                _, _, job = heapq.heappop(DaisyPipelineMonitor._queue)
+
+            if job["future"].done():
+                continue  # cancelled
+
+            try:
+                DaisyPipelineMonitor._poll(job)
+            except Exception:
+                logging.exception("Failed to get status of Pipeline 2 job {}".format(job["job_id"]))
+
+            if not job["future"].done():
+                with DaisyPipelineMonitor._condition:
+                    DaisyPipelineMonitor._schedule(job, time.time() + job["interval"])
+
+    @staticmethod
+    def _poll(job):
+        status = None
+        try:
+            response = HttpClient.get(DaisyPipelineJob.encode_url(job["engine"], "/jobs/{}".format(job["job_id"]), {}), timeout=30)
+            if response.ok:
+                xml = ElementTree.XML(str(response.content, 'utf-8').split("?>")[-1])
+                status = xml.attrib["status"]
+        except Exception:
+            pass
+
+        if status is None:
+            # avoid failing if there's a single failed status request, but give up if the engine is gone for a while
+            if job["failing_since"] is None:
+                job["failing_since"] = time.time()
+            elif time.time() - job["failing_since"] > DaisyPipelineMonitor.engine_timeout and not DaisyPipelineJob.is_alive(job["engine"]):
+                job["engine_died"] = True
+                DaisyPipelineEngines.invalidate(job["engine"])
+                DaisyPipelineMonitor._resolve(job, None)
+            job["interval"] = DaisyPipelineMonitor.min_interval * 5
+            return
+
+        job["failing_since"] = None
+        if status == "DONE":
+            status = "SUCCESS"
+
+        if status != job["status"]:
+            job["status"] = status
+            job["interval"] = DaisyPipelineMonitor.min_interval
+        else:
+            job["interval"] = min(job["interval"] * 2, DaisyPipelineMonitor.max_interval)
+
+        if status not in ["IDLE", "RUNNING"]:
+            DaisyPipelineMonitor._resolve(job, status)
+
+    @staticmethod
+    def _resolve(job, status):
+        if job["future"].set_running_or_notify_cancel():  # False if the job has been unwatched
+            job["future"].set_result(status)
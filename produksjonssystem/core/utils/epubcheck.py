@@ -1,12 +1,14 @@
 # -*- coding: utf-8 -*-
 
+import json
+import logging
 import os
 import subprocess
 import tempfile
 import traceback
 
-from core.utils.epub import Epub
 from core.utils.filesystem import Filesystem
+from core.utils.jvm_worker import JvmWorker
 
 
 class Epubcheck():
@@ -43,12 +45,11 @@ class Epubcheck():
             cwd = tempfile.gettempdir()
 
         self.success = False
+        self.report = None
+        self.messages = []
 
-        Epubcheck.init_environment()
-
-        # epubcheck works better when the input is zipped
+        # unzipped EPUBs are validated as directories, starting from the root of the EPUB
         if source.lower().endswith(".opf"):
-            pipeline.utils.report.debug("EPUB is not zipped, zipping…")
             root_path = os.path.dirname(source)
             while True:
                 assert root_path != os.path.dirname(root_path), "No mimetype file or META-INF directory found in the EPUB, unable to determine root directory"
@@ -61,17 +62,20 @@ class Epubcheck():
                     break
                 else:
                     root_path = os.path.dirname(root_path)
-
-            epub = Epub(pipeline.utils.report, root_path)
-            source = epub.asFile()
+            source = root_path
 
         try:
-            command = ["java", "-jar", Epubcheck.epubcheck_jar]
-            command.append(source)
-
             pipeline.utils.report.debug("Running Epubcheck")
-            process = Filesystem.run_static(command, cwd, pipeline.utils.report, stdout_level=stdout_level, stderr_level=stderr_level)
-            self.success = process.returncode == 0
+            result = Epubcheck.validate([source], pipeline.utils.report, cwd=cwd)[source]
+            self.success = result["success"]
+            self.report = result["report"]
+            self.messages = result["report"]["messages"] if result["report"] else []
+
+            for message in self.messages:
+                if message.get("severity") in ["FATAL", "ERROR", "WARNING"]:  # same as EpubCheck shows on the command line
+                    pipeline.utils.report.add_message(stdout_level, Epubcheck.format_message(message))
+            pipeline.utils.report.add_message(stdout_level, result["stdout"].strip(), add_empty_line_between=True)
+            pipeline.utils.report.add_message(stderr_level, result["stderr"].strip(), add_empty_line_between=True)
 
         except subprocess.TimeoutExpired:
             pipeline.utils.report.error("Epubcheck for {} took too long and were therefore stopped.".format(os.path.basename(source)))
@@ -79,3 +83,64 @@ class Epubcheck():
         except Exception:
             pipeline.utils.report.debug(traceback.format_exc(), preformatted=True)
             pipeline.utils.report.error("An error occured while running Epubcheck (for " + str(source) + ")")
+
+    @staticmethod
+    def validate(paths, report=None, cwd=None):
+        """
+        Validate one or more EPUBs. Both zipped EPUBs and unzipped EPUBs (directories) are supported.
+
+        Validating many EPUBs in one call is faster, since EpubCheck only has to be started once.
+        Returns a dict: path => {"success": …, "returncode": …, "report": …, "stdout": …, "stderr": …},
+        where "report" is the JSON report from EpubCheck (or None if EpubCheck failed to run).
+        """
+        paths = list(paths)
+        if not cwd:
+            cwd = tempfile.gettempdir()
+
+        Epubcheck.init_environment()
+
+        response = JvmWorker.request([Epubcheck.epubcheck_jar], "epubcheck", {"paths": paths}, timeout=600 * len(paths))
+        if response is not None and "results" in response:
+            results = response["results"]
+        else:
+            if response is not None:
+                (report if report else logging).debug(response["stderr"])
+            # worker not available: run EpubCheck as separate processes
+            results = {path: Epubcheck._run_process(path, report, cwd) for path in paths}
+
+        for path in results:
+            results[path]["success"] = results[path]["returncode"] == 0
+        return results
+
+    @staticmethod
+    def _run_process(path, report, cwd):
+        with tempfile.TemporaryDirectory(prefix="epubcheck-") as temp_dir:
+            report_path = os.path.join(temp_dir, "report.json")
+            command = ["java", "-Xss4096k", "-jar", Epubcheck.epubcheck_jar]
+            if os.path.isdir(path):
+                command.extend(["--mode", "exp"])
+            command.extend([path, "--json", report_path])
+
+            process = Filesystem.run_static(command, cwd, report)
+
+            epubcheck_report = None
+            if os.path.isfile(report_path):
+                with open(report_path, encoding="utf-8") as f:
+                    epubcheck_report = json.load(f)
+
+        return {
+            "returncode": process.returncode,
+            "report": epubcheck_report,
+            "stdout": process.stdout.decode("utf-8"),
+            "stderr": process.stderr.decode("utf-8"),
+        }
+
+    @staticmethod
+    def format_message(message):
+        """Format a message from the JSON report the same way as EpubCheck does on the command line"""
+        locations = message.get("locations") or [{}]
+        location = locations[0]
+        text = "{}({}): ".format(message.get("severity"), message.get("ID"))
+        if location.get("path"):
+            text += "{}({},{}): ".format(location["path"], location.get("line", -1), location.get("column", -1))
+        return text + str(message.get("message"))
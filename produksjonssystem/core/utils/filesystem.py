@@ -4,9 +4,9 @@ import hashlib
 import logging
 import os
 import re
-import requests
 import shutil
 import socket
+import struct
 import subprocess
 import tempfile
 import threading
@@ -15,8 +15,13 @@ import traceback
 import urllib.parse
 import urllib.request
 import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+from core.config import Config
+from core.utils.http_client import HttpClient
+
 
 class Filesystem():
     """Operations on files and directories"""
@@ -25,6 +30,22 @@ class Filesystem():
     last_reported_md5 = None  # avoid reporting change for same book multiple times
     hosts = {}  # hosts cache
 
+    # Checksums (see path_md5). Bump checksum_version when the checksum format changes,
+    # so that checksums stored by older versions are discarded instead of reported as changes.
+    checksum_version = 2
+    checksum_threads = int(os.getenv("CHECKSUM_THREADS", "8"))
+    checksum_chunk_size = 64  # number of files to stat per thread
+    checksum_memo_max_age = 3600  # reuse checksums of unchanged subdirectories for at most this many seconds
+    checksum_memo_max_size = 100000
+    _checksum_memo = {}  # (path, shallow) => checksum of subdirectory, in the order they were updated
+    _checksum_memo_lock = threading.RLock()
+    _checksum_pool = None
+
+    # Change notifications are not delivered for changes made by other hosts on these filesystems,
+    # and file operations are slow enough that it pays off to do them concurrently.
+    network_filesystems = ["nfs", "nfs4", "cifs", "smb3", "smbfs", "ncpfs", "afs", "9p", "davfs", "glusterfs", "ceph", "lustre"]
+    _network_filesystem_cache = {}
+
     shutil_ignore_patterns = shutil.ignore_patterns(  # supports globs: shutil.ignore_patterns('*.pyc', 'tmp*')
         "Thumbs.db", "*.swp", "ehthumbs.db", "ehthumbs_vista.db", "*.stackdump", "Desktop.ini", "desktop.ini",
         "$RECYCLE.BIN", "*~", ".fuse_hidden*", ".directory", ".Trash-*", ".nfs*", ".DS_Store", ".AppleDouble",
@@ -34,6 +55,11 @@ class Filesystem():
         "*.crdownload"
     )
 
+    # files with these extensions are already compressed, and are stored without compression in streamed zip files
+    compressed_extensions = [".jpg", ".jpeg", ".png", ".gif", ".webp", ".mp3", ".mp4", ".m4a", ".ogg", ".opus",
+                             ".zip", ".epub", ".gz", ".pdf", ".docx", ".woff", ".woff2"]
+    stream_chunk_size = 1024 * 1024
+
     def __init__(self, pipeline):
         self.pipeline = pipeline
 
@@ -49,8 +75,24 @@ class Filesystem():
         return bool(Filesystem.shutil_ignore_patterns(os.path.dirname(path), [os.path.basename(path)]))
 
     @staticmethod
-    def path_md5(path, shallow, expect=None):
-        attributes = []
+    def cache_dir():
+        """Directory for caches that should be kept across restarts (config "cache_dir", or the CACHE_DIR environment variable)"""
+        cache_dir = Config.get("cache_dir", None)
+        if not cache_dir:
+            cache_dir = os.getenv("CACHE_DIR", os.path.join(tempfile.gettempdir(), "prodsys-cache"))
+            Config.set("cache_dir", cache_dir)
+        os.makedirs(cache_dir, exist_ok=True)
+        return cache_dir
+
+    @staticmethod
+    def path_md5(path, shallow, expect=None, memoize=False, parallel=None):
+        """
+        Checksum of a file or directory, based on paths, sizes, modification times and modes.
+
+        When `shallow` is True, only the first file in each directory is checked.
+        When `memoize` is True, checksums of unchanged subdirectories (same directory mtime) may be reused.
+        When `parallel` is True (default: only on network filesystems), files are stat'ed concurrently.
+        """
 
         # In addition to the path, we use these stat attributes:
         # st_mode: File mode: file type and file mode bits (permissions).
@@ -58,70 +100,145 @@ class Filesystem():
         #          The size of a symbolic link is the length of the pathname it contains, without a terminating null byte.
         # st_mtime: Time of most recent content modification expressed in seconds.
 
+        md5 = None
         modified = 0
-        if not os.path.exists(path):
-            md5 = "d41d8cd98f00b204e9800998ecf8427e"  # MD5 of an empty string
-
-        else:
-            if os.path.isfile(path) and not Filesystem.should_ignore(path):
+        if os.path.isfile(path):
+            if not Filesystem.should_ignore(path):
                 stat = os.stat(path)
-                st_size = stat.st_size if os.path.isfile(path) else 0
-                st_mtime = round(stat.st_mtime)
-                attributes.extend([path, st_mtime, st_size, stat.st_mode])
+                md5 = hashlib.md5(Filesystem._checksum_line(path, stat)).hexdigest()
                 modified = stat.st_mtime
 
-            if not shallow or not modified:
-                try:
-                    for dirPath, subdirList, fileList in os.walk(path):
-                        fileList.sort()
-                        subdirList.sort()
-                        ignore = Filesystem.shutil_ignore_patterns(dirPath, fileList + subdirList)
-                        for s in reversed(range(len(subdirList))):
-                            if subdirList[s] in ignore:
-                                del subdirList[s]  # remove ignored folders in-place
-                        for f in fileList:
-                            if f in ignore:
-                                continue  # skip ignored files
-                            filePath = os.path.join(dirPath, f)
-                            stat = None
-
-                            # try handling FileNotFoundError: [Errno 2] No such file or directory
-                            stat_retries = 3
-                            while stat_retries > 0:
-                                try:
-                                    stat_retries -= 1
-                                    stat = os.stat(filePath)
-                                except FileNotFoundError as e:
-                                    if stat_retries >= 0:
-                                        logging.warning("Filen eller mappen ble ikke funnet ({}). Prøver igjen…".format(f))
-                                        # time.sleep(1)
-                                    else:
-                                        raise e
-
-                            if stat is not None:
-                                attributes.extend([filePath, round(stat.st_mtime), stat.st_size, stat.st_mode])
-                            else:
-                                attributes.extend([filePath, 0, 0, 0])
-                            modified = max(modified, stat.st_mtime if stat is not None else 0)
-                            if shallow:
-                                break
-                except FileNotFoundError as e:
-                    logging.exception("Filen eller mappen ble ikke funnet. Kanskje noen slettet den?")
-                    raise e
+        elif os.path.isdir(path):
+            if parallel is None:
+                parallel = Filesystem.is_network_filesystem(os.path.dirname(os.path.normpath(path)))
+            try:
+                md5, modified = Filesystem._dir_md5(path, shallow, memoize, parallel, is_subdir=False)
+            except FileNotFoundError as e:
+                logging.exception("Filen eller mappen ble ikke funnet. Kanskje noen slettet den?")
+                raise e
 
-            if attributes:
-                md5 = hashlib.md5(str(attributes).encode()).hexdigest()
-            else:
-                md5 = "d41d8cd98f00b204e9800998ecf8427e"  # MD5 of an empty string
+        if md5 is None:
+            md5 = "d41d8cd98f00b204e9800998ecf8427e"  # MD5 of an empty string
 
         if expect and expect != md5 and md5 != Filesystem.last_reported_md5:
             Filesystem.last_reported_md5 = md5
-            text = "MD5 changed for " + str(path) + " (was: {}, is: {}): ".format(expect, md5)
-            logging.info(text + str(attributes)[:1000] + ("…" if len(str(attributes)) > 1000 else ""))
-            logging.debug(text + str(attributes))
+            logging.info("MD5 changed for " + str(path) + " (was: {}, is: {})".format(expect, md5))
 
         return md5, modified
 
+    @staticmethod
+    def _checksum_line(path, stat):
+        if stat is None:
+            return "{}\0{}\0{}\0{}\n".format(path, 0, 0, 0).encode("utf-8", "surrogateescape")
+        return "{}\0{}\0{}\0{}\n".format(path, round(stat.st_mtime), stat.st_size, stat.st_mode).encode("utf-8", "surrogateescape")
+
+    @staticmethod
+    def _stat_entries(entries):
+        stats = []
+        for entry in entries:
+            stat = None
+
+            # try handling FileNotFoundError: [Errno 2] No such file or directory
+            stat_retries = 3
+            while stat is None and stat_retries > 0:
+                stat_retries -= 1
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    logging.warning("Filen eller mappen ble ikke funnet ({}). Prøver igjen…".format(entry.name))
+
+            stats.append(stat)
+        return stats
+
+    @staticmethod
+    def _dir_md5(path, shallow, memoize, parallel, is_subdir):
+        """Checksum of a directory tree. Returns (None, 0) if the tree contains no files."""
+        dir_stat = None
+        if memoize and is_subdir:
+            dir_stat = os.stat(path)
+            with Filesystem._checksum_memo_lock:
+                memo = Filesystem._checksum_memo.get((path, shallow))
+            if (memo is not None
+                    and memo["mtime"] == dir_stat.st_mtime_ns
+                    and memo["ino"] == dir_stat.st_ino
+                    and time.time() - memo["time"] < Filesystem.checksum_memo_max_age):
+                return memo["md5"], memo["modified"]
+
+        try:
+            with os.scandir(path) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except (FileNotFoundError, NotADirectoryError):
+            return None, 0  # deleted while we were iterating
+
+        ignore = Filesystem.shutil_ignore_patterns(path, [entry.name for entry in entries])
+        files = []
+        subdirs = []
+        for entry in entries:
+            if entry.name in ignore:
+                continue  # skip ignored files and folders
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if not is_dir:
+                files.append(entry)
+            elif not entry.is_symlink():
+                subdirs.append(entry)
+
+        if shallow:
+            files = files[:1]
+
+        if parallel and len(files) > Filesystem.checksum_chunk_size:
+            chunks = [files[i:i + Filesystem.checksum_chunk_size] for i in range(0, len(files), Filesystem.checksum_chunk_size)]
+            stats = [stat for chunk in Filesystem._checksum_executor().map(Filesystem._stat_entries, chunks) for stat in chunk]
+        else:
+            stats = Filesystem._stat_entries(files)
+
+        hasher = None
+        modified = 0
+        for entry, stat in zip(files, stats):
+            if hasher is None:
+                hasher = hashlib.md5()
+            hasher.update(Filesystem._checksum_line(entry.path, stat))
+            modified = max(modified, stat.st_mtime if stat is not None else 0)
+
+        for entry in subdirs:
+            subdir_md5, subdir_modified = Filesystem._dir_md5(entry.path, shallow, memoize, parallel, is_subdir=True)
+            if subdir_md5 is None:
+                continue  # directories without files does not affect the checksum
+            if hasher is None:
+                hasher = hashlib.md5()
+            hasher.update("{}/\0{}\n".format(entry.path, subdir_md5).encode("utf-8", "surrogateescape"))
+            modified = max(modified, subdir_modified)
+
+        md5 = hasher.hexdigest() if hasher is not None else None
+
+        if memoize and is_subdir:
+            with Filesystem._checksum_memo_lock:
+                if len(Filesystem._checksum_memo) > Filesystem.checksum_memo_max_size:
+                    for key in [key for key in Filesystem._checksum_memo
+                                if time.time() - Filesystem._checksum_memo[key]["time"] > Filesystem.checksum_memo_max_age]:
+                        del Filesystem._checksum_memo[key]
+                Filesystem._checksum_memo.pop((path, shallow), None)
+                Filesystem._checksum_memo[(path, shallow)] = {
+                    "mtime": dir_stat.st_mtime_ns,
+                    "ino": dir_stat.st_ino,
+                    "time": time.time(),
+                    "md5": md5,
+                    "modified": modified,
+                }
+                while len(Filesystem._checksum_memo) > Filesystem.checksum_memo_max_size:
+                    del Filesystem._checksum_memo[next(iter(Filesystem._checksum_memo))]  # remove the least recently updated subdirectory
+
+        return md5, modified
+
+    @staticmethod
+    def _checksum_executor():
+        with Filesystem._checksum_memo_lock:
+            if Filesystem._checksum_pool is None:
+                Filesystem._checksum_pool = ThreadPoolExecutor(max_workers=Filesystem.checksum_threads, thread_name_prefix="checksum")
+            return Filesystem._checksum_pool
+
     @staticmethod
     def touch(path):
         """ Touch a file, or the first file in a directory """
@@ -380,7 +497,7 @@ class Filesystem():
         elif format == "daisy202-ncc":
             latest_url = "https://raw.githubusercontent.com/nlbdev/nlb-scss/master/dist/css/ncc.min.css"
 
-        response = requests.get(latest_url)
+        response = HttpClient.get(latest_url)
         if response.status_code == 200:
             with open(path, "wb") as target_file:
                 target_file.write(response.content)
@@ -474,6 +591,150 @@ class Filesystem():
 
             Filesystem.fix_permissions(target)
 
+    @staticmethod
+    def zip_stream(report, files):
+        """
+        Zip `files` (a dict: path in archive => path on disk) while the zip file is being read.
+
+        Yields the zip file as chunks of bytes, so that it can be sent without storing it on disk first.
+        """
+        buffer = _WriteBuffer()
+        with zipfile.ZipFile(buffer, 'w') as archive:
+            for href in files:
+                file = str(files[href])
+                report.debug("zipping: " + href + " from " + file)
+                info = zipfile.ZipInfo.from_file(file, href)
+                if os.path.splitext(file)[1].lower() in Filesystem.compressed_extensions:
+                    info.compress_type = zipfile.ZIP_STORED
+                else:
+                    info.compress_type = zipfile.ZIP_DEFLATED
+                with open(file, 'rb') as source, archive.open(info, 'w', force_zip64=info.file_size > zipfile.ZIP64_LIMIT) as target:
+                    while True:
+                        data = source.read(Filesystem.stream_chunk_size)
+                        if not data:
+                            break
+                        target.write(data)
+                        if buffer.size >= Filesystem.stream_chunk_size:
+                            yield buffer.take()
+        yield buffer.take()  # the central directory is written when the archive is closed
+
+    @staticmethod
+    def unzip_stream(report, stream, target):
+        """
+        Unzip a zip file while it is being read from `stream` (a file-like object, for instance a HTTP response).
+
+        Files are extracted as they are read, using the local file headers, so that the zip file does not
+        have to be stored on disk first. Raises a ValueError if the zip file can not be extracted this way
+        (for instance encrypted files, or stored files with unknown size); in that case, use `unzip` instead.
+        Returns the number of extracted files.
+        """
+        assert target, "unzip_stream: target must be specified: "+str(target)
+        assert os.path.isdir(target) or not os.path.exists(target), "unzip_stream: if target exists, it must be a directory: "+target
+
+        os.makedirs(target, exist_ok=True)
+        target_real = os.path.realpath(target)
+        reader = _ReadBuffer(stream)
+        count = 0
+
+        while True:
+            signature = reader.read_exactly(4, allow_eof=True)
+            if not signature:
+                break  # empty zip file
+            if signature != b"PK\x03\x04":
+                if signature in [b"PK\x01\x02", b"PK\x05\x06", b"PK\x06\x06"] or count > 0:
+                    break  # reached the central directory: all files are extracted
+                raise ValueError("unzip_stream: not a zip file")
+
+            (version, flags, method, mtime, mdate, crc,
+             compressed_size, size, name_length, extra_length) = struct.unpack("<HHHHHIIIHH", reader.read_exactly(26))
+            name = reader.read_exactly(name_length).decode("utf-8" if flags & 0x800 else "cp437")
+            extra = reader.read_exactly(extra_length)
+
+            zip64 = False
+            while len(extra) >= 4:
+                extra_id, extra_size = struct.unpack("<HH", extra[:4])
+                if extra_id == 0x0001:  # zip64 extended information
+                    zip64 = True
+                    values = extra[4:4 + extra_size]
+                    if size == 0xFFFFFFFF and len(values) >= 8:
+                        size, values = struct.unpack("<Q", values[:8])[0], values[8:]
+                    if compressed_size == 0xFFFFFFFF and len(values) >= 8:
+                        compressed_size = struct.unpack("<Q", values[:8])[0]
+                extra = extra[4 + extra_size:]
+
+            if flags & 0x1:
+                raise ValueError("unzip_stream: encrypted files are not supported: " + name)
+            if method not in [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED]:
+                raise ValueError("unzip_stream: unsupported compression method ({}): {}".format(method, name))
+            if method == zipfile.ZIP_STORED and flags & 0x8 and compressed_size == 0:
+                raise ValueError("unzip_stream: stored file with unknown size: " + name)
+
+            path = os.path.realpath(os.path.join(target_real, name))
+            if path != target_real and not path.startswith(target_real + os.sep):
+                raise ValueError("unzip_stream: file outside of the target directory: " + name)
+
+            if name.endswith("/"):
+                os.makedirs(path, exist_ok=True)
+                output = None
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                output = open(path, 'wb')
+
+            actual_crc = 0
+            actual_size = 0
+            actual_compressed_size = 0
+            try:
+                if method == zipfile.ZIP_DEFLATED:
+                    decompressor = zlib.decompressobj(-15)
+                    while not decompressor.eof:
+                        data = reader.read(Filesystem.stream_chunk_size)
+                        if not data:
+                            raise EOFError("unzip_stream: unexpected end of zip file: " + name)
+                        actual_compressed_size += len(data)
+                        data = decompressor.decompress(data)
+                        actual_crc = zlib.crc32(data, actual_crc)
+                        actual_size += len(data)
+                        if output:
+                            output.write(data)
+                    reader.unread(decompressor.unused_data)
+                    actual_compressed_size -= len(decompressor.unused_data)
+
+                else:
+                    remaining = compressed_size
+                    while remaining > 0:
+                        data = reader.read(min(remaining, Filesystem.stream_chunk_size))
+                        if not data:
+                            raise EOFError("unzip_stream: unexpected end of zip file: " + name)
+                        remaining -= len(data)
+                        actual_crc = zlib.crc32(data, actual_crc)
+                        actual_size += len(data)
+                        if output:
+                            output.write(data)
+                    actual_compressed_size = compressed_size
+
+            finally:
+                if output:
+                    output.close()
+
+            if flags & 0x8:
+                # data descriptor: the CRC and sizes are stored after the file data
+                descriptor = reader.read_exactly(4)
+                if descriptor == b"PK\x07\x08":
+                    descriptor = reader.read_exactly(4)
+                crc = struct.unpack("<I", descriptor)[0]
+                if zip64 or actual_size >= 0xFFFFFFFF or actual_compressed_size >= 0xFFFFFFFF:
+                    reader.read_exactly(16)
+                else:
+                    reader.read_exactly(8)
+
+            if crc != actual_crc:
+                raise ValueError("unzip_stream: CRC does not match: " + name)
+
+            count += 1
+
+        Filesystem.fix_permissions(target)
+        return count
+
     @staticmethod
     def ismount(path):
         return True if Filesystem.getdevice(path) else False
@@ -505,6 +766,34 @@ class Filesystem():
 
         return None
 
+    @staticmethod
+    def getfstype(path):
+        """Filesystem type (for instance "ext4", "nfs" or "cifs") of the mount containing `path`"""
+        path = os.path.realpath(path)
+
+        fstype = None
+        mount_point = ""
+        with open('/proc/mounts', 'r') as f:
+            for line in f.readlines():
+                line = line.split()
+                if len(line) < 3:
+                    continue
+                # line[1] = "/mount/point", line[2] = filesystem type
+                mount = line[1].replace("\\040", " ")
+                if (path == mount or path.startswith(mount.rstrip("/") + "/")) and len(mount) >= len(mount_point):
+                    mount_point = mount
+                    fstype = line[2]
+
+        return fstype
+
+    @staticmethod
+    def is_network_filesystem(path):
+        if path not in Filesystem._network_filesystem_cache:
+            fstype = Filesystem.getfstype(path)
+            Filesystem._network_filesystem_cache[path] = fstype is not None and (fstype in Filesystem.network_filesystems
+                                                                                 or fstype.startswith("fuse"))
+        return Filesystem._network_filesystem_cache[path]
+
     @staticmethod
     def networkpath(path):
         path = os.path.normpath(path)
@@ -605,6 +894,13 @@ class Filesystem():
             logging.debug("Filesystem.list_book_dir: '{}' in filtered == {}".format("558282402019", "558282402019" in filtered))
         return filtered
 
+    @staticmethod
+    def is_book_name(dir, name):
+        """Whether `name` would be included when listing `dir` with `list_book_dir`"""
+        if len(name) == 0 or (name[0] not in "0123456789" and not name.startswith("TEST")):
+            return False
+        return not Filesystem.should_ignore(os.path.join(dir, name))
+
     @staticmethod
     def book_path_in_dir(dir, identifiers, subdirs=None):
         # check "pipeline parent directories" (i.e. subdirectories)
@@ -622,3 +918,53 @@ class Filesystem():
 
         # not found
         return None
+
+
+class _WriteBuffer():
+    """Unseekable file-like object that keeps what's written to it until it's taken"""
+
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        return data
+
+
+class _ReadBuffer():
+    """Wraps a file-like object so that data can be put back after it's read"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.buffer = b""
+
+    def read(self, size):
+        if self.buffer:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+            return data
+        return self.stream.read(size)
+
+    def unread(self, data):
+        self.buffer = data + self.buffer
+
+    def read_exactly(self, size, allow_eof=False):
+        data = b""
+        while len(data) < size:
+            chunk = self.read(size - len(data))
+            if not chunk:
+                if allow_eof and not data:
+                    return data
+                raise EOFError("unexpected end of zip file")
+            data += chunk
+        return data
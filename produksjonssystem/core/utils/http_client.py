@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+
+import concurrent.futures
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import urllib.parse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class HttpClient():
+    """
+    Shared HTTP client, used for all requests to the NLB API, the STEM service and Pipeline 2.
+
+    Connections are kept alive and reused (one connection pool per host), requests time out
+    after `timeout` seconds unless another timeout is given, and idempotent requests are retried
+    on connection errors and 502/503/504 responses. Latency and error rate is recorded per host.
+    """
+
+    timeout = float(os.getenv("HTTP_TIMEOUT", "60"))
+    retries = int(os.getenv("HTTP_RETRIES", "3"))
+    pool_size = int(os.getenv("HTTP_POOL_SIZE", "20"))  # max number of connections kept alive per host
+    hosts = 50  # max number of hosts to keep connection pools for
+
+    # treat as class variables
+    _lock = threading.RLock()
+    _session = None
+    _metrics = {}  # host => {"requests", "errors", "latency", "max_latency"}
+
+    @staticmethod
+    def session():
+        with HttpClient._lock:
+            if HttpClient._session is None:
+                retry = Retry(total=HttpClient.retries,
+                              backoff_factor=0.5,
+                              status_forcelist=[502, 503, 504],
+                              raise_on_status=False)
+                adapter = HTTPAdapter(pool_connections=HttpClient.hosts, pool_maxsize=HttpClient.pool_size, max_retries=retry)
+                session = requests.Session()
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                HttpClient._session = session
+            return HttpClient._session
+
+    @staticmethod
+    def request(method, url, **kwargs):
+        """Same as `requests.request`, but using the shared connection pools"""
+        kwargs.setdefault("timeout", HttpClient.timeout)
+        host = urllib.parse.urlparse(url).netloc
+
+        start = time.time()
+        try:
+            response = HttpClient.session().request(method, url, **kwargs)
+        except Exception:
+            HttpClient._record(host, time.time() - start, True)
+            raise
+        HttpClient._record(host, time.time() - start, response.status_code >= 500)
+        return response
+
+    @staticmethod
+    def get(url, **kwargs):
+        return HttpClient.request("GET", url, **kwargs)
+
+    @staticmethod
+    def post(url, **kwargs):
+        return HttpClient.request("POST", url, **kwargs)
+
+    @staticmethod
+    def delete(url, **kwargs):
+        return HttpClient.request("DELETE", url, **kwargs)
+
+    @staticmethod
+    def _record(host, latency, error):
+        with HttpClient._lock:
+            if host not in HttpClient._metrics:
+                HttpClient._metrics[host] = {"requests": 0, "errors": 0, "latency": 0.0, "max_latency": 0.0}
+            metrics = HttpClient._metrics[host]
+            metrics["requests"] += 1
+            metrics["errors"] += 1 if error else 0
+            metrics["latency"] += latency
+            metrics["max_latency"] = max(metrics["max_latency"], latency)
+        if error:
+            logging.debug("HTTP request to {} failed after {:.1f} seconds".format(host, latency))
+
+    @staticmethod
+    def metrics():
+        """Number of requests, error rate and latency (in seconds) per host"""
+        with HttpClient._lock:
+            return {
+                host: {
+                    "requests": metrics["requests"],
+                    "errors": metrics["errors"],
+                    "error_rate": metrics["errors"] / metrics["requests"],
+                    "average_latency": metrics["latency"] / metrics["requests"],
+                    "max_latency": metrics["max_latency"],
+                } for host, metrics in HttpClient._metrics.items()
+            }
+
+
+class ResponseCache():
+    """
+    Cache of responses for GET requests, with a time to live for each response and a max number of responses.
+
+    Lookups of cached responses do not take any locks. When several threads request the same URL at the same
+    time, only one request is made, and the other threads wait for that response. Responses can optionally be
+    stored on disk (in the cache directory), so that they survive a restart.
+    """
+
+    # treat as class variables
+    caches = {}  # name => cache (for metrics)
+
+    def __init__(self, name, max_size=1000, persistent=False):
+        self.name = name
+        self.max_size = max_size
+        self.persistent = persistent
+        self._entries = {}  # url => {"expires": …, "last_used": …, "response": …}
+        self._inflight = {}  # url => future for the response that is being requested
+        self._lock = threading.RLock()
+        self._connection = None
+        self._metrics = {"hits": 0, "misses": 0, "shared": 0, "evictions": 0}
+        ResponseCache.caches[name] = self
+
+    def get(self, url, ttl=30):
+        """GET `url`, or return the cached response if it is not older than `ttl` seconds"""
+        entry = self._entries.get(url)
+        if entry is not None and entry["expires"] > time.time():
+            entry["last_used"] = time.time()
+            self._metrics["hits"] += 1
+            return entry["response"]
+
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is not None and entry["expires"] > time.time():
+                entry["last_used"] = time.time()
+                self._metrics["hits"] += 1
+                return entry["response"]
+
+            future = self._inflight.get(url)
+            owner = future is None
+            if owner:
+                future = concurrent.futures.Future()
+                self._inflight[url] = future
+                self._metrics["misses"] += 1
+            else:
+                self._metrics["shared"] += 1
+
+        if not owner:
+            # someone else is already requesting the URL: wait for their response
+            return future.result()
+
+        try:
+            response, expires = self._load(url) if self.persistent else (None, None)
+            if response is None:
+                logging.debug("Updating cache for: {}".format(url))
+                response = HttpClient.get(url)
+                expires = time.time() + ttl
+                self._store(url, response, expires)
+            self._put(url, response, expires)
+            future.set_result(response)
+            return response
+
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+
+        finally:
+            with self._lock:
+                del self._inflight[url]
+
+    def _put(self, url, response, expires):
+        with self._lock:
+            self._entries[url] = {"expires": expires, "last_used": time.time(), "response": response}
+
+            if len(self._entries) > self.max_size:
+                # remove expired responses, and then the least recently used responses (10 % at a time, so that this doesn't happen too often)
+                now = time.time()
+                entries = sorted(self._entries.items(), key=lambda item: (item[1]["expires"] > now, item[1]["last_used"]))
+                remove = max(len(self._entries) - self.max_size, self.max_size // 10)
+                for cached_url, _ in entries[:remove]:
+                    del self._entries[cached_url]
+                self._metrics["evictions"] += remove
+
+    def metrics(self):
+        with self._lock:
+            metrics = dict(self._metrics)
+            metrics["size"] = len(self._entries)
+            requests = metrics["hits"] + metrics["misses"] + metrics["shared"]
+            metrics["hit_rate"] = (metrics["hits"] + metrics["shared"]) / requests if requests else 0
+            return metrics
+
+    def _database(self):
+        if self._connection is None:
+            from core.utils.filesystem import Filesystem  # imported here, as Filesystem uses HttpClient
+
+            cache_dir = Filesystem.cache_dir()
+            os.makedirs(os.path.join(cache_dir, "http"), exist_ok=True)
+
+            connection = sqlite3.connect(os.path.join(cache_dir, "http", "{}.sqlite".format(self.name)), timeout=30, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS responses ("
+                               "url TEXT PRIMARY KEY, expires REAL, status_code INTEGER, reason TEXT, headers TEXT, encoding TEXT, content BLOB)")
+            connection.commit()
+            self._connection = connection
+        return self._connection
+
+    def _load(self, url):
+        """Get a response from disk and when it expires, or (None, None) if it's not stored or is expired"""
+        try:
+            with self._lock:
+                row = self._database().execute("SELECT expires, status_code, reason, headers, encoding, content FROM responses WHERE url = ? AND expires > ?",
+                                               [url, time.time()]).fetchone()
+        except sqlite3.Error:
+            logging.exception("Could not read from the HTTP cache: {}".format(self.name))
+            return None, None
+        if row is None:
+            return None, None
+
+        response = requests.models.Response()
+        response.url = url
+        response.status_code = row[1]
+        response.reason = row[2]
+        response.headers = requests.structures.CaseInsensitiveDict(json.loads(row[3]))
+        response.encoding = row[4]
+        response._content = row[5]
+        return response, row[0]
+
+    def _store(self, url, response, expires):
+        """Store a response on disk"""
+        if not self.persistent:
+            return
+        try:
+            with self._lock:
+                connection = self._database()
+                with connection:
+                    connection.execute("INSERT OR REPLACE INTO responses (url, expires, status_code, reason, headers, encoding, content) "
+                                       "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                       [url, expires, response.status_code, response.reason, json.dumps(dict(response.headers)),
+                                        response.encoding, response.content])
+                    connection.execute("DELETE FROM responses WHERE expires < ?", [time.time()])
+        except sqlite3.Error:
+            logging.exception("Could not write to the HTTP cache: {}".format(self.name))
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+
+from core.utils.filesystem import Filesystem
+
+
+class Inotify():
+    """Watch a directory tree for changes using the Linux inotify API"""
+
+    # from <sys/inotify.h>
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_UNMOUNT = 0x00002000
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+
+    watch_mask = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+                  | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+    event_header = struct.Struct("iIII")  # wd, mask, cookie, len
+
+    # treat as class variables
+    _libc = None
+
+    @staticmethod
+    def libc():
+        if Inotify._libc is None:
+            Inotify._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        return Inotify._libc
+
+    @staticmethod
+    def is_supported(path):
+        """Whether change notifications can be trusted for `path`"""
+        try:
+            if not hasattr(Inotify.libc(), "inotify_init1"):
+                return False
+        except OSError:
+            return False
+
+        if Filesystem.getfstype(path) is None:
+            return False
+        if Filesystem.is_network_filesystem(path):
+            logging.debug("{} is on a network filesystem, change notifications are not available".format(path))
+            return False
+
+        return True
+
+    def __init__(self, path):
+        self.path = os.path.normpath(path)
+        self.root_removed = False
+        self._watches = {}  # watch descriptor => path relative to self.path
+
+        self._fd = Inotify.libc().inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed: " + os.strerror(ctypes.get_errno()))
+
+        try:
+            self._add_watch_recursive(self.path)
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        if self._fd is not None and self._fd >= 0:
+            os.close(self._fd)
+        self._fd = None
+        self._watches = {}
+
+    def _add_watch(self, path):
+        wd = Inotify.libc().inotify_add_watch(self._fd, os.fsencode(path), Inotify.watch_mask)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error in [2, 20]:  # ENOENT, ENOTDIR: deleted before we got to it
+                return
+            # most likely ENOSPC, which means that fs.inotify.max_user_watches is too low
+            raise OSError(error, "Could not watch {}: {}".format(path, os.strerror(error)))
+        self._watches[wd] = os.path.relpath(path, self.path) if path != self.path else ""
+
+    def _remove_watches(self, relpath):
+        """Stop watching a subdirectory and everything below it, for instance because it was moved"""
+        for wd in [wd for wd in self._watches if self._watches[wd] == relpath or self._watches[wd].startswith(relpath + os.path.sep)]:
+            Inotify.libc().inotify_rm_watch(self._fd, wd)
+            del self._watches[wd]
+
+    def _add_watch_recursive(self, path):
+        self._add_watch(path)
+        for dirPath, subdirList, fileList in os.walk(path):
+            ignore = Filesystem.shutil_ignore_patterns(dirPath, subdirList)
+            for s in reversed(range(len(subdirList))):
+                if subdirList[s] in ignore:
+                    del subdirList[s]  # remove ignored folders in-place
+            for subdir in subdirList:
+                self._add_watch(os.path.join(dirPath, subdir))
+
+    def read_events(self, timeout=1):
+        """
+        Wait up to `timeout` seconds for changes.
+
+        Returns the set of top-level names (i.e. books) that have changed, or
+        None if events were lost and the whole directory must be rescanned.
+        """
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return set()
+
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return set()
+
+        names = set()
+        rescan = False
+        offset = 0
+        while offset + Inotify.event_header.size <= len(data):
+            wd, mask, cookie, length = Inotify.event_header.unpack_from(data, offset)
+            offset += Inotify.event_header.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+
+            if mask & Inotify.IN_Q_OVERFLOW:
+                rescan = True
+                continue
+
+            if mask & Inotify.IN_IGNORED:
+                self._watches.pop(wd, None)
+                continue
+
+            relpath = self._watches.get(wd)
+            if relpath is None:
+                continue
+
+            if relpath == "" and mask & (Inotify.IN_DELETE_SELF | Inotify.IN_MOVE_SELF | Inotify.IN_UNMOUNT):
+                self.root_removed = True  # the watched directory itself is gone
+                rescan = True
+                continue
+
+            relpath = os.path.join(relpath, name) if name else relpath
+            if not relpath:
+                continue
+
+            if mask & Inotify.IN_ISDIR and mask & Inotify.IN_MOVED_FROM:
+                # the watches follow the directory, so they would keep reporting changes using the old name
+                self._remove_watches(relpath)
+
+            if mask & Inotify.IN_ISDIR and mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO):
+                self._add_watch_recursive(os.path.join(self.path, relpath))
+
+            names.add(relpath.split(os.path.sep)[0])
+
+        return None if rescan else names
@@ -0,0 +1,483 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import os
+import select
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import urllib.parse
+from collections import OrderedDict
+
+
+class JvmWorker():
+    """
+    Long-lived worker processes running a Java virtual machine.
+
+    Starting a JVM takes a few seconds, so instead of running `java -jar …`
+    for every operation, requests are sent to a worker process that keeps
+    the JVM (and things like compiled stylesheets) in memory. The worker
+    process runs this file, and uses JPype to call into the JVM.
+
+    Requests and responses are single lines of JSON on stdin and stdout of the worker.
+    If a worker is not available, request() returns None, and the caller
+    should fall back to running the Java tool as a separate process.
+    """
+
+    # treat as class variables
+    enabled = os.getenv("JVM_WORKERS", "true").lower() in ["true", "1"]
+    max_workers = int(os.getenv("JVM_WORKER_COUNT", "2"))  # per classpath
+    max_requests = 1000  # restart workers regularly, in case of memory leaks
+    startup_timeout = 120
+    command = [sys.executable, os.path.realpath(__file__)]  # starts a worker process, the classpath is given as arguments
+    _pools = {}  # classpath => list of workers
+    _pools_condition = threading.Condition()
+    _unavailable_since = {}  # classpath => time when the worker could not be started
+
+    def __init__(self, classpath):
+        self.classpath = classpath
+        self.requests = 0
+        self.busy = False
+        self._buffer = b""
+        self.process = subprocess.Popen(JvmWorker.command + list(classpath),
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        cwd=os.path.dirname(os.path.realpath(__file__)))
+        ready = self._read_response(time.time() + JvmWorker.startup_timeout)
+        if not ready or not ready.get("ready"):
+            self.close()
+            raise Exception("JVM worker did not start: {}".format(ready.get("error") if ready else "no response"))
+
+    @staticmethod
+    def is_available():
+        if not JvmWorker.enabled:
+            return False
+        try:
+            import jpype  # noqa
+            return True
+        except ImportError:
+            return False
+
+    @staticmethod
+    def request(classpath, command, arguments, timeout=600):
+        """
+        Send a request to a worker with the given classpath.
+
+        Returns a dict with (at least) "returncode", "stdout" and "stderr",
+        or None if a worker is not available.
+        Raises subprocess.TimeoutExpired if the request takes longer than `timeout` seconds.
+        """
+        classpath = tuple(classpath)
+        worker = JvmWorker._acquire(classpath)
+        if worker is None:
+            return None
+
+        try:
+            response = worker._request(command, arguments, timeout)
+        except subprocess.TimeoutExpired:
+            worker.close()
+            raise
+        except Exception:
+            logging.exception("JVM worker failed")
+            worker.close()
+            response = None
+        finally:
+            JvmWorker._release(worker)
+
+        return response
+
+    @staticmethod
+    def stop_all():
+        with JvmWorker._pools_condition:
+            for classpath in JvmWorker._pools:
+                for worker in JvmWorker._pools[classpath]:
+                    worker.close()
+            JvmWorker._pools = {}
+
+    @staticmethod
+    def _acquire(classpath):
+        if not JvmWorker.is_available():
+            return None
+
+        with JvmWorker._pools_condition:
+            # don't keep trying to start workers that fail to start
+            if time.time() - JvmWorker._unavailable_since.get(classpath, 0) < 600:
+                return None
+
+            pool = JvmWorker._pools.setdefault(classpath, [])
+            while True:
+                for worker in list(pool):
+                    if not worker.is_alive() or worker.requests >= JvmWorker.max_requests and not worker.busy:
+                        worker.close()
+                        pool.remove(worker)
+                for worker in pool:
+                    if not worker.busy:
+                        worker.busy = True
+                        return worker
+                if len(pool) < JvmWorker.max_workers:
+                    break
+                JvmWorker._pools_condition.wait(timeout=10)
+
+            # reserve a spot in the pool while the worker is starting
+            placeholder = _StartingWorker()
+            pool.append(placeholder)
+
+        worker = None
+        try:
+            worker = JvmWorker(classpath)
+            worker.busy = True
+        except Exception:
+            logging.exception("Could not start JVM worker, running Java as separate processes instead")
+            JvmWorker._unavailable_since[classpath] = time.time()
+
+        with JvmWorker._pools_condition:
+            pool.remove(placeholder)
+            if worker:
+                pool.append(worker)
+            JvmWorker._pools_condition.notify_all()
+        return worker
+
+    @staticmethod
+    def _release(worker):
+        with JvmWorker._pools_condition:
+            worker.busy = False
+            JvmWorker._pools_condition.notify_all()
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def close(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        if self.process is not None:
+            self.process.stdin.close()
+            self.process.stdout.close()
+        self.process = None
+
+    def _request(self, command, arguments, timeout):
+        self.requests += 1
+        self.process.stdin.write((json.dumps({"command": command, "arguments": arguments}) + "\n").encode("utf-8"))
+        self.process.stdin.flush()
+        response = self._read_response(time.time() + timeout)
+        if response is None:
+            raise subprocess.TimeoutExpired(command, timeout)
+        return response
+
+    def _read_response(self, deadline):
+        """Read one line from the worker. Returns None on timeout."""
+        while b"\n" not in self._buffer:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            readable, _, _ = select.select([self.process.stdout], [], [], remaining)
+            if not readable:
+                return None
+            data = os.read(self.process.stdout.fileno(), 64 * 1024)
+            if not data:
+                raise EOFError("JVM worker stopped unexpectedly")
+            self._buffer += data
+        line, self._buffer = self._buffer.split(b"\n", 1)
+        return json.loads(line.decode("utf-8"))
+
+
+class _StartingWorker():
+    """Placeholder for a worker that is starting"""
+    busy = True
+    requests = 0
+
+    def is_alive(self):
+        return True
+
+    def close(self):
+        pass
+
+
+# ---- everything below runs in the worker process ----
+
+class Handlers():
+    """Request handlers. Runs inside the worker process, where the JVM is available through JPype."""
+
+    commands = ["xslt", "jing", "epubcheck"]
+
+    max_cached_stylesheets = 100
+    _stylesheets = OrderedDict()  # stylesheet hash => compiled stylesheet
+    _processor = None
+
+    max_cached_schemas = 20
+    _schemas = OrderedDict()  # (path, mtime) => {"driver": …, "results": […]}
+
+    @staticmethod
+    def _compile(compiler, stylesheet, compiled_stylesheet):
+        """
+        Compile a stylesheet, or load it from `compiled_stylesheet` if it has been compiled before.
+
+        Exporting compiled stylesheets (SEF files) requires Saxon-EE. With other editions,
+        the stylesheet is compiled in memory only.
+        """
+        from jpype import JClass, JException
+
+        File = JClass("java.io.File")
+        StreamSource = JClass("javax.xml.transform.stream.StreamSource")
+
+        if compiled_stylesheet and os.path.isfile(compiled_stylesheet):
+            try:
+                return compiler.loadExecutablePackage(File(compiled_stylesheet).toURI())
+            except (JException, AttributeError):
+                pass  # not supported by this version of Saxon, or the file is invalid
+
+        if compiled_stylesheet and hasattr(compiler, "compilePackage") and str(Handlers._processor.getSaxonEdition()) == "EE":
+            try:
+                package = compiler.compilePackage(StreamSource(File(stylesheet)))
+                os.makedirs(os.path.dirname(compiled_stylesheet), exist_ok=True)
+                temp = "{}.{}.tmp".format(compiled_stylesheet, os.getpid())
+                package.save(File(temp))
+                os.replace(temp, compiled_stylesheet)
+                return package.link()
+            except JException:
+                pass
+
+        return compiler.compile(StreamSource(File(stylesheet)))
+
+    @staticmethod
+    def xslt(arguments):
+        from jpype import JClass, JImplements, JOverride, JException
+
+        File = JClass("java.io.File")
+        StringReader = JClass("java.io.StringReader")
+        StringWriter = JClass("java.io.StringWriter")
+        StreamSource = JClass("javax.xml.transform.stream.StreamSource")
+        Processor = JClass("net.sf.saxon.s9api.Processor")
+        QName = JClass("net.sf.saxon.s9api.QName")
+        ItemType = JClass("net.sf.saxon.s9api.ItemType")
+        XdmAtomicValue = JClass("net.sf.saxon.s9api.XdmAtomicValue")
+
+        stdout = []
+        stderr = []
+
+        @JImplements("javax.xml.transform.ErrorListener")
+        class ErrorListener():
+            @JOverride
+            def warning(self, exception):
+                stderr.append("Warning: " + str(exception.getMessageAndLocation()))
+
+            @JOverride
+            def error(self, exception):
+                stderr.append("Error: " + str(exception.getMessageAndLocation()))
+
+            @JOverride
+            def fatalError(self, exception):
+                stderr.append("Error: " + str(exception.getMessageAndLocation()))
+
+        @JImplements("net.sf.saxon.s9api.MessageListener")
+        class MessageListener():
+            @JOverride
+            def message(self, content, terminate, locator):
+                stderr.append(str(content.getStringValue()))
+
+        if Handlers._processor is None:
+            Handlers._processor = Processor(False)
+        processor = Handlers._processor
+
+        stylesheet = arguments["stylesheet"]
+        key = arguments.get("stylesheet_hash") or (stylesheet, os.stat(stylesheet).st_mtime_ns)
+        try:
+            if key in Handlers._stylesheets:
+                Handlers._stylesheets.move_to_end(key)
+                executable = Handlers._stylesheets[key]
+            else:
+                compiler = processor.newXsltCompiler()
+                compiler.setErrorListener(ErrorListener())
+                executable = Handlers._compile(compiler, stylesheet, arguments.get("compiled_stylesheet"))
+                Handlers._stylesheets[key] = executable
+                while len(Handlers._stylesheets) > Handlers.max_cached_stylesheets:
+                    Handlers._stylesheets.popitem(last=False)
+
+            transformer = executable.load()
+            transformer.getUnderlyingController().setErrorListener(ErrorListener())
+            transformer.setMessageListener(MessageListener())
+
+            if arguments.get("source_text") is not None:
+                transformer.setSource(StreamSource(StringReader(arguments["source_text"])))
+            elif arguments.get("source"):
+                transformer.setSource(StreamSource(File(arguments["source"])))
+            else:
+                transformer.setInitialTemplate(QName.fromClarkName(arguments["template"]))
+
+            for name, value in arguments.get("parameters", {}).items():
+                transformer.setParameter(QName.fromClarkName(name), XdmAtomicValue(value, ItemType.UNTYPED_ATOMIC))
+
+            writer = None
+            if arguments.get("target"):
+                target = File(arguments["target"])
+                transformer.setBaseOutputURI(target.toURI().toString())
+                transformer.setDestination(processor.newSerializer(target))
+            else:
+                writer = StringWriter()
+                transformer.setDestination(processor.newSerializer(writer))
+
+            transformer.transform()
+
+            if writer is not None:
+                if arguments.get("return_output"):
+                    return {"returncode": 0, "output": str(writer.toString()), "stdout": "", "stderr": "\n".join(stderr)}
+                stdout.append(str(writer.toString()))
+
+            return {"returncode": 0, "stdout": "\n".join(stdout), "stderr": "\n".join(stderr)}
+
+        except JException as e:
+            stderr.append(str(e.getMessage()))
+            return {"returncode": 2, "stdout": "\n".join(stdout), "stderr": "\n".join(stderr)}
+
+    @staticmethod
+    def jing(arguments):
+        """Validate a document against a RELAX NG schema. The schema is only loaded once."""
+        from jpype import JClass, JImplements, JOverride
+
+        ValidationDriver = JClass("com.thaiopensource.validate.ValidationDriver")
+        PropertyMapBuilder = JClass("com.thaiopensource.util.PropertyMapBuilder")
+        ValidateProperty = JClass("com.thaiopensource.validate.ValidateProperty")
+        RngProperty = JClass("com.thaiopensource.validate.prop.rng.RngProperty")
+        CompactSchemaReader = JClass("com.thaiopensource.validate.rng.CompactSchemaReader")
+
+        schema = arguments["schema"]
+        key = (schema, os.stat(schema).st_mtime_ns)
+        if key in Handlers._schemas:
+            Handlers._schemas.move_to_end(key)
+            cached = Handlers._schemas[key]
+            cached["results"].clear()
+        else:
+            results = []
+
+            @JImplements("org.xml.sax.ErrorHandler")
+            class ErrorHandler():
+                def _add(self, severity, exception):
+                    system_id = str(exception.getSystemId()) if exception.getSystemId() else None
+                    if system_id and system_id.startswith("file:"):
+                        system_id = urllib.parse.unquote(urllib.parse.urlparse(system_id).path)
+                    results.append({
+                        "severity": severity,
+                        "file": system_id,
+                        "line": int(exception.getLineNumber()),
+                        "column": int(exception.getColumnNumber()),
+                        "message": str(exception.getMessage()),
+                    })
+
+                @JOverride
+                def warning(self, exception):
+                    self._add("warning", exception)
+
+                @JOverride
+                def error(self, exception):
+                    self._add("error", exception)
+
+                @JOverride
+                def fatalError(self, exception):
+                    self._add("fatal", exception)
+
+            error_handler = ErrorHandler()
+            properties = PropertyMapBuilder()
+            ValidateProperty.ERROR_HANDLER.put(properties, error_handler)
+            RngProperty.CHECK_ID_IDREF.add(properties)  # same as the jing command line
+            properties = properties.toPropertyMap()
+            driver = ValidationDriver(properties, properties, CompactSchemaReader.getInstance() if schema.endswith(".rnc") else None)
+            cached = {"driver": driver, "error_handler": error_handler, "results": results}  # the error handler must be kept alive
+
+            if not driver.loadSchema(ValidationDriver.fileInputSource(schema)):
+                return {"returncode": 1, "valid": False, "results": list(results), "stdout": "", "stderr": ""}
+
+            Handlers._schemas[key] = cached
+            while len(Handlers._schemas) > Handlers.max_cached_schemas:
+                Handlers._schemas.popitem(last=False)
+
+        valid = bool(cached["driver"].validate(ValidationDriver.fileInputSource(arguments["source"])))
+        return {"returncode": 0 if valid else 1, "valid": valid, "results": list(cached["results"]), "stdout": "", "stderr": ""}
+
+    @staticmethod
+    def epubcheck(arguments):
+        """
+        Validate one or more EPUBs with EpubCheck. Both zipped and unzipped EPUBs are supported.
+
+        Returns the JSON report from EpubCheck for each EPUB.
+        """
+        from jpype import JArray, JClass, JString
+
+        EpubChecker = JClass("com.adobe.epubcheck.tool.EpubChecker")
+        System = JClass("java.lang.System")
+        PrintStream = JClass("java.io.PrintStream")
+        ByteArrayOutputStream = JClass("java.io.ByteArrayOutputStream")
+
+        results = {}
+        for path in arguments["paths"]:
+            with tempfile.TemporaryDirectory(prefix="epubcheck-") as temp_dir:
+                report_path = os.path.join(temp_dir, "report.json")
+                command = [path] + (["--mode", "exp"] if os.path.isdir(path) else []) + ["--json", report_path]
+
+                # capture what EpubCheck prints, so that it can be returned along with the report
+                stdout, stderr = ByteArrayOutputStream(), ByteArrayOutputStream()
+                original_stdout, original_stderr = System.out, System.err
+                System.setOut(PrintStream(stdout, True, "UTF-8"))
+                System.setErr(PrintStream(stderr, True, "UTF-8"))
+                try:
+                    returncode = int(EpubChecker().run(JArray(JString)(command)))
+                finally:
+                    System.setOut(original_stdout)
+                    System.setErr(original_stderr)
+
+                report = None
+                if os.path.isfile(report_path):
+                    with open(report_path, encoding="utf-8") as f:
+                        report = json.load(f)
+
+            results[path] = {
+                "returncode": returncode,
+                "report": report,
+                "stdout": str(stdout.toString("UTF-8")),
+                "stderr": str(stderr.toString("UTF-8")),
+            }
+
+        return {
+            "returncode": max([result["returncode"] for result in results.values()] + [0]),
+            "results": results,
+            "stdout": "",
+            "stderr": "",
+        }
+
+    @staticmethod
+    def serve(classpath):
+        # Keep the real stdout for responses, and send anything else written
+        # to stdout (for instance from Java) to stderr instead.
+        responses = os.fdopen(os.dup(sys.stdout.fileno()), "w", encoding="utf-8")
+        os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+        def respond(response):
+            responses.write(json.dumps(response) + "\n")
+            responses.flush()
+
+        try:
+            import jpype
+            jvm_path = os.getenv("JVM_PATH") or jpype.getDefaultJVMPath()
+            jpype.startJVM(jvm_path, "--enable-native-access=ALL-UNNAMED", classpath=classpath, convertStrings=False, ignoreUnrecognized=True)
+        except Exception:
+            respond({"ready": False, "error": traceback.format_exc()})
+            return
+
+        respond({"ready": True})
+
+        for line in sys.stdin:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                assert request["command"] in Handlers.commands, "Unknown command: {}".format(request["command"])
+                respond(getattr(Handlers, request["command"])(request["arguments"]))
+            except Exception:
+                respond({"returncode": 1, "stdout": "", "stderr": traceback.format_exc()})
+
+
+if __name__ == "__main__":
+    Handlers.serve(sys.argv[1:])
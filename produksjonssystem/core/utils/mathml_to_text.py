@@ -1,19 +1,32 @@
 # -*- coding: utf-8 -*-
 
+import concurrent.futures
+import hashlib
+import logging
 import os
+import sqlite3
 import subprocess
+import threading
+import time
 import traceback
-import requests
 from lxml import etree
 
 from core.config import Config
 from core.utils.daisy_pipeline import DaisyPipelineJob
 from core.utils.filesystem import Filesystem
+from core.utils.http_client import HttpClient
 
 
 class Mathml_to_text():
     """Class used to transform MathML in xhtml documents"""
 
+    concurrency = int(os.getenv("STEM_CONCURRENCY", "8"))  # number of formulas sent to the STEM service at the same time
+    cache_max_age = 3600 * 24 * 30  # transform cached formulas again after this many seconds, in case the STEM service has been improved
+
+    # treat as class variables
+    _cache_lock = threading.RLock()
+    _cache_connection = None
+
     def __init__(self,
                  pipeline=None,
                  source=None,
@@ -49,32 +62,34 @@ class Mathml_to_text():
             else:
                 self.report.info("Replacing MathML elements in document with spoken math")
 
+                # identical formulas (with the same language) are only transformed once
+                formulas = {}  # MathML => elements
                 for element in mathML_elements:
-                    if not pipeline.shouldRun:
-                        # converting all MathML elements can take a long time,
-                        # so if we're shutting down the system while converting
-                        # MathML, we'll just make this conversion fail.
-                        self.success = False
-                        break
-
-                    # converting all MathML elements can take a long time,
-                    # so run watchdog_bark here.
-                    pipeline.watchdog_bark()
-
-                    parent = element.getparent()
-
                     if "{http://www.w3.org/XML/1998/namespace}lang" not in element.attrib:
                         element.set("{http://www.w3.org/XML/1998/namespace}lang", find_xml_lang(element))
+                    mathml = etree.tostring(element, encoding='unicode', method='xml', with_tail=False)
+                    formulas.setdefault(mathml, []).append(element)
+                self.report.info("{} MathML elements ({} unique formulas)".format(len(mathML_elements), len(formulas)))
 
-                    html_representation = self.mathML_transformation(etree.tostring(element, encoding='unicode', method='xml', with_tail=False))
+                transformations = self.transform_all(pipeline, list(formulas.keys()))
+                if transformations is None:
+                    # converting all MathML elements can take a long time,
+                    # so if we're shutting down the system while converting
+                    # MathML, we'll just make this conversion fail.
+                    return
+
+                for mathml in formulas:
+                    html_representation = transformations[mathml]
                     self.report.debug("Inserting transformation: " + html_representation)
 
-                    stem_element = etree.fromstring(html_representation)
+                    for element in formulas[mathml]:
+                        parent = element.getparent()
+                        stem_element = etree.fromstring(html_representation)
 
-                    if element.tail is not None:
-                        stem_element.tail = element.tail
-                    parent.insert(parent.index(element) + 1, stem_element)
-                    parent.remove(element)
+                        if element.tail is not None:
+                            stem_element.tail = element.tail
+                        parent.insert(parent.index(element) + 1, stem_element)
+                        parent.remove(element)
 
                 self.report.info("Transformasjon ferdig, lagrer fil.")
                 tree.write(target, method='XML', xml_declaration=True, encoding='UTF-8', pretty_print=False)
@@ -85,37 +100,137 @@ class Mathml_to_text():
             self.report.warning(traceback.format_exc(), preformatted=True)
             self.report.error("An error occured during the MathML transformation")
 
-    def mathML_transformation(self, mathml):
-        try:
-            url = Config.get("nlb_api_url") + "/stem/math"
-            payload = mathml
-            headers = {
-                'Accept': "application/json",
-                'Content-Type': 'text/html;charset=utf-8',
-                }
+    def transform_all(self, pipeline, formulas):
+        """
+        Transform a list of MathML formulas, using cached transformations where possible.
+
+        The remaining formulas are sent to the STEM service concurrently. Returns a dict: MathML => HTML,
+        or None if the system is shutting down.
+        """
+        transformations = Mathml_to_text.cache_get(formulas)
+        missing = [mathml for mathml in formulas if mathml not in transformations]
+        if transformations:
+            self.report.debug("{} formulas found in cache".format(len(transformations)))
+
+        if not missing:
+            return transformations
+
+        transformed = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=Mathml_to_text.concurrency) as executor:
+            futures = {executor.submit(Mathml_to_text.stem_transformation, mathml): mathml for mathml in missing}
+            try:
+                for future in concurrent.futures.as_completed(futures):
+                    if pipeline is not None and not pipeline.shouldRun:
+                        for other in futures:
+                            other.cancel()
+                        return None
+
+                    # converting all MathML elements can take a long time,
+                    # so run watchdog_bark here.
+                    if pipeline is not None:
+                        pipeline.watchdog_bark()
 
-            response = requests.request("POST", url, data=payload.encode('utf-8'), headers=headers)
+                    mathml = futures[future]
+                    try:
+                        transformed[mathml] = future.result()
+                        transformations[mathml] = transformed[mathml]
+                    except Exception:
+                        self.report.warning("Error returning MathML transformation. Check STEM result")
+                        transformations[mathml] = Mathml_to_text.fallback_transformation(mathml)
 
-            data = response.json()
+            finally:
+                Mathml_to_text.cache_set(transformed)
 
-            html = data["generated"]["html"]
-            return html
+        return transformations
+
+    def mathML_transformation(self, mathml):
+        try:
+            return Mathml_to_text.stem_transformation(mathml)
         except Exception:
             self.report.warning("Error returning MathML transformation. Check STEM result")
-        #    self.report.warning(traceback.format_exc(), preformatted=True)
-            element = etree.fromstring(mathml)
-            display_attrib = element.attrib["display"]
-            lang_attrib = element.attrib["{http://www.w3.org/XML/1998/namespace}lang"]
-            if display_attrib == "inline":
-                if lang_attrib == "nb" or lang_attrib == "nob" or lang_attrib == "nn":
-                    return "<span>Matematisk formel</span>"
-                else:
-                    return "<span>Mathematical formula</span>"
+            return Mathml_to_text.fallback_transformation(mathml)
+
+    @staticmethod
+    def stem_transformation(mathml):
+        url = Config.get("nlb_api_url") + "/stem/math"
+        payload = mathml
+        headers = {
+            'Accept': "application/json",
+            'Content-Type': 'text/html;charset=utf-8',
+            }
+
+        response = HttpClient.post(url, data=payload.encode('utf-8'), headers=headers)
+
+        data = response.json()
+
+        html = data["generated"]["html"]
+        etree.fromstring(html)  # make sure that the result can be inserted into the document (and cached)
+        return html
+
+    @staticmethod
+    def fallback_transformation(mathml):
+        element = etree.fromstring(mathml)
+        display_attrib = element.attrib["display"]
+        lang_attrib = element.attrib["{http://www.w3.org/XML/1998/namespace}lang"]
+        if display_attrib == "inline":
+            if lang_attrib == "nb" or lang_attrib == "nob" or lang_attrib == "nn":
+                return "<span>Matematisk formel</span>"
             else:
-                if lang_attrib == "nb" or lang_attrib == "nob" or lang_attrib == "nn":
-                    return "<p>Matematisk formel</p>"
-                else:
-                    return "<p>Mathematical formula</p>"
+                return "<span>Mathematical formula</span>"
+        else:
+            if lang_attrib == "nb" or lang_attrib == "nob" or lang_attrib == "nn":
+                return "<p>Matematisk formel</p>"
+            else:
+                return "<p>Mathematical formula</p>"
+
+    @staticmethod
+    def _cache():
+        if Mathml_to_text._cache_connection is None:
+            cache_dir = Filesystem.cache_dir()
+
+            connection = sqlite3.connect(os.path.join(cache_dir, "stem.sqlite"), timeout=30, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS formulas (hash TEXT PRIMARY KEY, html TEXT, created REAL)")
+            connection.commit()
+            Mathml_to_text._cache_connection = connection
+        return Mathml_to_text._cache_connection
+
+    @staticmethod
+    def cache_key(mathml):
+        return hashlib.sha256(mathml.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def cache_get(formulas):
+        """Returns the cached transformations of `formulas` (a list of MathML), as a dict: MathML => HTML"""
+        keys = {Mathml_to_text.cache_key(mathml): mathml for mathml in formulas}
+        hashes = list(keys.keys())
+        result = {}
+        try:
+            with Mathml_to_text._cache_lock:
+                connection = Mathml_to_text._cache()
+                for i in range(0, len(hashes), 500):  # SQLite limits the number of parameters in a query
+                    batch = hashes[i:i + 500]
+                    rows = connection.execute("SELECT hash, html FROM formulas WHERE created > ? AND hash IN ({})".format(", ".join(["?"] * len(batch))),
+                                              [time.time() - Mathml_to_text.cache_max_age] + batch).fetchall()
+                    for row in rows:
+                        result[keys[row[0]]] = row[1]
+        except sqlite3.Error:
+            logging.exception("Klarte ikke å lese fra STEM-cachen")
+        return result
+
+    @staticmethod
+    def cache_set(transformations):
+        """Store transformations (a dict: MathML => HTML) in the cache"""
+        if not transformations:
+            return
+        try:
+            with Mathml_to_text._cache_lock:
+                connection = Mathml_to_text._cache()
+                with connection:
+                    connection.executemany("INSERT OR REPLACE INTO formulas (hash, html, created) VALUES (?, ?, ?)",
+                                           [[Mathml_to_text.cache_key(mathml), transformations[mathml], time.time()] for mathml in transformations])
+        except sqlite3.Error:
+            logging.exception("Klarte ikke å lagre i STEM-cachen")
 
 
 class Mathml_validator():
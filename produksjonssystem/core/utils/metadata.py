@@ -1,23 +1,26 @@
-import copy
 import datetime
+import json
 import logging
 import os
-import pickle
 import re
 import tempfile
 import threading
 import time
 import traceback
+import types
 from difflib import SequenceMatcher
 from json import JSONDecodeError
 
 import dateutil.parser
-import requests
 from lxml import etree as ElementTree
 
 from core.config import Config
+from core.directory import Directory
 from core.utils.epub import Epub
+from core.utils.filesystem import Filesystem
+from core.utils.http_client import HttpClient, ResponseCache
 from core.utils.report import Report
+from core.utils.signature_store import SignatureStore
 
 
 class Metadata:
@@ -29,10 +32,11 @@ class Metadata:
     max_update_interval = 60 * 30  # half hour
     max_metadata_emails_per_day = 5
 
-    metadata_cache = {}
+    metadata_cache = {}  # path => {"checksum": …, "metadata": …}
+    metadata_cache_size = 1000
     _cache_update_lock = threading.RLock()
 
-    signatures_cache = {}
+    signatures_store = None  # see Metadata.get_signatures_store
     signatures_last_update = 0
     _signatures_cachelock = threading.RLock()
     _signatures_updater_cachelock = threading.RLock()
@@ -41,36 +45,26 @@ class Metadata:
     old_books_last_update = 0
     _old_books_cachelock = threading.RLock()
 
-    creative_works = []
+    creative_works = ()  # immutable records (see Metadata.freeze)
     creative_works_editions = {}
     editions = {}
     creative_works_last_update = 0
-    _creative_works_cachelock = threading.RLock()
-
-    requests_cache = {}
-    _requests_cachelock = threading.RLock()
+    creative_works_max_age = 3600  # update the cached creative works in the background after this many seconds
+    _creative_works_cachelock = threading.RLock()  # only used when updating the cache
+    _creative_works_index = None  # see Metadata.index_creative_works
+    _creative_works_validators = {}  # "ETag" and "Last-Modified" of the cached creative works
+    _creative_works_thread = None
+
+    # In some cases, the same URL will be requested multiple times almost simultaneously.
+    # This should reduce the amount of requests done against the API.
+    requests_cache = ResponseCache("metadata",
+                                   max_size=int(os.getenv("HTTP_CACHE_SIZE", "1000")),
+                                   persistent=os.getenv("HTTP_CACHE_PERSISTENT", "false").lower() == "true")
 
+    @staticmethod
     def requests_get(url, cache_timeout=30):
-        # In some cases, the same URL will be requested multiple times almost simultaneously.
-        # This should reduce the amount of requests done against the API.
-        with Metadata._requests_cachelock:
-            for cached_url in list(Metadata.requests_cache.keys()):
-                if Metadata.requests_cache[cached_url]["timeout"] < time.time():
-                    # delete any outdated data from the cache, so that it gets refreshed, and so that we don't store unnecessary data in the cache
-                    del Metadata.requests_cache[cached_url]
-
-                elif url == cached_url:
-                    # hopefully responses are thread safe, as we give the same object to multiple threads here
-                    logging.debug("Using cached response for: {}".format(url))
-                    return Metadata.requests_cache[cached_url]["response"]
-
-            # cache the response, and return it
-            logging.debug("Updating cache for: {}".format(url))
-            Metadata.requests_cache[url] = {
-                "timeout": time.time() + cache_timeout,
-                "response": requests.get(url),
-            }
-            return Metadata.requests_cache[url]["response"]
+        # hopefully responses are thread safe, as we give the same object to multiple threads here
+        return Metadata.requests_cache.get(url, ttl=cache_timeout)
 
     @staticmethod
     def get_edition_from_api(edition_identifier, format="json", report=logging, use_cache_if_possible=False):
@@ -213,7 +207,7 @@ class Metadata:
             if time.time() - Metadata.old_books_last_update > 3600 * 24:
                 editions_url = Config.get("nlb_api_url") + "/editions?limit=-1&editions-metadata=all"
                 logging.debug("Updating old books cache: {}".format(editions_url))
-                response = requests.get(editions_url)
+                response = HttpClient.get(editions_url)
 
                 if response.status_code == 200:
                     old_books = []
@@ -792,19 +786,38 @@ class Metadata:
         if "/" not in path:
             return book_metadata
 
+        # the cached metadata is valid for as long as the book is unchanged
+        checksum = Metadata.book_checksum(path)
+        with Metadata._cache_update_lock:
+            cached = Metadata.metadata_cache.get(path)
+            if cached and not force_update and cached["checksum"] == checksum:
+                return cached["metadata"]
+
+        book_metadata.update(Metadata.sniff_metadata(report, path))
+
+        if checksum is None:
+            return book_metadata  # the book is not in a monitored directory, so we can't tell when the cached metadata is outdated
+
         with Metadata._cache_update_lock:
-            # remove old metadata from cache
-            if not Metadata.metadata_cache:
-                Metadata.metadata_cache = {}
-            for p in list(Metadata.metadata_cache.keys()):
-                if time.time() - Metadata.metadata_cache[p]["cache_time"] > 3600:
-                    del Metadata.metadata_cache[p]
-            if force_update and path in Metadata.metadata_cache:
-                del Metadata.metadata_cache[path]
-
-            # return cached metadata if cached metadata is not old
-            if path in Metadata.metadata_cache:
-                return Metadata.metadata_cache[path]["metadata"]
+            Metadata.metadata_cache.pop(path, None)
+            Metadata.metadata_cache[path] = {
+                "checksum": checksum,
+                "metadata": book_metadata
+            }
+            while len(Metadata.metadata_cache) > Metadata.metadata_cache_size:
+                del Metadata.metadata_cache[next(iter(Metadata.metadata_cache))]  # remove the least recently updated book
+        return book_metadata
+
+    @staticmethod
+    def book_checksum(path):
+        """Checksum of the book, as calculated by the directory monitor (None if the book is not in a monitored directory)"""
+        directory = Directory.get(os.path.dirname(path))
+        return directory.get_checksum(os.path.basename(path)) if directory else None
+
+    @staticmethod
+    def sniff_metadata(report, path):
+        """Read the title and identifier of a book, without parsing more of the book than necessary"""
+        book_metadata = {}
 
         # Try getting EPUB metadata
         if os.path.exists(path):
@@ -812,34 +825,24 @@ class Metadata:
             if epub.isepub(report_errors=False):
                 book_metadata["identifier"] = epub.identifier()
                 book_metadata["title"] = epub.meta("dc:title")
-                with Metadata._cache_update_lock:
-                    Metadata.metadata_cache[path] = {
-                        "cache_time": time.time(),
-                        "metadata": book_metadata
-                    }
-                    return book_metadata
+                return book_metadata
 
-        # Try getting HTML or DAISY 2.02 metadata
+        # Find HTML or DAISY 2.02, DTBook and PEF files
         html_files = []
+        xml_files = []
+        pef_files = []
         for root, dirs, files in os.walk(path):
             for file in files:
                 if file.endswith("html"):
                     html_files.append(os.path.join(root, file))
-
-        # Try getting DTBook metadata
-        xml_files = []
-        for root, dirs, files in os.walk(path):
-            for file in files:
-                if file.endswith(".xml"):
+                elif file.endswith(".xml"):
                     xml_files.append(os.path.join(root, file))
-
-        # Try getting PEF metadata
-        pef_files = []
-        for root, dirs, files in os.walk(path):
-            for file in files:
-                if file.endswith(".pef"):
+                elif file.endswith(".pef"):
                     pef_files.append(os.path.join(root, file))
 
+        book_title = None
+        book_identifier = None
+
         if (os.path.isfile(os.path.join(path, "ncc.html"))
                 or os.path.isfile(os.path.join(path, "metadata.html"))
                 or len(html_files)):
@@ -857,86 +860,88 @@ class Metadata:
             if not file:
                 file = html_files[0]
 
-            html = ElementTree.parse(file).getroot()
-            head = html.xpath("/*[local-name()='head']") + html.xpath("/*/*[local-name()='head']")
-            head = head[0] if head else None
+            _, head = Metadata.parse_head(file)
             if head is not None:
-                book_title = [e.text for e in head.xpath(
-                    "/*/*[local-name()='head']/*[local-name()='title']")]
+                book_title = [e.text for e in head.xpath("*[local-name()='title']")]
                 book_title = book_title[0] if book_title else None
                 book_identifier = [e.attrib["content"] for e in head.xpath(
-                    "/*/*[local-name()='head']/*[local-name()='meta' and @name='dc:identifier']") if "content" in e.attrib]
+                    "*[local-name()='meta' and @name='dc:identifier']") if "content" in e.attrib]
                 book_identifier = book_identifier[0] if book_identifier else None
 
-            if book_title:
-                book_metadata["title"] = book_title
-            if book_identifier:
-                book_metadata["identifier"] = book_identifier
-
         elif len(xml_files) > 0:
-            dtbook = None
             for file in xml_files:
-                xml = ElementTree.parse(file).getroot()
-                if xml.xpath("namespace-uri()") == "http://www.daisy.org/z3986/2005/dtbook/":
-                    dtbook = xml
+                namespace, head = Metadata.parse_head(file, namespace="http://www.daisy.org/z3986/2005/dtbook/")
+                if namespace == "http://www.daisy.org/z3986/2005/dtbook/":
                     break
 
-            if dtbook is not None:
-                head = dtbook.xpath("/*[local-name()='head']") + dtbook.xpath("/*/*[local-name()='head']")
-                head = head[0] if head else None
-                if head is not None:
-                    book_title = [e.attrib["content"] for e in head.xpath(
-                        "/*/*[local-name()='head']/*[local-name()='meta' and @name='dc:Title']") if "content" in e.attrib]
-                    book_title = book_title[0] if book_title else None
-                    book_identifier = [e.attrib["content"] for e in head.xpath(
-                        "/*/*[local-name()='head']/*[local-name()='meta' and @name='dc:Identifier']") if "content" in e.attrib]
-                    book_identifier = book_identifier[0] if book_identifier else None
-
-                if book_title:
-                    book_metadata["title"] = book_title
-                if book_identifier:
-                    book_metadata["identifier"] = book_identifier
+            if head is not None:
+                book_title = [e.attrib["content"] for e in head.xpath(
+                    "*[local-name()='meta' and @name='dc:Title']") if "content" in e.attrib]
+                book_title = book_title[0] if book_title else None
+                book_identifier = [e.attrib["content"] for e in head.xpath(
+                    "*[local-name()='meta' and @name='dc:Identifier']") if "content" in e.attrib]
+                book_identifier = book_identifier[0] if book_identifier else None
 
         elif len(pef_files) > 0:
-            pef = None
             nsmap = {
                 'pef': 'http://www.daisy.org/ns/2008/pef',
                 'dc': 'http://purl.org/dc/elements/1.1/',
                 'nlb': 'http://www.nlb.no/ns/pipeline/xproc'
             }
             for file in pef_files:
-                xml = ElementTree.parse(file).getroot()
-                if xml.xpath("namespace-uri()") == nsmap["pef"]:
-                    pef = xml
+                namespace, head = Metadata.parse_head(file, namespace=nsmap["pef"])
+                if namespace == nsmap["pef"]:
                     break
 
-            if pef is not None:
-                head = pef.xpath("/*/pef:head/pef:meta", namespaces=nsmap)
-                head = head[0] if head else None
-                if head is not None:
-                    book_title = [e.text for e in head.xpath("dc:title", namespaces=nsmap)]
-                    book_title = book_title[0] if book_title else None
-                    book_identifier = [e.text for e in head.xpath("dc:identifier", namespaces=nsmap)]
-                    book_identifier = book_identifier[0] if (book_identifier and re.match(r"^(TEST)?\d+$", book_identifier[0])) else None
-
-                    for e in head.xpath("/*/pef:head/dc:*", namespaces=nsmap):
-                        name = e.xpath("name()", namespaces=nsmap)
-                        value = e.text
-                        if ":" in name:
-                            book_metadata[name] = value
-
-                if book_title:
-                    book_metadata["title"] = book_title
-                if book_identifier:
-                    book_metadata["identifier"] = book_identifier
+            meta = head.xpath("pef:meta", namespaces=nsmap) if head is not None else None
+            meta = meta[0] if meta else None
+            if meta is not None:
+                book_title = [e.text for e in meta.xpath("dc:title", namespaces=nsmap)]
+                book_title = book_title[0] if book_title else None
+                book_identifier = [e.text for e in meta.xpath("dc:identifier", namespaces=nsmap)]
+                book_identifier = book_identifier[0] if (book_identifier and re.match(r"^(TEST)?\d+$", book_identifier[0])) else None
+
+                for e in head.xpath("dc:*", namespaces=nsmap):
+                    name = e.xpath("name()", namespaces=nsmap)
+                    value = e.text
+                    if ":" in name:
+                        book_metadata[name] = value
+
+        if book_title:
+            book_metadata["title"] = book_title
+        if book_identifier:
+            book_metadata["identifier"] = book_identifier
 
-        with Metadata._cache_update_lock:
-            Metadata.metadata_cache[path] = {
-                "cache_time": time.time(),
-                "metadata": book_metadata
-            }
         return book_metadata
 
+    @staticmethod
+    def parse_head(file, namespace=None):
+        """
+        Parse a document until the end of its head element (the root element, or a child of the root element).
+
+        Returns the namespace of the root element, and the head element (or None if there is no head element).
+        If `namespace` is given and the root element is not in that namespace, the rest of the document is not parsed.
+        """
+        root_namespace = None
+        depth = 0
+        with open(file, "rb") as f:
+            for event, element in ElementTree.iterparse(f, events=("start", "end")):
+                if event == "start":
+                    depth += 1
+                    if depth == 1:
+                        root_namespace = ElementTree.QName(element).namespace or ""
+                        if namespace is not None and root_namespace != namespace:
+                            return root_namespace, None
+                    continue
+
+                depth -= 1
+                if depth <= 1 and ElementTree.QName(element).localname == "head":
+                    return root_namespace, element
+                if depth == 1:
+                    element.clear()  # siblings of the head element are not needed
+
+        return root_namespace, None
+
     @staticmethod
     def pipeline_book_shortname(pipeline):
         name = pipeline.book["name"] if pipeline.book else ""
@@ -952,6 +957,8 @@ class Metadata:
     def get_signatures_from_quickbase(edition_identifiers, library=None, report=logging, refresh=False):
         if not edition_identifiers:
             return []
+        if isinstance(edition_identifiers, str):
+            edition_identifiers = [edition_identifiers]
 
         if library is None:
             library = Metadata.get_library_from_identifier(edition_identifiers[0])
@@ -996,120 +1003,94 @@ class Metadata:
             "468": "Signatur honorarkrav behandlet",
             "489": "Signatur kontroll påbegynt",
         }
-        sources_xpath_filter = " or ".join(["@id = '{}'".format(s) for s in sources])
-
-        if not refresh and Metadata.signatures_cache:
-            # hopefully boolean(Metadata.signatures_cache) is an atomic operation, otherwise there
-            # could be a rare race condition here as we don't want to block with Metadata._signatures_updater_cachelock
 
-            pass  # don't update the signatures
-
-        else:
+        store = Metadata.get_signatures_store()
+        if refresh or not store.dumps():
             with Metadata._signatures_updater_cachelock:
-                if refresh or not Metadata.signatures_cache:  # check this again, in case the condition has changed since we got the lock
-                    signatures_cache = {}
-
-                    signatures_cache_file = None
-                    cache_dir = Config.get("cache_dir", None)
-                    if not cache_dir:
-                        cache_dir = os.getenv("CACHE_DIR", os.path.join(tempfile.gettempdir(), "prodsys-cache"))
-                        if not os.path.isdir(cache_dir):
-                            os.makedirs(cache_dir, exist_ok=True)
-                        Config.set("cache_dir", cache_dir)
-                    signatures_cache_file = os.path.join(cache_dir, "signatures.pickle")
-
-                    # try to load from dump file if there are nothing cached in memory
-                    if not Metadata.signatures_cache and signatures_cache_file:
-                        if os.path.isfile(signatures_cache_file):
-                            try:
-                                with open(signatures_cache_file, 'rb') as f:
-                                    loaded_cache = pickle.load(f)
-                                    with Metadata._signatures_cachelock:
-                                        Metadata.signatures_cache = loaded_cache
-                                    report.debug("Loaded signatures cache from: {}".format(signatures_cache_file))
-                            except Exception as e:
-                                logging.exception("Cache file found, but could not parse it", e)
-                        else:
-                            logging.debug("Can't find cache file")
-
+                if refresh or not store.dumps():  # check this again, in case the condition has changed since we got the lock
                     for dump in bookguru_dumps:
                         if not Config.get("system.shouldRun"):
                             return []  # exit from this function here if we're shutting down the system
 
-                        signatures_cache[dump["path"]] = {}
-
                         if not os.path.isfile(dump["path"]):
                             report.warning("Quickbase-dump finnes ikke. Kan ikke hente ut e-postsignaturer: {}")
                             report.debug("Quickbase-dump path: {}".format(dump["path"]))
+                            store.update(dump["path"], [], time.time())
                             continue
 
                         report.debug("Updating signatures cache from: {}".format(dump["path"]))
-
-                        lusers = {}
-                        id_xpath_filter = " or ".join(["@id = '{}'".format(i) for i in dump["id-rows"]])
-                        f = open(dump["path"], "rb")
-                        context = ElementTree.iterparse(f)  # use a streaming parser for big XML files
-
-                        counter = 0
-                        for action, elem in context:
-                            if elem.tag == "lusers":
-                                report.debug("{}: found lusers".format(dump["path"]))
-                                for luser in elem.xpath("luser"):
-                                    lusers[luser.get("id")] = luser.text
-                                report.debug("{}: found {} luser in lusers".format(dump["path"], len(lusers)))
-
-                            if elem.tag != "record":
-                                continue
-
-                            if not Config.get("system.shouldRun", default=True):
-                                return []  # abort iteration if the system is shutting down
-
-                            counter += 1
-                            if counter % 10 == 1:
-                                report.debug("{}: processed {} records so far…".format(dump["path"], counter))
-
-                            identifiers = elem.xpath(f"*[{id_xpath_filter}]/text()")
-
-                            signatures = []
-                            for signature in elem.xpath(f"*[{sources_xpath_filter}]"):
-                                luser = signature.text
-                                if luser and luser in lusers and lusers[luser]:
-                                    signatures.append({
-                                        "source-id": signature.get("id"),
-                                        "source": sources[signature.get("id")],
-                                        "value": lusers[luser]
-                                    })
-                            for identifier in identifiers:
-                                signatures_cache[dump["path"]][identifier] = signatures
-
+                        if not store.update(dump["path"], Metadata._read_signatures_from_quickbase(dump, sources, report), time.time()):
+                            return []  # the system is shutting down
                         report.debug("{}: done parsing.".format(dump["path"]))
 
                     report.debug("Done parsing all Quickbase-dumps.")
-                    with Metadata._signatures_cachelock:
-                        Metadata.signatures_cache = signatures_cache
-                        Metadata.signatures_last_update = time.time()
-                        with open(signatures_cache_file, 'wb') as f:
-                            pickle.dump(Metadata.signatures_cache, f, -1)
-                            report.debug("Stored signatures cache as: {}".format(signatures_cache_file))
+                    Metadata.signatures_last_update = time.time()
 
         if not Config.get("system.shouldRun"):
             return []  # exit from this function here if we're shutting down the system
 
         report.debug("Locating '{}' in signature cache…".format("/".join(edition_identifiers)))
-        with Metadata._signatures_cachelock:
-            for dump in bookguru_dumps:
-                # iterate in order of `bookguru_dumps`, which means Statped gets checked first
-                # when library=StatPed, and NLB gets checked first when library=NLB
-                if dump["path"] not in Metadata.signatures_cache:
-                    continue
-                for identifier in Metadata.signatures_cache[dump["path"]]:
-                    if identifier in edition_identifiers:
-                        report.debug("Found signatures for '{}' in {}.".format("/".join(edition_identifiers), dump["path"]))
-                        return Metadata.signatures_cache[dump["path"]][identifier]
+        for dump in bookguru_dumps:
+            # iterate in order of `bookguru_dumps`, which means Statped gets checked first
+            # when library=StatPed, and NLB gets checked first when library=NLB
+            signatures = store.get(dump["path"], edition_identifiers)
+            if signatures is not None:
+                report.debug("Found signatures for '{}' in {}.".format("/".join(edition_identifiers), dump["path"]))
+                return signatures
 
         report.debug("Signatures for '{}' was not found.".format("/".join(edition_identifiers)))
         return []
 
+    @staticmethod
+    def get_signatures_store():
+        with Metadata._signatures_cachelock:
+            if Metadata.signatures_store is None:
+                cache_dir = Filesystem.cache_dir()
+                Metadata.signatures_store = SignatureStore(os.path.join(cache_dir, "signatures.sqlite"))
+            return Metadata.signatures_store
+
+    @staticmethod
+    def _read_signatures_from_quickbase(dump, sources, report):
+        """Yields (identifiers, signatures) for each record in a Quickbase dump, using a streaming parser for the big XML files"""
+        lusers = {}
+        id_xpath_filter = " or ".join(["@id = '{}'".format(i) for i in dump["id-rows"]])
+        sources_xpath_filter = " or ".join(["@id = '{}'".format(s) for s in sources])
+
+        counter = 0
+        with open(dump["path"], "rb") as f:
+            for action, elem in ElementTree.iterparse(f, tag=("lusers", "record")):
+                if elem.tag == "lusers":
+                    report.debug("{}: found lusers".format(dump["path"]))
+                    for luser in elem.xpath("luser"):
+                        lusers[luser.get("id")] = luser.text
+                    report.debug("{}: found {} luser in lusers".format(dump["path"], len(lusers)))
+
+                else:
+                    if not Config.get("system.shouldRun", default=True):
+                        raise SignatureStore.Abort()  # abort iteration if the system is shutting down
+
+                    counter += 1
+                    if counter % 10 == 1:
+                        report.debug("{}: processed {} records so far…".format(dump["path"], counter))
+
+                    identifiers = elem.xpath(f"*[{id_xpath_filter}]/text()")
+
+                    signatures = []
+                    for signature in elem.xpath(f"*[{sources_xpath_filter}]"):
+                        luser = signature.text
+                        if luser and luser in lusers and lusers[luser]:
+                            signatures.append({
+                                "source-id": signature.get("id"),
+                                "source": sources[signature.get("id")],
+                                "value": lusers[luser]
+                            })
+                    yield identifiers, signatures
+
+                # free the memory used by elements that are already processed
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+
     @staticmethod
     def get_cataloging_signature_from_quickbase(identifiers, report=logging):
         signatures = Metadata.get_signatures_from_quickbase(identifiers, report=report)
@@ -1122,78 +1103,225 @@ class Metadata:
 
     @staticmethod
     def refresh_creative_work_cache_if_necessary(report=logging):
+        """
+        Make sure that the creative works are cached, and that they are kept up to date in the background.
+
+        The first time, the creative works are loaded from the snapshot in the cache directory, or, if there is
+        no snapshot, downloaded from the API. After that, the cache is updated in a background thread, and
+        readers never have to wait for it.
+        """
         if not Config.get("nlb_api_url"):
             report.warning("nlb_api_url is not set, unable to get metadata from API")
             return
 
-        if time.time() - Metadata.creative_works_last_update <= 3600:
-            return  # don't bother waiting for lock
+        if Metadata._creative_works_index is None:
+            with Metadata._creative_works_cachelock:
+                if Metadata._creative_works_index is None and not Metadata.load_creative_works_snapshot(report=report):
+                    Metadata.update_creative_works(report=report)  # nothing cached yet: we have to wait for the API
 
-        with Metadata._creative_works_cachelock:
-            if time.time() - Metadata.creative_works_last_update > 3600:
-                creative_works_url = Config.get("nlb_api_url") + "/creative-works?limit=-1&editions-metadata=simple"
-                logging.debug("Updating creative works cache: {}".format(creative_works_url))
-                response = requests.get(creative_works_url)
+        if Metadata._creative_works_thread is None or not Metadata._creative_works_thread.is_alive():
+            with Metadata._creative_works_cachelock:
+                if Metadata._creative_works_thread is None or not Metadata._creative_works_thread.is_alive():
+                    Metadata._creative_works_thread = threading.Thread(target=Metadata._update_creative_works_periodically,
+                                                                       name="creative works",
+                                                                       daemon=True)
+                    Metadata._creative_works_thread.start()
 
-                if response.status_code == 200:
-                    try:
-                        ret = response.json()
-
-                        if "data" in ret:
-                            Metadata.creative_works = ret["data"]
-                            Metadata.creative_works_editions = {}
-                            Metadata.editions = {}
-                            for cw in Metadata.creative_works:
-                                Metadata.creative_works_editions[cw["identifier"]] = []
-                                for edition in cw["editions"]:
-                                    if not edition["deleted"]:
-                                        Metadata.creative_works_editions[cw["identifier"]].append(edition["identifier"])
-                                        Metadata.editions[edition["identifier"]] = {
-                                            "format": edition["format"],
-                                            "creativeWork": cw["identifier"]
-                                        }
-                            Metadata.creative_works_last_update = time.time()
+    @staticmethod
+    def _update_creative_works_periodically():
+        while True:
+            wait = Metadata.creative_works_last_update + Metadata.creative_works_max_age - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            elif not Metadata.update_creative_works():
+                time.sleep(60)  # try again later
 
-                        else:
-                            report.debug("Could not update creative works metadata from: {}".format(creative_works_url))
-                            report.debug(ret)
+    @staticmethod
+    def update_creative_works(report=logging):
+        """
+        Download the creative works from the API, unless they haven't changed since the last time (using ETag and Last-Modified).
+
+        Returns True if the cache is up to date.
+        """
+        with Metadata._creative_works_cachelock:  # only update from one thread at a time
+            creative_works_url = Config.get("nlb_api_url") + "/creative-works?limit=-1&editions-metadata=simple"
+            logging.debug("Updating creative works cache: {}".format(creative_works_url))
+
+            headers = {}
+            if Metadata._creative_works_index is not None:
+                if Metadata._creative_works_validators.get("ETag"):
+                    headers["If-None-Match"] = Metadata._creative_works_validators["ETag"]
+                if Metadata._creative_works_validators.get("Last-Modified"):
+                    headers["If-Modified-Since"] = Metadata._creative_works_validators["Last-Modified"]
+
+            try:
+                response = HttpClient.get(creative_works_url, headers=headers, timeout=600)
+            except Exception:
+                report.debug("Could not update creative works metadata from: {}".format(creative_works_url))
+                report.debug(traceback.format_exc())
+                return False
+
+            if response.status_code == 304:
+                logging.debug("Creative works has not changed since the last update")
+                Metadata.creative_works_last_update = time.time()
+                return True
+
+            if response.status_code == 200:
+                try:
+                    ret = response.json()
 
-                    except JSONDecodeError:
+                    if "data" in ret:
+                        Metadata.set_creative_works(ret["data"])
+                        Metadata._creative_works_validators = {
+                            header: response.headers[header] for header in ["ETag", "Last-Modified"] if header in response.headers
+                        }
+                        Metadata.save_creative_works_snapshot(ret["data"], report=report)
+                        return True
+
+                    else:
                         report.debug("Could not update creative works metadata from: {}".format(creative_works_url))
-                        report.debug(traceback.format_exc())
+                        report.debug(ret)
 
-                else:
+                except JSONDecodeError:
                     report.debug("Could not update creative works metadata from: {}".format(creative_works_url))
+                    report.debug(traceback.format_exc())
+
+            else:
+                report.debug("Could not update creative works metadata from: {}".format(creative_works_url))
+
+            return False
+
+    @staticmethod
+    def creative_works_snapshot_path():
+        cache_dir = Filesystem.cache_dir()
+        return os.path.join(cache_dir, "creative-works.json")
+
+    @staticmethod
+    def save_creative_works_snapshot(creative_works, report=logging):
+        path = Metadata.creative_works_snapshot_path()
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(path), suffix=".tmp", delete=False) as f:
+                json.dump({
+                    "updated": Metadata.creative_works_last_update,
+                    "validators": Metadata._creative_works_validators,
+                    "data": creative_works,
+                }, f)
+            os.replace(f.name, path)  # replace the snapshot all at once, so that a partially written snapshot is never read
+        except Exception:
+            report.debug("Could not store creative works snapshot: {}".format(path))
+            report.debug(traceback.format_exc())
+
+    @staticmethod
+    def load_creative_works_snapshot(report=logging):
+        """Load the creative works from the snapshot in the cache directory. Returns False if there is no usable snapshot."""
+        path = Metadata.creative_works_snapshot_path()
+        if not os.path.isfile(path):
+            return False
+        try:
+            with open(path) as f:
+                snapshot = json.load(f)
+            Metadata.set_creative_works(snapshot["data"], updated=snapshot["updated"])
+            Metadata._creative_works_validators = snapshot["validators"]
+            report.debug("Loaded creative works from: {}".format(path))
+            return True
+        except Exception:
+            report.debug("Could not load creative works snapshot: {}".format(path))
+            report.debug(traceback.format_exc())
+            return False
+
+    @staticmethod
+    def set_creative_works(creative_works, updated=None):
+        """Replace the cached creative works, and the indexes used to look them up"""
+        index = Metadata.index_creative_works(creative_works)
+
+        # readers use the index without locking, so it is replaced all at once
+        Metadata._creative_works_index = index
+        Metadata.creative_works = index["creative_works"]
+        Metadata.creative_works_editions = index["creative_works_editions"]
+        Metadata.editions = index["editions"]
+        Metadata.creative_works_last_update = updated if updated is not None else time.time()
+
+    @staticmethod
+    def index_creative_works(creative_works):
+        """
+        Build the indexes for a list of creative works (as returned by the API).
+
+        The records are frozen (see `Metadata.freeze`), so that they can be shared without copying them.
+        """
+        index = {
+            "creative_works": Metadata.freeze(creative_works),
+            "creative_works_editions": {},  # creative work identifier => identifiers of editions that are not deleted
+            "editions": {},  # identifier of edition that is not deleted => {"format": …, "creativeWork": …}
+            "creative_work_by_edition": {},  # edition identifier => creative work
+            "sort_values": {},  # edition identifier => (registration date (or availability date, or identifier), -position in the list)
+            "identifier_lengths": set(),  # lengths of edition identifiers
+        }
+
+        position = 0
+        for cw in index["creative_works"]:
+            index["creative_works_editions"][cw["identifier"]] = []
+            for edition in cw["editions"]:
+                position += 1
+                index["creative_work_by_edition"].setdefault(edition["identifier"], cw)
+                index["identifier_lengths"].add(len(edition["identifier"]))
+
+                sort_value = edition["identifier"]
+                if "registered" in edition and edition["registered"] is not None:
+                    sort_value = edition["registered"]
+                elif "available" in edition and edition["available"] is not None:
+                    sort_value = edition["available"]
+                sort_value = (sort_value, -position)  # editions with the same date are kept in the same order as in the list
+                if edition["identifier"] not in index["sort_values"] or sort_value > index["sort_values"][edition["identifier"]]:
+                    index["sort_values"][edition["identifier"]] = sort_value
+
+                if not edition["deleted"]:
+                    index["creative_works_editions"][cw["identifier"]].append(edition["identifier"])
+                    index["editions"][edition["identifier"]] = {
+                        "format": edition["format"],
+                        "creativeWork": cw["identifier"]
+                    }
+
+        return index
+
+    @staticmethod
+    def freeze(value):
+        """Recursively convert dicts to read-only mappings and lists to tuples"""
+        if isinstance(value, dict):
+            return types.MappingProxyType({key: Metadata.freeze(value[key]) for key in value})
+        if isinstance(value, (list, tuple)):
+            return tuple(Metadata.freeze(item) for item in value)
+        return value
 
     @staticmethod
     def get_creative_work_from_cache(edition_identifier, report=logging):
         Metadata.refresh_creative_work_cache_if_necessary(report=report)
 
-        with Metadata._creative_works_cachelock:
-            # if the edition doesn't exist; don't bother searching for its creative work
-            if edition_identifier not in Metadata.editions:
-                return None
+        index = Metadata._creative_works_index
 
-            for cw in Metadata.creative_works:
-                match = False
-                for edition in cw["editions"]:
-                    if (
-                        edition["identifier"] == edition_identifier
-                        or edition["identifier"] == edition_identifier[:6]  # …since the API doesn't fully support longer edition identifiers yet
-                    ):
-                        match = True
-                if match:
-                    creative_work = copy.deepcopy(cw)
-
-                    # fix 12 digit identifiers if necessary
-                    for edition in creative_work["editions"]:
-                        if len(edition["identifier"]) == 6:
-                            edition["identifier"] += edition_identifier[6:]
-
-                    return creative_work
-
-        report.debug("{} was not found in cache".format(edition_identifier))
-        return None
+        # if the edition doesn't exist; don't bother searching for its creative work
+        if index is None or edition_identifier not in index["editions"]:
+            return None
+
+        creative_work = index["creative_work_by_edition"].get(edition_identifier)
+        if creative_work is None:
+            # …since the API doesn't fully support longer edition identifiers yet
+            creative_work = index["creative_work_by_edition"].get(edition_identifier[:6])
+
+        if creative_work is None:
+            report.debug("{} was not found in cache".format(edition_identifier))
+            return None
+
+        # fix 12 digit identifiers if necessary
+        suffix = edition_identifier[6:]
+        if suffix and any(len(edition["identifier"]) == 6 for edition in creative_work["editions"]):
+            editions = tuple(
+                types.MappingProxyType(dict(edition, identifier=edition["identifier"] + suffix)) if len(edition["identifier"]) == 6 else edition
+                for edition in creative_work["editions"]
+            )
+            creative_work = types.MappingProxyType(dict(creative_work, editions=editions))
+
+        return creative_work
 
     @staticmethod
     def filter_identifiers(identifiers_in, identifiers_out, format=None, report=logging):
@@ -1205,45 +1333,36 @@ class Metadata:
         identifiers_in = distinct_identifiers_in
         identifiers_out = distinct_identifiers_out
 
-        creative_works_in = {}
-        creative_works_out = []
-        with Metadata._creative_works_cachelock:
-            for identifier in identifiers_in:
-                short_identifier = identifier[:6]
-                suffix = identifier[6:]
-                if short_identifier not in Metadata.editions:
-                    continue
-                edition = Metadata.editions[short_identifier]
-                other_identifiers = Metadata.creative_works_editions.get(edition["creativeWork"], [])
-                creative_works_in[short_identifier + suffix] = {
-                    other + suffix: Metadata.editions[other] for other in other_identifiers if other in Metadata.editions
-                }
-
-            for identifier in identifiers_out:
-                short_identifier = identifier[:6]
-                suffix = identifier[6:]
-                if short_identifier not in Metadata.editions:
-                    continue
-                edition = Metadata.editions[short_identifier]
-                other_identifiers = Metadata.creative_works_editions.get(edition["creativeWork"], [])
-                creative_works_out.append({
-                    other + suffix: Metadata.editions[other] for other in other_identifiers if other in Metadata.editions
-                })
+        index = Metadata._creative_works_index
+        editions = index["editions"] if index else {}
+        creative_works_editions = index["creative_works_editions"] if index else {}
+
+        # creative works (with suffix) that are already produced
+        creative_works_out = set()
+        for identifier in identifiers_out:
+            short_identifier = identifier[:6]
+            if short_identifier in editions:
+                creative_works_out.add((editions[short_identifier]["creativeWork"], identifier[6:]))
 
-        for identifier in list(creative_works_in.keys()):
-            creative_work_formats = [creative_works_in[identifier][edition]["format"] for edition in creative_works_in[identifier]]
+        missing_identifiers = []
+        for identifier in identifiers_in:
+            short_identifier = identifier[:6]
+            suffix = identifier[6:]
+            if short_identifier not in editions:
+                continue
+            creative_work = editions[short_identifier]["creativeWork"]
 
             # check if we should produce the edition in the format `format`
-            if format is not None and format not in creative_work_formats:
-                del creative_works_in[identifier]
+            if format is not None and not any(editions[other]["format"] == format
+                                              for other in creative_works_editions.get(creative_work, [])
+                                              if other in editions):
                 continue
 
             # check if the creative work is already in creative_works_out (using the identifier for another format)
-            if creative_works_in[identifier] in creative_works_out:
-                del creative_works_in[identifier]
+            if (creative_work, suffix) in creative_works_out:
                 continue
 
-        missing_identifiers = list(creative_works_in.keys())
+            missing_identifiers.append(short_identifier + suffix)
 
         for identifier in identifiers_in:
             if identifier.startswith("TEST") and identifier not in identifiers_out:
@@ -1260,35 +1379,28 @@ class Metadata:
 
         Metadata.refresh_creative_work_cache_if_necessary(report=report)
 
-        sorted = []
+        index = Metadata._creative_works_index
+        if not index or not index["creative_works"]:
+            report.warning("no cached creative works, unable to sort")
+            return identifiers
 
-        # find registration dates for each identifier
-        with Metadata._creative_works_cachelock:
-            if not Metadata.creative_works:
-                report.warning("no cached creative works, unable to sort")
-                return identifiers
-
-            for cw in Metadata.creative_works:
-                for edition in cw["editions"]:
-                    sort_value = edition["identifier"]
-                    if "registered" in edition and edition["registered"] is not None:
-                        sort_value = edition["registered"]
-                    elif "available" in edition and edition["available"] is not None:
-                        sort_value = edition["available"]
-                    matches = [i for i in identifiers if i.startswith(edition["identifier"])]
-                    for match in matches:
-                        sorted.append((match, sort_value))
+        # find registration dates for each identifier (using the editions whose identifier the identifier starts with)
+        sorted = []
+        unsorted = []
+        for identifier in identifiers:
+            sort_values = [index["sort_values"][identifier[:length]] for length in index["identifier_lengths"]
+                           if identifier[:length] in index["sort_values"]]
+            if sort_values:
+                sorted.append((identifier, max(sort_values)))
+            else:
+                unsorted.append(identifier)
 
         # sort by registration date, then remove the registration date from the list
         sorted.sort(key=lambda tup: tup[1], reverse=True)
         sorted = [tup[0] for tup in sorted]
 
         # append any identifiers we couldn't find a registration date for at the end of the list
-        for identifier in identifiers:
-            if identifier not in sorted:
-                sorted.append(identifier)
-
-        return sorted
+        return sorted + unsorted
 
     @staticmethod
     def suggest_similar_editions(edition_identifier, edition_format=None, limit=10, report=logging):
@@ -1305,21 +1417,20 @@ class Metadata:
             return []
 
         matches = []
-        with Metadata._creative_works_cachelock:
-            for cw in Metadata.creative_works:
-                if not isinstance(cw["title"], str):
-                    continue
+        for cw in Metadata.creative_works:
+            if not isinstance(cw["title"], str):
+                continue
 
-                ratio = SequenceMatcher(a=creative_work["title"], b=cw["title"]).ratio()
-                if ratio > 0.9:
-                    for e in cw["editions"]:
-                        if e["format"] == edition_format or edition_format is None:
-                            matches.append((ratio,
-                                            {
-                                                "identifier": e["identifier"],
-                                                "title": cw["title"],
-                                                "format": e["format"]
-                                            }))
+            ratio = SequenceMatcher(a=creative_work["title"], b=cw["title"]).ratio()
+            if ratio > 0.9:
+                for e in cw["editions"]:
+                    if e["format"] == edition_format or edition_format is None:
+                        matches.append((ratio,
+                                        {
+                                            "identifier": e["identifier"],
+                                            "title": cw["title"],
+                                            "format": e["format"]
+                                        }))
         matches = sorted(matches, key=lambda match: match[0])
         matches = [match[1] for match in matches]
         matches = matches[:limit]
@@ -1,7 +1,11 @@
 # -*- coding: utf-8 -*-
 
+import html
 import os
+import re
 
+from core.utils.filesystem import Filesystem
+from core.utils.jvm_worker import JvmWorker
 from core.utils.xslt import Xslt
 
 
@@ -14,6 +18,9 @@ class Relaxng():
 
     relaxng_dir = os.path.join(Xslt.xslt_dir, uid)
 
+    # format of the messages from the jing command line: <file>:<line>:<column>: <severity>: <message>
+    jing_message = re.compile(r"^(?P<file>.*?):(?P<line>-?\d+):(?P<column>-?\d+): (?P<severity>warning|error|fatal)(?: error)?: (?P<message>.*)$")
+
     def __init__(self, pipeline=None, relaxng=None, source=None, report=None, cwd=None, attach_report=True):
         assert pipeline or report and cwd
         assert relaxng and "/" in relaxng and os.path.isfile(relaxng)
@@ -29,28 +36,91 @@ class Relaxng():
             )
             cwd = report.pipeline.dir_in
 
-        self.success = False
-        if not(Xslt.jing_jar is None):
-            process = pipeline.utils.filesystem.run(["java", "-jar", Xslt.jing_jar, "-t", relaxng, source])
+        self.success, self.results = Relaxng.validate(relaxng, source, report, cwd)
+
+        if attach_report:
+            relaxng_report_dir = os.path.join(report.reportDir(), "relaxng")
+            os.makedirs(relaxng_report_dir, exist_ok=True)
+            name = ".".join(os.path.basename(relaxng).split(".")[:-1])
+            available_path = os.path.join(relaxng_report_dir, "{}.html".format(name))
+            if os.path.exists(available_path):
+                for i in range(2, 100000):
+                    available_path = os.path.join(relaxng_report_dir, "{}-{}.html".format(name, i))  # assumes we won't have move than 1000 reports
+                    if not os.path.exists(available_path):
+                        break
+            if os.path.exists(available_path):
+                report.warn("Klarte ikke å finne et tilgjengelig filnavn for rapporten")
+            else:
+                report.debug("Lagrer rapport som {}".format(available_path))
+                report.attachment(Relaxng.render_html(self.results), available_path, "SUCCESS" if self.success else "ERROR")
 
-            if process.returncode == 0:
-                self.success = True
+    @staticmethod
+    def validate(relaxng, source, report, cwd):
+        """
+        Validate `source` against the schema `relaxng`.
 
-        process_string = (process.stdout.decode("utf-8").strip())
-        lines = process_string.splitlines()
-        process_html = """
+        Returns a tuple (success, results), where results is a list of dicts with
+        "severity", "file", "line", "column" and "message".
         """
+        if Xslt.jing_jar is None:
+            report.error("Jing er ikke tilgjengelig, kan ikke validere med RelaxNG")
+            return False, []
+
+        response = JvmWorker.request([Xslt.jing_jar],
+                                     "jing",
+                                     {"schema": os.path.join(cwd, relaxng), "source": os.path.join(cwd, source)})
+
+        if response is not None and "valid" in response:
+            for result in response["results"]:
+                report.debug(Relaxng.format_result(result))
+            return response["valid"], response["results"]
+
+        if response is not None:
+            # the validator failed, for instance because the document could not be read
+            report.debug(response["stderr"], preformatted=True)
+            message = response["stderr"].strip().splitlines()[-1] if response["stderr"].strip() else "Validering feilet"
+            return False, [{"severity": "fatal", "file": None, "line": -1, "column": -1, "message": message}]
 
-        for line in lines:
-            newline = """
+        # worker not available: run jing as a separate process
+        process = Filesystem.run_static(["java", "-jar", Xslt.jing_jar, "-t", relaxng, source], cwd, report)
+        results = [Relaxng.parse_line(line) for line in process.stdout.decode("utf-8").strip().splitlines()]
+        return process.returncode == 0, results
+
+    @staticmethod
+    def parse_line(line):
+        """Parse a line of output from the jing command line"""
+        match = Relaxng.jing_message.match(line)
+        if not match:
+            return {"severity": "info", "file": None, "line": -1, "column": -1, "message": line}
+        result = match.groupdict()
+        result["line"] = int(result["line"])
+        result["column"] = int(result["column"])
+        return result
+
+    @staticmethod
+    def format_result(result):
+        if result["file"] is None:
+            return result["message"]
+        return "{}:{}:{}: {}: {}".format(result["file"], result["line"], result["column"], result["severity"], result["message"])
+
+    @staticmethod
+    def render_html(results):
+        rows = []
+        for result in results:
+            rows.append("""
+               <tr>
+                    <td class="{}">{}</td>
+               </tr>
+               """.format("info" if result["severity"] == "info" else "error", html.escape(Relaxng.format_result(result))))
+        if not rows:
+            rows.append("""
                <tr>
-                    <td class="info">""" + line + """</td>
+                    <td class="info">Ingen feil funnet</td>
                </tr>
-               """
-            process_html += newline + "\n"
+               """)
 
         # HTML String to attach
-        html = """<!DOCTYPE html>
+        return """<!DOCTYPE html>
         <html xmlns="http://www.w3.org/1999/xhtml">
            <head>
               <meta charset="utf-8">
@@ -62,24 +132,9 @@ class Relaxng():
               <h1>Valideringsrapport</h1>
               <div>
                 <table class="results">
-                """ + process_html + """
+                """ + "\n".join(rows) + """
                 </table>
               </div>
            </body>
         </html>
         """
-        if attach_report:
-            relaxng_report_dir = os.path.join(report.reportDir(), "relaxng")
-            os.makedirs(relaxng_report_dir, exist_ok=True)
-            name = ".".join(os.path.basename(relaxng).split(".")[:-1])
-            available_path = os.path.join(relaxng_report_dir, "{}.html".format(name))
-            if os.path.exists(available_path):
-                for i in range(2, 100000):
-                    available_path = os.path.join(relaxng_report_dir, "{}-{}.html".format(name, i))  # assumes we won't have move than 1000 reports
-                    if not os.path.exists(available_path):
-                        break
-            if os.path.exists(available_path):
-                report.warn("Klarte ikke å finne et tilgjengelig filnavn for rapporten")
-            else:
-                report.debug("Lagrer rapport som {}".format(available_path))
-                report.attachment(html, available_path, "SUCCESS" if self.success else "ERROR")
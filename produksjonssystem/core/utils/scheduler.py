@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+import itertools
+import logging
+import os
+import threading
+from contextlib import contextmanager
+
+from core.config import Config
+
+
+class Scheduler():
+    """
+    Limits how many books are processed at the same time across all pipelines.
+
+    Each pipeline has a resource class (Pipeline.resource_class), and each resource class
+    has a limit for how many books can be processed concurrently. Manually triggered books
+    are let through before autotriggered books.
+
+    The limits can be configured with the config keys "scheduler.<resource class>"
+    or the environment variables SCHEDULER_LIMIT_<RESOURCE CLASS>. 0 means no limit.
+    """
+
+    default_limits = {
+        "cpu": os.cpu_count() or 4,  # XSLT, calibre, validators etc.
+        "dp2": 0,  # DAISY Pipeline 2 jobs (no limit, as the jobs are queued and distributed by the engines themselves)
+        "io": 8,  # mostly copying files and talking to APIs
+    }
+
+    # treat as class variables
+    _condition = threading.Condition()
+    _running = {}  # resource class => number of books being processed
+    _waiting = []  # (0 for manual or 1 for autotriggered, ticket number, resource class)
+    _tickets = itertools.count()
+
+    @staticmethod
+    def get_limit(resource_class):
+        limit = Config.get("scheduler.{}".format(resource_class), None)
+        if limit is None:
+            limit = os.getenv("SCHEDULER_LIMIT_{}".format(resource_class.upper()), None)
+        if limit is None:
+            limit = Scheduler.default_limits.get(resource_class, 0)
+        try:
+            return int(limit)
+        except ValueError:
+            logging.warning("Invalid limit for resource class {}: {}".format(resource_class, limit))
+            return Scheduler.default_limits.get(resource_class, 0)
+
+    @staticmethod
+    def get_status():
+        """Number of books being processed and waiting, per resource class"""
+        with Scheduler._condition:
+            resource_classes = set(Scheduler._running.keys()) | set(ticket[2] for ticket in Scheduler._waiting)
+            return {
+                resource_class: {
+                    "running": Scheduler._running.get(resource_class, 0),
+                    "waiting": len([ticket for ticket in Scheduler._waiting if ticket[2] == resource_class]),
+                    "limit": Scheduler.get_limit(resource_class),
+                } for resource_class in resource_classes
+            }
+
+    @staticmethod
+    @contextmanager
+    def slot(resource_class, manual=True):
+        """Wait until a book of the given resource class can be processed, and hold the slot while processing it"""
+        if not resource_class:
+            yield
+            return
+
+        Scheduler.acquire(resource_class, manual)
+        try:
+            yield
+        finally:
+            Scheduler.release(resource_class)
+
+    @staticmethod
+    def acquire(resource_class, manual=True):
+        with Scheduler._condition:
+            ticket = (0 if manual else 1, next(Scheduler._tickets), resource_class)
+            Scheduler._waiting.append(ticket)
+            try:
+                while not Scheduler._can_run(ticket):
+                    Scheduler._condition.wait(timeout=10)  # check regularly in case the limit is changed
+            finally:
+                Scheduler._waiting.remove(ticket)
+            Scheduler._running[resource_class] = Scheduler._running.get(resource_class, 0) + 1
+            Scheduler._condition.notify_all()  # let the next in line check if there are more free slots
+
+    @staticmethod
+    def release(resource_class):
+        with Scheduler._condition:
+            Scheduler._running[resource_class] = max(0, Scheduler._running.get(resource_class, 0) - 1)
+            Scheduler._condition.notify_all()
+
+    @staticmethod
+    def _can_run(ticket):
+        resource_class = ticket[2]
+        limit = Scheduler.get_limit(resource_class)
+        if limit > 0 and Scheduler._running.get(resource_class, 0) >= limit:
+            return False
+
+        # only the first in line (manual before autotriggered, then first come first served) can run
+        return ticket == min(waiting for waiting in Scheduler._waiting if waiting[2] == resource_class)
@@ -1,12 +1,14 @@
 # -*- coding: utf-8 -*-
 
+import hashlib
+import io
 import os
-import tempfile
 import traceback
 from threading import RLock
 
 from lxml import etree as ElementTree
 
+from core.utils.filesystem import Filesystem
 from core.utils.xslt import Xslt
 
 
@@ -16,8 +18,14 @@ class Schematron():
     uid = "core-utils-schematron"
     schematron_dir = os.path.join(Xslt.xslt_dir, uid, "schematron/trunk/schematron/code")
 
+    # the stylesheets used to compile a Schematron to XSLT, in order
+    compile_steps = ["iso_dsdl_include.xsl", "iso_abstract_expand.xsl", "iso_svrl_for_xslt2.xsl"]
+
+    # references to other files from a Schematron
+    include_references = "//sch:include/@href | //sch:extends/@href | //xi:include/@href"
+
     # static
-    cache = {}
+    cache = {}  # compiled Schematron => lock
     _cache_lock = RLock()
 
     def __init__(self, pipeline=None, schematron=None, source=None, report=None, cwd=None, attach_report=True):
@@ -42,143 +50,142 @@ class Schematron():
             if not compiled_schematron:
                 return
 
-            temp_xml_report_obj = tempfile.NamedTemporaryFile()
-            temp_xml_report = temp_xml_report_obj.name
-
-            report.debug("Validating against compiled Schematron ({} + {}): {}".format(
+            report.debug("Validating against compiled Schematron ({} + {})".format(
                 "iso_svrl_for_xslt2.xsl",
-                os.path.basename(source),
-                os.path.basename(temp_xml_report)))
-            xslt = Xslt(report=report,
-                        cwd=cwd,
-                        stylesheet=compiled_schematron,
-                        source=source,
-                        target=temp_xml_report,
-                        stdout_level="DEBUG",
-                        stderr_level="DEBUG")
-            if not xslt.success:
+                os.path.basename(source)))
+            svrl = Xslt.transform_in_memory(compiled_schematron, report, source=source, cwd=cwd)
+            if svrl is None:
                 return
 
             # Count number of errors
-            svrl_schematron_output = ElementTree.parse(temp_xml_report).getroot()
-            errors = svrl_schematron_output.findall('{http://purl.oclc.org/dsdl/svrl}failed-assert')
-            errors.extend(svrl_schematron_output.findall('{http://purl.oclc.org/dsdl/svrl}successful-report'))
-            if len(errors) == 0:
-                self.success = True
-            else:
-                max_errors = 20
-                e = 0
-                pattern_title = None
-                for element in svrl_schematron_output.getchildren():
-                    if element.tag == '{http://purl.oclc.org/dsdl/svrl}active-pattern':
-                        pattern_title = element.attrib["name"] if "name" in element.attrib else None
-                        continue
-
-                    if element.tag == '{http://purl.oclc.org/dsdl/svrl}failed-assert' or element.tag == '{http://purl.oclc.org/dsdl/svrl}successful-report':
-
-                        location = element.attrib["location"] if "location" in element.attrib else None
-                        test = element.attrib["test"] if "test" in element.attrib else None
-                        text = element.find('{http://purl.oclc.org/dsdl/svrl}text')
-                        text = text.text if text is not None and text.text else "(missing description)"
-
-                        if e < max_errors:
-                            report.error((pattern_title + ": " if pattern_title else "") + text)
-                        report.debug((pattern_title + ": " if pattern_title else "") + text + (" ({})".format(location) if location else "") +
-                                     (" ({})".format(test) if test else ""))
-
-                        e += 1
+            errors = Schematron.report_errors(svrl, report)
+            self.success = errors == 0
 
             # Create HTML report
-            if temp_xml_report and "/" in temp_xml_report:
-                html_report_obj = tempfile.NamedTemporaryFile()
-                html_report = html_report_obj.name
-                report.debug("Creating HTML report for Schematron validation ({} + {}): {}".format(
-                    "iso_svrl_for_xslt2.xsl", os.path.basename(temp_xml_report), os.path.basename(html_report)))
-                xslt = Xslt(report=report,
-                            cwd=cwd,
-                            stylesheet=os.path.join(Xslt.xslt_dir, Schematron.uid, "svrl-to-html.xsl"),
-                            source=temp_xml_report,
-                            target=html_report)
-                if not xslt.success:
+            if attach_report:
+                report.debug("Creating HTML report for Schematron validation")
+                html = Xslt.transform_in_memory(os.path.join(Xslt.xslt_dir, Schematron.uid, "svrl-to-html.xsl"),
+                                                report,
+                                                source_text=svrl,
+                                                cwd=cwd)
+                if html is None:
                     return
 
-                if attach_report:
-                    schematron_report_dir = os.path.join(report.reportDir(), "schematron")
-                    os.makedirs(schematron_report_dir, exist_ok=True)
-                    name = ".".join(os.path.basename(schematron).split(".")[:-1])
-                    available_path = os.path.join(schematron_report_dir, "{}.html".format(name))
-                    if os.path.exists(available_path):
-                        for i in range(2, 100000):
-                            available_path = os.path.join(schematron_report_dir, "{}-{}.html".format(name, i))  # assumes we won't have move than 1000 reports
-                            if not os.path.exists(available_path):
-                                break
-                    if os.path.exists(available_path):
-                        report.warn("Klarte ikke å finne et tilgjengelig filnavn for rapporten")
-                    else:
-                        report.debug("Lagrer rapport som {}".format(available_path))
-                        with open(html_report, 'r') as result_report:
-                            report.attachment(result_report.readlines(),
-                                              available_path,
-                                              "SUCCESS" if self.success else "ERROR")
+                schematron_report_dir = os.path.join(report.reportDir(), "schematron")
+                os.makedirs(schematron_report_dir, exist_ok=True)
+                name = ".".join(os.path.basename(schematron).split(".")[:-1])
+                available_path = os.path.join(schematron_report_dir, "{}.html".format(name))
+                if os.path.exists(available_path):
+                    for i in range(2, 100000):
+                        available_path = os.path.join(schematron_report_dir, "{}-{}.html".format(name, i))  # assumes we won't have move than 1000 reports
+                        if not os.path.exists(available_path):
+                            break
+                if os.path.exists(available_path):
+                    report.warn("Klarte ikke å finne et tilgjengelig filnavn for rapporten")
+                else:
+                    report.debug("Lagrer rapport som {}".format(available_path))
+                    report.attachment(html,
+                                      available_path,
+                                      "SUCCESS" if self.success else "ERROR")
 
         except Exception:
             report.debug(traceback.format_exc(), preformatted=True)
             report.error("An error occured while running the Schematron (" + str(schematron) + ")")
 
+    @staticmethod
+    def report_errors(svrl, report, max_errors=20):
+        """
+        Report the failed asserts and successful reports in the SVRL output, without building a tree of the whole document.
+
+        Returns the number of errors.
+        """
+        svrl_ns = "{http://purl.oclc.org/dsdl/svrl}"
+        errors = 0
+        pattern_title = None
+        depth = 0
+        for event, element in ElementTree.iterparse(io.BytesIO(svrl.encode("utf-8")), events=("start", "end")):
+            if event == "start":
+                depth += 1
+                if depth == 2 and element.tag == svrl_ns + "active-pattern":
+                    pattern_title = element.attrib["name"] if "name" in element.attrib else None
+                continue
+
+            depth -= 1
+            if depth != 1:
+                continue
+
+            if element.tag == svrl_ns + "failed-assert" or element.tag == svrl_ns + "successful-report":
+                location = element.attrib["location"] if "location" in element.attrib else None
+                test = element.attrib["test"] if "test" in element.attrib else None
+                text = element.find(svrl_ns + "text")
+                text = text.text if text is not None and text.text else "(missing description)"
+
+                if errors < max_errors:
+                    report.error((pattern_title + ": " if pattern_title else "") + text)
+                report.debug((pattern_title + ": " if pattern_title else "") + text + (" ({})".format(location) if location else "") +
+                             (" ({})".format(test) if test else ""))
+
+                errors += 1
+
+            # we're done with this element
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
+        return errors
+
+    @staticmethod
+    def compiled_schematron_path(schematron):
+        """
+        Where the compiled version of a Schematron is stored.
+
+        The path contains a hash of the Schematron, the files it includes and the stylesheets used to
+        compile it, so that the compiled Schematron is reused across restarts until one of them changes.
+        """
+        cache_dir = Filesystem.cache_dir()
+
+        md5 = hashlib.md5()
+        md5.update(Xslt.stylesheet_hash(schematron, references=Schematron.include_references).encode("utf-8"))
+        for stylesheet in Schematron.compile_steps:
+            md5.update(Xslt.stylesheet_hash(os.path.join(Schematron.schematron_dir, stylesheet)).encode("utf-8"))
+        return os.path.join(cache_dir, "schematron", "{}.xsl".format(md5.hexdigest()))
+
+    @staticmethod
     def compile_schematron(schematron, cwd, report):
-        with Schematron._cache_lock:
-            if schematron in Schematron.cache and Schematron.cache[schematron] and os.path.isfile(Schematron.cache[schematron].name):
-                return Schematron.cache[schematron].name
+        compiled_schematron = Schematron.compiled_schematron_path(os.path.join(cwd, schematron))
 
-        try:
-            temp_xml_1_obj = tempfile.NamedTemporaryFile()
-            temp_xml_1 = temp_xml_1_obj.name
-
-            temp_xml_2_obj = tempfile.NamedTemporaryFile()
-            temp_xml_2 = temp_xml_2_obj.name
-
-            temp_xml_3_obj = tempfile.NamedTemporaryFile()
-            temp_xml_3 = temp_xml_3_obj.name
-
-            report.debug("Compiling schematron ({} + {}): {}".format("iso_dsdl_include.xsl", os.path.basename(schematron), os.path.basename(temp_xml_1)))
-            xslt = Xslt(report=report,
-                        cwd=cwd,
-                        stylesheet=os.path.join(Schematron.schematron_dir, "iso_dsdl_include.xsl"),
-                        source=schematron,
-                        target=temp_xml_1,
-                        stdout_level="DEBUG",
-                        stderr_level="DEBUG")
-            if not xslt.success:
-                return None
-
-            report.debug("Compiling schematron ({} + {}): {}".format("iso_abstract_expand.xsl", os.path.basename(schematron), os.path.basename(temp_xml_2)))
-            xslt = Xslt(report=report,
-                        cwd=cwd,
-                        stylesheet=os.path.join(Schematron.schematron_dir, "iso_abstract_expand.xsl"),
-                        source=temp_xml_1,
-                        target=temp_xml_2,
-                        stdout_level="DEBUG",
-                        stderr_level="DEBUG")
-            if not xslt.success:
-                return None
-
-            report.debug("Compiling schematron ({} + {}): {}".format("iso_svrl_for_xslt2.xsl", os.path.basename(schematron), os.path.basename(temp_xml_3)))
-            xslt = Xslt(report=report,
-                        cwd=cwd,
-                        stylesheet=os.path.join(Schematron.schematron_dir, "iso_svrl_for_xslt2.xsl"),
-                        source=temp_xml_2,
-                        target=temp_xml_3,
-                        stdout_level="DEBUG",
-                        stderr_level="DEBUG")
-            if not xslt.success:
-                return None
-
-            with Schematron._cache_lock:
-                Schematron.cache[schematron] = temp_xml_3_obj
-                return Schematron.cache[schematron].name
-
-        except Exception:
-            report.debug(traceback.format_exc(), preformatted=True)
-            report.error("An error occured while compiling the Schematron (" + str(schematron) + ")")
+        with Schematron._cache_lock:
+            lock = Schematron.cache.setdefault(compiled_schematron, RLock())
+
+        with lock:  # only compile the same Schematron once at a time
+            if os.path.isfile(compiled_schematron):
+                return compiled_schematron
+
+            try:
+                result = None
+                source = schematron
+                for stylesheet in Schematron.compile_steps:
+                    report.debug("Compiling schematron ({} + {})".format(stylesheet, os.path.basename(schematron)))
+                    result = Xslt.transform_in_memory(os.path.join(Schematron.schematron_dir, stylesheet),
+                                                      report,
+                                                      source=source if result is None else None,
+                                                      source_text=result,
+                                                      cwd=cwd)
+                    if result is None:
+                        return None
+
+                # write to a temporary file first, so that other processes never see a partially written file
+                os.makedirs(os.path.dirname(compiled_schematron), exist_ok=True)
+                temp_file = "{}.{}.tmp".format(compiled_schematron, os.getpid())
+                with open(temp_file, "w", encoding="utf-8") as f:
+                    f.write(result)
+                os.replace(temp_file, compiled_schematron)
+                report.debug("Compiled schematron stored as {}".format(compiled_schematron))
+
+                return compiled_schematron
+
+            except Exception:
+                report.debug(traceback.format_exc(), preformatted=True)
+                report.error("An error occured while compiling the Schematron (" + str(schematron) + ")")
 
         return None
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+
+class SignatureStore():
+    """
+    Persistent storage of Quickbase signatures, backed by SQLite and indexed by edition identifier.
+
+    Each dump is replaced in a single transaction, so lookups see either the old or the new signatures.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._connection = None  # used for lookups
+        self._lock = threading.RLock()
+
+    def _connect(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute("CREATE TABLE IF NOT EXISTS dumps ("
+                           "dump TEXT PRIMARY KEY, "
+                           "updated REAL)")
+        connection.execute("CREATE TABLE IF NOT EXISTS records ("
+                           "id INTEGER PRIMARY KEY, "
+                           "dump TEXT, "
+                           "signatures TEXT)")
+        connection.execute("CREATE INDEX IF NOT EXISTS records_dump ON records (dump)")
+        connection.execute("CREATE TABLE IF NOT EXISTS identifiers ("
+                           "dump TEXT, "
+                           "identifier TEXT, "
+                           "record INTEGER, "
+                           "PRIMARY KEY (dump, identifier))")
+        connection.commit()
+        return connection
+
+    def _reader(self):
+        if self._connection is None:
+            self._connection = self._connect()
+        return self._connection
+
+    def dumps(self):
+        """Returns the dumps that are stored, as a dict: dump => time of last update"""
+        with self._lock:
+            try:
+                return dict(self._reader().execute("SELECT dump, updated FROM dumps").fetchall())
+            except sqlite3.DatabaseError:
+                logging.exception("Could not read signatures from {}".format(self.path))
+                return {}
+
+    def get(self, dump, identifiers):
+        """Returns the signatures for the first of the `identifiers` found in `dump`, or None if none of them are found"""
+        if not identifiers:
+            return None
+        with self._lock:
+            try:
+                row = self._reader().execute(
+                    "SELECT records.signatures FROM identifiers JOIN records ON records.id = identifiers.record "
+                    "WHERE identifiers.dump = ? AND identifiers.identifier IN ({}) ORDER BY identifiers.rowid LIMIT 1".format(
+                        ", ".join(["?"] * len(identifiers))),
+                    [dump] + list(identifiers)).fetchone()
+            except sqlite3.DatabaseError:
+                logging.exception("Could not read signatures from {}".format(self.path))
+                return None
+        return json.loads(row[0]) if row else None
+
+    def update(self, dump, records, updated):
+        """
+        Replace the signatures for `dump` with `records`.
+
+        `records` is an iterable of (identifiers, signatures) tuples, which is consumed one record at a time.
+        If it raises `SignatureStore.Abort`, the update is rolled back and False is returned.
+        """
+        connection = self._connect()  # separate connection, so that lookups are not blocked (or see a half-written dump) while updating
+        try:
+            with connection:
+                connection.execute("DELETE FROM identifiers WHERE dump = ?", [dump])
+                connection.execute("DELETE FROM records WHERE dump = ?", [dump])
+
+                for identifiers, signatures in records:
+                    record = connection.execute("INSERT INTO records (dump, signatures) VALUES (?, ?)",
+                                                [dump, json.dumps(signatures)]).lastrowid
+                    connection.executemany("INSERT OR REPLACE INTO identifiers (dump, identifier, record) VALUES (?, ?, ?)",
+                                           [[dump, identifier, record] for identifier in identifiers])
+
+                connection.execute("INSERT OR REPLACE INTO dumps (dump, updated) VALUES (?, ?)", [dump, updated])
+
+        except SignatureStore.Abort:
+            return False
+
+        finally:
+            connection.close()
+
+        return True
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+            self._connection = None
+
+    class Abort(Exception):
+        """Raised while iterating the records to abort an update"""
+        pass
@@ -1,11 +1,17 @@
 # -*- coding: utf-8 -*-
 
+import hashlib
 import os
 import subprocess
+import tempfile
+import threading
 import traceback
 
+from lxml import etree
+
 from core.utils.daisy_pipeline import DaisyPipelineJob
 from core.utils.filesystem import Filesystem
+from core.utils.jvm_worker import JvmWorker
 
 
 class Xslt():
@@ -15,6 +21,14 @@ class Xslt():
     xslt_dir = os.path.realpath(os.path.join(os.path.dirname(os.path.realpath(__file__)), "../../..", "xslt"))
     saxon_jar = None
     jing_jar = None
+    namespaces = {
+        "xsl": "http://www.w3.org/1999/XSL/Transform",
+        "sch": "http://purl.oclc.org/dsdl/schematron",
+        "xi": "http://www.w3.org/2001/XInclude",
+    }
+    import_references = "/*/xsl:import/@href | /*/xsl:include/@href"
+    _hashes = {}  # (stylesheet, references) => {"hash": …, "files": {path: state}}
+    _hashes_lock = threading.Lock()
 
     @staticmethod
     def init_environment():
@@ -32,6 +46,180 @@ class Xslt():
         if "JING_JAR" in os.environ:
             Xslt.jing_jar = os.environ["JING_JAR"]
 
+    @staticmethod
+    def _file_state(path):
+        try:
+            stat = os.stat(path)
+            return [stat.st_mtime_ns, stat.st_size]
+        except OSError:
+            return None
+
+    @staticmethod
+    def _stylesheet_info(stylesheet, references=None):
+        """
+        Information about a stylesheet and all the stylesheets it imports or includes.
+
+        `references` is an XPath expression for finding references to other files
+        (default: xsl:import and xsl:include).
+
+        Returns a dict with "hash" (of all the files) and "files".
+        The information is remembered, and only recalculated when one of the files has changed.
+        """
+        stylesheet = os.path.realpath(stylesheet)
+        references = references or Xslt.import_references
+        with Xslt._hashes_lock:
+            cached = Xslt._hashes.get((stylesheet, references))
+        if cached and all(Xslt._file_state(path) == state for path, state in cached["files"].items()):
+            return cached
+
+        md5 = hashlib.md5()
+        files = {}
+        queue = [stylesheet]
+        while queue:
+            path = queue.pop(0)
+            if path in files:
+                continue
+            files[path] = Xslt._file_state(path)
+            md5.update(path.encode("utf-8"))
+            if files[path] is None:
+                continue
+
+            with open(path, "rb") as f:
+                content = f.read()
+            md5.update(content)
+
+            try:
+                document = etree.fromstring(content, base_url=path)
+            except etree.XMLSyntaxError:
+                continue  # let Saxon report the error
+            for href in document.xpath(references, namespaces=Xslt.namespaces):
+                if href.startswith("file:"):
+                    href = href[len("file:"):]
+                elif "://" in href:
+                    continue  # not a local file
+                queue.append(os.path.realpath(os.path.join(os.path.dirname(path), href)))
+
+        info = {"hash": md5.hexdigest(), "files": files}
+        with Xslt._hashes_lock:
+            Xslt._hashes[(stylesheet, references)] = info
+        return info
+
+    @staticmethod
+    def stylesheet_hash(stylesheet, references=None):
+        """Hash of a stylesheet and all the stylesheets it imports or includes (or other references, see _stylesheet_info)."""
+        return Xslt._stylesheet_info(stylesheet, references)["hash"]
+
+    @staticmethod
+    def compiled_stylesheet_path(stylesheet_hash):
+        cache_dir = Filesystem.cache_dir()
+        return os.path.join(cache_dir, "xslt", "{}.sef".format(stylesheet_hash))
+
+    @staticmethod
+    def transform_in_worker(stylesheet, source, target, parameters, template, report, cwd, stdout_level, stderr_level):
+        """
+        Run the transformation in a long-lived JVM worker, which keeps compiled stylesheets in memory.
+        Compiled stylesheets are identified by the hash of the stylesheet and its imports.
+
+        Returns whether the transformation succeeded, or None if no worker is available.
+        """
+        if not Xslt.saxon_jar:
+            return None
+
+        stylesheet_hash = Xslt.stylesheet_hash(os.path.join(cwd, stylesheet))
+        arguments = {
+            "stylesheet": os.path.join(cwd, stylesheet),
+            "stylesheet_hash": stylesheet_hash,
+            "compiled_stylesheet": Xslt.compiled_stylesheet_path(stylesheet_hash),
+            "source": os.path.join(cwd, source) if source else None,
+            "template": template,
+            "target": os.path.join(cwd, target) if target else None,
+            "parameters": parameters,
+        }
+        if arguments["target"]:
+            os.makedirs(os.path.dirname(arguments["target"]), exist_ok=True)
+
+        report.debug("Running XSLT: {}".format(stylesheet))
+        result = JvmWorker.request([Xslt.saxon_jar], "xslt", arguments)
+        if result is None:
+            return None
+
+        if result["returncode"] != 0:
+            report.error("XSLTen {} feilet (returkode {})".format(stylesheet, result["returncode"]))
+        report.debug("---- stdout: ----")
+        report.add_message(stdout_level, result["stdout"].strip(), add_empty_line_between=True)
+        report.debug("-----------------")
+        report.debug("---- stderr: ----")
+        report.add_message(stderr_level, result["stderr"].strip(), add_empty_line_between=True)
+        report.debug("-----------------")
+
+        return result["returncode"] == 0
+
+    @staticmethod
+    def transform_in_memory(stylesheet, report, source=None, source_text=None, parameters={}, cwd=None, stderr_level="DEBUG"):
+        """
+        Run a transformation and return the result as a string, instead of writing it to a file.
+
+        The source can be given either as a file (`source`) or as a string (`source_text`).
+        Returns None if the transformation failed.
+        """
+        assert source or source_text is not None
+
+        if not cwd:
+            cwd = Xslt.xslt_dir
+
+        Xslt.init_environment()
+
+        try:
+            if Xslt.saxon_jar:
+                arguments = {
+                    "stylesheet": os.path.join(cwd, stylesheet),
+                    "stylesheet_hash": Xslt.stylesheet_hash(os.path.join(cwd, stylesheet)),
+                    "source": os.path.join(cwd, source) if source else None,
+                    "source_text": source_text,
+                    "parameters": parameters,
+                    "return_output": True,
+                }
+                arguments["compiled_stylesheet"] = Xslt.compiled_stylesheet_path(arguments["stylesheet_hash"])
+
+                report.debug("Running XSLT: {}".format(stylesheet))
+                result = JvmWorker.request([Xslt.saxon_jar], "xslt", arguments)
+                if result is not None:
+                    report.add_message(stderr_level, result["stderr"].strip(), add_empty_line_between=True)
+                    if result["returncode"] != 0:
+                        report.error("XSLTen {} feilet (returkode {})".format(stylesheet, result["returncode"]))
+                        return None
+                    return result["output"]
+
+            # worker not available: go through temporary files
+            with tempfile.TemporaryDirectory() as temp_dir:
+                if source_text is not None:
+                    source = os.path.join(temp_dir, "source.xml")
+                    with open(source, "w", encoding="utf-8") as f:
+                        f.write(source_text)
+                target = os.path.join(temp_dir, "result.xml")
+
+                xslt = Xslt(report=report,
+                            cwd=cwd,
+                            stylesheet=stylesheet,
+                            source=source,
+                            target=target,
+                            parameters=parameters,
+                            stdout_level="DEBUG",
+                            stderr_level=stderr_level)
+                if not xslt.success:
+                    return None
+                with open(target, encoding="utf-8") as f:
+                    return f.read()
+
+        except subprocess.TimeoutExpired:
+            report.error("XSLTen {} tok for lang tid og ble derfor stoppet.".format(stylesheet))
+
+        except Exception:
+            report.debug(traceback.format_exc(), preformatted=True)
+            report.error("An error occured while running the XSLT (" + str(stylesheet) + ")")
+
+        return None
+
     def __init__(self,
                  pipeline=None,
                  stylesheet=None,
@@ -58,20 +246,24 @@ class Xslt():
         Xslt.init_environment()
 
         try:
-            command = ["java", "-jar", Xslt.saxon_jar]
-            if source:
-                command.append("-s:" + source)
-            else:
-                command.append("-it:" + template)
-            command.append("-xsl:" + stylesheet)
-            if target:
-                command.append("-o:" + target)
-            for param in parameters:
-                command.append(param + "=" + parameters[param])
-
-            report.debug("Running XSLT")
-            process = Filesystem.run_static(command, cwd, report, stdout_level=stdout_level, stderr_level=stderr_level)
-            self.success = process.returncode == 0
+            self.success = Xslt.transform_in_worker(stylesheet, source, target, parameters, template, report, cwd, stdout_level, stderr_level)
+
+            if self.success is None:
+                # worker not available: run Saxon as a separate process
+                command = ["java", "-jar", Xslt.saxon_jar]
+                if source:
+                    command.append("-s:" + source)
+                else:
+                    command.append("-it:" + template)
+                command.append("-xsl:" + stylesheet)
+                if target:
+                    command.append("-o:" + target)
+                for param in parameters:
+                    command.append(param + "=" + parameters[param])
+
+                report.debug("Running XSLT")
+                process = Filesystem.run_static(command, cwd, report, stdout_level=stdout_level, stderr_level=stderr_level)
+                self.success = process.returncode == 0
 
         except subprocess.TimeoutExpired:
             report.error("XSLTen {} tok for lang tid og ble derfor stoppet.".format(stylesheet))
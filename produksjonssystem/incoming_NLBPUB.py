@@ -24,6 +24,7 @@ class IncomingNLBPUB(Pipeline):
     group_title = "Mottakskontroll NLBPUB"
     labels = ["EPUB"]
     publication_format = None
+    resource_class = "cpu"
     expected_processing_time = 300
     warning = False
     should_email_default = True
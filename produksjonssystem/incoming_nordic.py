@@ -39,6 +39,8 @@ class IncomingNordic(Pipeline):
     title = "Validering av Nordisk EPUB 3"
     labels = ["EPUB", "Statped"]
     publication_format = None
+    resource_class = "dp2"
+    release_worker_while_waiting = True  # process other books while waiting for Pipeline 2
     expected_processing_time = 1400
     ace_cli = None
 
@@ -19,6 +19,7 @@ class InsertMetadata(Pipeline):
     # group_title = "Sett inn metadata"
     labels = ["Statped"]
     publication_format = None
+    resource_class = "cpu"
     expected_processing_time = 500
 
     logPipeline = None
@@ -28,6 +28,7 @@ class Newsletter(Pipeline):
     newsletter_identifier = ""
     year_month = ""
     publication_format = "Braille"
+    resource_class = "dp2"
     expected_processing_time = 20
     _triggerNewsletterThread = None
 
@@ -23,6 +23,7 @@ class NewspaperSchibsted(Pipeline):
     labels = ["Daisy 2.02"]
     logPipeline = None
     publication_format = "Lydbok"
+    resource_class = "cpu"
     expected_processing_time = 300
 
     def start(self, *args, **kwargs):
@@ -36,6 +36,7 @@ class NLBpubToDocx(Pipeline):
     title = "NLBPUB til DOCX"
     labels = ["e-bok", "Statped"]
     publication_format = "XHTML"
+    resource_class = "cpu"
     expected_processing_time = 370
 
     xslt_dir = os.path.realpath(os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "xslt"))
@@ -29,6 +29,7 @@ class NlbpubToEpub(Pipeline):
     title = "NLBPUB til EPUB"
     labels = ["e-bok", "Statped"]
     publication_format = "XHTML"
+    resource_class = "cpu"
     expected_processing_time = 550
 
     _triggerEpubCatalogThread = None
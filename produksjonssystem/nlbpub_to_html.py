@@ -24,6 +24,7 @@ class NlbpubToHtml(Pipeline):
     title = "NLBPUB til HTML"
     labels = ["e-bok", "Statped"]
     publication_format = "XHTML"
+    resource_class = "cpu"
     expected_processing_time = 550
 
     def on_book_deleted(self):
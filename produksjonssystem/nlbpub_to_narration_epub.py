@@ -25,6 +25,7 @@ class NlbpubToNarrationEpub(Pipeline):
     title = "NLBPUB til innlesingsklar EPUB"
     labels = ["Lydbok", "Statped"]
     publication_format = "DAISY 2.02"
+    resource_class = "cpu"
     expected_processing_time = 590
 
     xslt_dir = os.path.realpath(os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "xslt"))
@@ -132,6 +132,8 @@ class NlbpubToPef(Pipeline):
     title = "NLBPUB til PEF"
     labels = ["Punktskrift", "Statped"]
     publication_format = "Braille"
+    resource_class = "dp2"
+    release_worker_while_waiting = True  # process other books while waiting for Pipeline 2
     expected_processing_time = 880
 
     def on_book_deleted(self):
@@ -26,6 +26,8 @@ class NordicDTBookToEpub(Pipeline):
     title = "Nordisk DTBook til EPUB"
     labels = []
     publication_format = "EPUB"
+    resource_class = "dp2"
+    release_worker_while_waiting = True  # process other books while waiting for Pipeline 2
     expected_processing_time = 3200
 
     xslt_dir = os.path.realpath(os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "xslt"))
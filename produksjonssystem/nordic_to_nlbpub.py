@@ -36,6 +36,8 @@ class NordicToNlbpub(Pipeline):
     title = "Nordisk EPUB til NLBPUB"
     labels = ["EPUB", "Lydbok", "Punktskrift", "e-bok", "Statped"]
     publication_format = None
+    resource_class = "dp2"
+    release_worker_while_waiting = True  # process other books while waiting for Pipeline 2
     expected_processing_time = 2000
 
 
@@ -28,6 +28,7 @@ class PrepareForBraille(Pipeline):
     title = "Klargjør for punktskrift"
     labels = ["Punktskrift", "Statped"]
     publication_format = "Braille"
+    resource_class = "cpu"
     expected_processing_time = 450
 
     def on_book_deleted(self):
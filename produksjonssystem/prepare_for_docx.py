@@ -25,6 +25,7 @@ class PrepareForDocx(Pipeline):
     title = "Klargjør for DOCX"
     labels = ["e-bok", "Statped"]
     publication_format = "XHTML"
+    resource_class = "cpu"
     expected_processing_time = 380
 
     def on_book_deleted(self):
@@ -7,7 +7,6 @@ import sys
 import tempfile
 import time
 
-import requests
 from lxml import etree as ElementTree
 
 from core.config import Config
@@ -17,6 +16,7 @@ from core.utils.epubcheck import Epubcheck
 from core.utils.xslt import Xslt
 from core.utils.mathml_to_text import Mathml_to_text, Mathml_validator
 from core.utils.filesystem import Filesystem
+from core.utils.http_client import HttpClient
 
 
 if sys.version_info[0] != 3 or sys.version_info[1] < 5:
@@ -29,6 +29,7 @@ class PrepareForEbook(Pipeline):
     title = "Klargjør for e-bok"
     labels = ["e-bok", "Statped"]
     publication_format = "XHTML"
+    resource_class = "cpu"
     expected_processing_time = 260
 
     css_tempfile_obj = None
@@ -198,7 +199,7 @@ class PrepareForEbook(Pipeline):
             # NOTE: identifier at this point is the e-book identifier
             edition_url = "{}/editions/{}?creative-work-metadata=none&edition-metadata=all".format(Config.get("nlb_api_url"), epub.identifier())
 
-            response = requests.get(edition_url)
+            response = HttpClient.get(edition_url)
             self.utils.report.debug("looking for cover image in: {}".format(edition_url))
             if response.status_code == 200:
                 response_json = response.json()
@@ -209,7 +210,7 @@ class PrepareForEbook(Pipeline):
                 data = response_json["data"]
                 cover_url = data["coverUrlLarge"]
                 if cover_url is not None and cover_url.startswith("http"):
-                    response = requests.get(cover_url)
+                    response = HttpClient.get(cover_url)
                     if response.status_code == 200:
                         _, extension = os.path.splitext(cover_url)
                         target_href = "cover" + extension
@@ -297,8 +298,8 @@ class PrepareForEbook(Pipeline):
 
             latest_url = "https://github.com/nlbdev/nlb-scss/releases/download/v1.1.1/epub.min.css"
 
-            response = requests.get(latest_url)
-            response_statped = requests.get(latest_url_statped)
+            response = HttpClient.get(latest_url)
+            response_statped = HttpClient.get(latest_url_statped)
             if response.status_code == 200:
                 with open(css_tempfile, "wb") as target_file:
                     target_file.write(response.content)
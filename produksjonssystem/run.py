@@ -31,7 +31,9 @@ from core.config import Config  # noqa
 from core.directory import Directory  # noqa
 from core.pipeline import DummyPipeline, Pipeline  # noqa
 from core.plotter import Plotter  # noqa
+from core.utils.daisy_pipeline import DaisyPipelineLocalEngines  # noqa
 from core.utils.filesystem import Filesystem  # noqa
+from core.utils.jvm_worker import JvmWorker  # noqa
 from core.utils.slack import Slack  # noqa
 from core.utils.metadata import Metadata  # noqa
 
@@ -333,7 +335,8 @@ class Produksjonssystem():
                                during_working_hours=True),      "pub-in-braille",      "pub-ready-braille"],
             [NlbpubToPef(retry_missing=True,
                          check_identifiers=True,
-                         during_working_hours=True),            "pub-ready-braille",   "pef"],
+                         during_working_hours=True,
+                         max_workers=2),                        "pub-ready-braille",   "pef"],
             # [CheckPef(),                                        "pef",                 "pef-checked"],
 
             # innlest lydbok
@@ -713,6 +716,10 @@ class Produksjonssystem():
         self.info("Venter på at API-tråden skal stoppe...")
         self.server.join(timeout=10)
 
+        self.info("Stopper Java-prosesser...")
+        JvmWorker.stop_all()
+        DaisyPipelineLocalEngines.stop_all()
+
     def shouldRun(self, set=None):
         if set is not None:
             Config.set("system.shouldRun", set)
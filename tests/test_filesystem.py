@@ -1,11 +1,13 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import io
 import unittest
 import sys
 import os
 import shutil
 import time
+import zipfile
 
 from dotmap import DotMap
 from pathlib import Path
@@ -168,6 +170,71 @@ class FilesystemTest(unittest.TestCase):
         self.assertTrue(len([m for m in self.pipeline.messages if m.startswith("[WARN]")]) == 0)
         self.assertTrue(len([m for m in self.pipeline.messages if m.startswith("[ERROR]") and "/locked" in m]) >= 1)
 
+    def test_path_md5(self):
+        book = os.path.join(self.dir_in, "book")
+        os.makedirs(os.path.join(book, "images"))
+        for i in range(200):
+            Path(os.path.join(book, "page{}.html".format(i))).touch()
+        Path(os.path.join(book, "images/image.png")).touch()
+
+        md5, modified = Filesystem.path_md5(book, shallow=False)
+        self.assertNotEqual(md5, "d41d8cd98f00b204e9800998ecf8427e")
+        self.assertGreater(modified, 0)
+        self.assertEqual(Filesystem.path_md5(book, shallow=False, parallel=True), (md5, modified))
+        self.assertEqual(Filesystem.path_md5(book, shallow=False, memoize=True), (md5, modified))
+
+        print("empty directories and ignored files does not affect the checksum")
+        os.makedirs(os.path.join(book, "empty"))
+        Path(os.path.join(book, "images/Thumbs.db")).touch()
+        self.assertEqual(Filesystem.path_md5(book, shallow=False)[0], md5)
+
+        print("adding a file to a subdirectory changes the checksum")
+        Path(os.path.join(book, "images/image2.png")).touch()
+        new_md5, _ = Filesystem.path_md5(book, shallow=False, memoize=True)
+        self.assertNotEqual(new_md5, md5)
+        self.assertEqual(Filesystem.path_md5(book, shallow=False)[0], new_md5)
+
+        print("the oldest memoized checksums are removed when there are too many")
+        os.makedirs(os.path.join(book, "audio"))
+        Path(os.path.join(book, "audio/audio.mp3")).touch()
+        max_size = Filesystem.checksum_memo_max_size
+        try:
+            Filesystem.checksum_memo_max_size = 1
+            Filesystem.path_md5(book, shallow=False, memoize=True)
+            self.assertEqual(list(Filesystem._checksum_memo), [(os.path.join(book, "images"), False)])
+        finally:
+            Filesystem.checksum_memo_max_size = max_size
+
+    def test_zip_stream(self):
+        book = os.path.join(self.dir_in, "book")
+        os.makedirs(os.path.join(book, "images"))
+        with open(os.path.join(book, "book.xhtml"), "w") as f:
+            f.write("<html>" + "<p>text</p>" * 10000 + "</html>")
+        with open(os.path.join(book, "images/image.png"), "wb") as f:
+            f.write(os.urandom(100000))
+        files = {"book.xhtml": os.path.join(book, "book.xhtml"), "images/image.png": os.path.join(book, "images/image.png")}
+
+        archive = zipfile.ZipFile(io.BytesIO(b"".join(Filesystem.zip_stream(self.pipeline.utils.report, files))))
+        self.assertIsNone(archive.testzip())
+        self.assertEqual(archive.getinfo("book.xhtml").compress_type, zipfile.ZIP_DEFLATED)
+        self.assertEqual(archive.getinfo("images/image.png").compress_type, zipfile.ZIP_STORED)
+
+        print("unzip_stream extracts zip files with data descriptors")
+        del files["images/image.png"]
+        stream = io.BytesIO(b"".join(Filesystem.zip_stream(self.pipeline.utils.report, files)))
+        self.assertEqual(Filesystem.unzip_stream(self.pipeline.utils.report, stream, os.path.join(self.dir_out, "1")), 1)
+        with open(os.path.join(self.dir_out, "1", "book.xhtml")) as f, open(os.path.join(book, "book.xhtml")) as original:
+            self.assertEqual(f.read(), original.read())
+
+        print("unzip_stream does not extract files outside of the target directory")
+        stream = io.BytesIO()
+        with zipfile.ZipFile(stream, "w") as archive:
+            archive.writestr("../outside.txt", "text")
+        stream.seek(0)
+        with self.assertRaises(ValueError):
+            Filesystem.unzip_stream(self.pipeline.utils.report, stream, os.path.join(self.dir_out, "2"))
+        self.assertFalse(os.path.exists(os.path.join(self.dir_out, "outside.txt")))
+
 
 if __name__ == '__main__':
     unittest.main()
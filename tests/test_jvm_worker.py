@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+from dotmap import DotMap
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../produksjonssystem')))
+from core.utils.epubcheck import Epubcheck  # noqa: E402
+from core.utils.filesystem import Filesystem  # noqa: E402
+from core.utils.jvm_worker import JvmWorker  # noqa: E402
+from core.utils.xslt import Xslt  # noqa: E402
+
+if sys.version_info[0] != 3 or sys.version_info[1] < 5:
+    print("# This script requires Python version 3.5+")
+    sys.exit(1)
+
+# Speaks the same JSON lines protocol as the real worker, without starting a JVM.
+# Responses are written in two parts, to check that partial lines are handled.
+STUB_WORKER = """
+import json, os, sys, time
+
+if any("fail" in argument for argument in sys.argv[1:]):
+    print(json.dumps({"ready": False, "error": "no JVM"}), flush=True)
+    sys.exit(1)
+
+print(json.dumps({"ready": True}), flush=True)
+
+for line in sys.stdin:
+    request = json.loads(line)
+    arguments = request["arguments"]
+    if request["command"] == "sleep":
+        time.sleep(arguments["seconds"])
+    if request["command"] == "epubcheck":
+        results = {path: {"returncode": 0 if "good" in path else 1, "report": {"messages": []}, "stdout": "", "stderr": ""}
+                   for path in arguments["paths"]}
+        response = {"returncode": max(result["returncode"] for result in results.values()), "results": results, "stdout": "", "stderr": ""}
+    else:
+        response = {"returncode": 0, "stdout": json.dumps(request), "stderr": "", "pid": os.getpid()}
+    response = json.dumps(response) + "\\n"
+    sys.stdout.write(response[:5])
+    sys.stdout.flush()
+    time.sleep(0.01)
+    sys.stdout.write(response[5:])
+    sys.stdout.flush()
+"""
+
+
+class JvmWorkerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir_obj = tempfile.TemporaryDirectory(prefix="jvm-worker-test-")
+        self.temp_dir = self.temp_dir_obj.name
+        stub = os.path.join(self.temp_dir, "stub_worker.py")
+        with open(stub, "w") as f:
+            f.write(STUB_WORKER)
+
+        self.patches = [
+            mock.patch.object(JvmWorker, "command", [sys.executable, stub]),
+            mock.patch.object(JvmWorker, "is_available", staticmethod(lambda: JvmWorker.enabled)),  # don't require JPype
+            mock.patch.object(JvmWorker, "enabled", True),
+            mock.patch.object(JvmWorker, "_unavailable_since", {}),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+        self.report = mock.MagicMock()
+
+    def tearDown(self):
+        JvmWorker.stop_all()
+        for patch in reversed(self.patches):
+            patch.stop()
+        self.temp_dir_obj.cleanup()
+
+    def test_request(self):
+        response = JvmWorker.request(["stub.jar"], "xslt", {"stylesheet": "æøå.xsl"})
+        self.assertEqual(response["returncode"], 0)
+        self.assertEqual(json.loads(response["stdout"]), {"command": "xslt", "arguments": {"stylesheet": "æøå.xsl"}})
+
+        # the worker is reused for the next request
+        self.assertEqual(JvmWorker.request(["stub.jar"], "xslt", {})["pid"], response["pid"])
+        self.assertEqual(len(JvmWorker._pools[("stub.jar",)]), 1)
+
+    def test_restart_after_max_requests(self):
+        with mock.patch.object(JvmWorker, "max_requests", 2):
+            pids = [JvmWorker.request(["stub.jar"], "xslt", {})["pid"] for i in range(3)]
+        self.assertEqual(pids[0], pids[1])
+        self.assertNotEqual(pids[1], pids[2])
+        self.assertEqual(len(JvmWorker._pools[("stub.jar",)]), 1)
+
+    def test_timeout(self):
+        with self.assertRaises(subprocess.TimeoutExpired):
+            JvmWorker.request(["stub.jar"], "sleep", {"seconds": 5}, timeout=1)
+
+        # the worker that timed out is replaced
+        self.assertEqual(JvmWorker.request(["stub.jar"], "xslt", {})["returncode"], 0)
+        self.assertEqual(len(JvmWorker._pools[("stub.jar",)]), 1)
+
+    def test_disabled(self):
+        with mock.patch.object(JvmWorker, "enabled", False):
+            self.assertIsNone(JvmWorker.request(["stub.jar"], "xslt", {}))
+        self.assertEqual(JvmWorker._pools, {})
+
+    def test_start_failure(self):
+        with self.assertLogs(level="ERROR"):
+            self.assertIsNone(JvmWorker.request(["fail.jar"], "xslt", {}))
+        self.assertIn(("fail.jar",), JvmWorker._unavailable_since)
+
+        # don't try to start it again right away
+        with mock.patch.object(JvmWorker, "__init__") as init:
+            self.assertIsNone(JvmWorker.request(["fail.jar"], "xslt", {}))
+            init.assert_not_called()
+
+    def test_xslt_fallback(self):
+        def transform(jar):
+            with mock.patch.object(Xslt, "saxon_jar", jar), \
+                    mock.patch.object(Filesystem, "run_static", return_value=DotMap(returncode=0)) as run_static:
+                xslt = Xslt(report=self.report, stylesheet="stylesheet.xsl", source="source.xml", target="target.xml", cwd=self.temp_dir)
+
+            self.assertTrue(xslt.success)
+            run_static.assert_called_once()
+            self.assertEqual(run_static.call_args[0][0],
+                             ["java", "-jar", jar, "-s:source.xml", "-xsl:stylesheet.xsl", "-o:target.xml"])
+
+        # JVM workers disabled
+        with mock.patch.object(JvmWorker, "enabled", False):
+            transform("saxon.jar")
+
+        # the JVM fails to start
+        with self.assertLogs(level="ERROR"):
+            transform("fail-saxon.jar")
+
+    def test_epubcheck_validate(self):
+        paths = [os.path.join(self.temp_dir, "good.epub"), os.path.join(self.temp_dir, "bad.epub")]
+
+        results = Epubcheck.validate(paths, self.report, cwd=self.temp_dir)
+        self.assertEqual(sorted(results), sorted(paths))
+        self.assertTrue(results[paths[0]]["success"])
+        self.assertFalse(results[paths[1]]["success"])
+
+        # without a worker, EpubCheck is run once for each EPUB
+        process = DotMap(returncode=1, stdout=b"", stderr=b"")
+        with mock.patch.object(JvmWorker, "enabled", False), \
+                mock.patch.object(Filesystem, "run_static", return_value=process) as run_static:
+            results = Epubcheck.validate(paths + [self.temp_dir], self.report, cwd=self.temp_dir)
+
+        self.assertEqual(run_static.call_count, 3)
+        self.assertEqual(sorted(results), sorted(paths + [self.temp_dir]))
+        self.assertFalse(any(result["success"] for result in results.values()))
+        self.assertIn("exp", run_static.call_args_list[2][0][0])  # unzipped EPUB
+
+
+if __name__ == '__main__':
+    unittest.main()
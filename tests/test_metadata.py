@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../produksjonssystem')))
+from core.utils.metadata import Metadata  # noqa: E402
+
+if sys.version_info[0] != 3 or sys.version_info[1] < 5:
+    print("# This script requires Python version 3.5+")
+    sys.exit(1)
+
+
+def edition(identifier, format, registered=None, available=None, deleted=False):
+    return {"identifier": identifier, "format": format, "registered": registered, "available": available, "deleted": deleted}
+
+
+class MetadataTest(unittest.TestCase):
+    creative_works = [
+        {"identifier": "cw1", "editions": [
+            edition("100001", "EPUB", registered="2020-01-01"),
+            edition("100002", "DAISY 2.02", registered="2020-01-01"),  # same date as 100001
+            edition("100003", "Braille", registered="2021-05-05", deleted=True),
+        ]},
+        {"identifier": "cw2", "editions": [
+            edition("200001", "EPUB", available="2019-06-01"),
+            edition("200002", "Braille", registered="2022-02-02"),
+        ]},
+        {"identifier": "cw3", "editions": [
+            edition("300001", "EPUB"),  # no dates; sorted by identifier
+        ]},
+        {"identifier": "cw4", "editions": [
+            edition("400001123456", "EPUB", registered="2018-01-01"),
+            edition("400002", "DAISY 2.02", registered="2018-01-01"),
+        ]},
+    ]
+
+    def setUp(self):
+        self.refresh = mock.patch.object(Metadata, "refresh_creative_work_cache_if_necessary")
+        self.refresh.start()
+        Metadata.set_creative_works(self.creative_works)
+
+    def tearDown(self):
+        self.refresh.stop()
+        Metadata.set_creative_works([], updated=0)
+
+    def test_index_creative_works(self):
+        index = Metadata.index_creative_works(self.creative_works)
+
+        # deleted editions are not available as editions, but can still be sorted
+        self.assertEqual(index["creative_works_editions"]["cw1"], ["100001", "100002"])
+        self.assertNotIn("100003", index["editions"])
+        self.assertIn("100003", index["sort_values"])
+        self.assertEqual(index["editions"]["200002"], {"format": "Braille", "creativeWork": "cw2"})
+        self.assertEqual(index["identifier_lengths"], {6, 12})
+
+        # the records are read-only
+        with self.assertRaises(TypeError):
+            index["creative_works"][0]["identifier"] = "changed"
+
+    def test_sort_identifiers(self):
+        identifiers = ["300001", "100002", "100001", "200001", "200002", "999999", "100001123456", "100003"]
+        self.assertEqual(Metadata.sort_identifiers(identifiers), [
+            "300001",  # the identifier is used when there are no dates, and "3…" sorts after "2…"
+            "200002",
+            "100003",  # deleted editions are sorted as well
+            "100001",  # same date as 100002, but listed first in the catalogue
+            "100001123456",  # 12 digit identifiers are sorted with their 6 digit edition
+            "100002",
+            "200001",  # uses the availability date
+            "999999",  # unknown identifiers are put last
+        ])
+
+    def test_filter_identifiers(self):
+        # 200001 is already produced (as 200002), and deleted editions are ignored
+        self.assertEqual(sorted(Metadata.filter_identifiers(["100001", "200001", "300001", "100003", "TEST123"], ["200002"])),
+                         ["100001", "300001", "TEST123"])
+
+        # only creative works that have (non-deleted) editions in the given format
+        self.assertEqual(Metadata.filter_identifiers(["100001", "200001", "300001"], [], format="Braille"), ["200001"])
+        self.assertEqual(sorted(Metadata.filter_identifiers(["100001", "200001", "300001"], [], format="EPUB")), ["100001", "200001", "300001"])
+
+        # for 12 digit identifiers, the suffix must match as well
+        self.assertEqual(Metadata.filter_identifiers(["100001123456"], ["100002123456"]), [])
+        self.assertEqual(Metadata.filter_identifiers(["100001123456"], ["100002999999"]), ["100001123456"])
+
+    def test_get_creative_work_from_cache(self):
+        self.assertIsNone(Metadata.get_creative_work_from_cache("100003"))  # deleted
+        self.assertIsNone(Metadata.get_creative_work_from_cache("999999"))
+
+        creative_work = Metadata.get_creative_work_from_cache("100002")
+        self.assertEqual(creative_work["identifier"], "cw1")
+        self.assertEqual([e["identifier"] for e in creative_work["editions"]], ["100001", "100002", "100003"])
+
+        # 6 digit identifiers get the suffix of the 12 digit identifier
+        creative_work = Metadata.get_creative_work_from_cache("400001123456")
+        self.assertEqual([e["identifier"] for e in creative_work["editions"]], ["400001123456", "400002123456"])
+
+        # …without changing the cached creative work
+        creative_work = Metadata.get_creative_work_from_cache("400002")
+        self.assertEqual([e["identifier"] for e in creative_work["editions"]], ["400001123456", "400002"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -8,10 +8,12 @@ import sys
 import time
 import unittest
 from pathlib import Path
+from unittest import mock
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../produksjonssystem')))
-from core.pipeline import Pipeline
-from core.utils.metadata import Metadata
+from core.pipeline import Pipeline  # noqa: E402
+from core.utils.book_queue import BookQueue  # noqa: E402
+from core.utils.metadata import Metadata  # noqa: E402
 
 if sys.version_info[0] != 3 or sys.version_info[1] < 5:
     print("# This script requires Python version 3.5+")
@@ -208,6 +210,115 @@ class PipelineTest(unittest.TestCase):
         self.waitUntil(15, "done processing books", lambda test: test.pipeline.get_status() == "Venter")
         self.assertEqual(len(self.pipeline._queue), 0)
 
+    def test_concurrent_workers(self):
+        print("TEST: " + inspect.stack()[0][3])
+
+        self.pipeline.max_workers = 2
+        self.pipeline.on_book_created = lambda: time.sleep(6)  # pretend like it takes a few seconds to handle a book
+        self.pipeline.start(inactivity_timeout=2, dir_in=self.dir_in, dir_out=self.dir_out, dir_reports=self.dir_reports, dir_base=self.dir_base)
+        time.sleep(1)
+
+        # Create three books; two of them should be processed at the same time
+        Path(os.path.join(self.dir_in, '1_book')).touch()
+        Path(os.path.join(self.dir_in, '2_book')).touch()
+        Path(os.path.join(self.dir_in, '3_book')).touch()
+
+        self.waitUntil(15, "two books being processed", lambda test: len(test.pipeline.get_active_books()) == 2)
+        self.assertEqual(len(self.pipeline._queue), 1)
+        self.assertEqual(len(set(b["name"] for b in self.pipeline.get_active_books())), 2)
+
+        self.waitUntil(20, "3_book being processed", lambda test: "3_book" in [b["name"] for b in test.pipeline.get_active_books()])
+        self.assertEqual(len(self.pipeline._queue), 0)
+
+        self.waitUntil(20, "done processing books", lambda test: test.pipeline.get_status() == "Venter")
+        self.assertEqual(len(self.pipeline._queue), 0)
+
+    def test_release_worker_while_waiting(self):
+        print("TEST: " + inspect.stack()[0][3])
+
+        def on_book_created():
+            with self.pipeline.waiting_for_external_job():
+                time.sleep(6)  # pretend like we're waiting for a Pipeline 2 job
+
+        self.pipeline.release_worker_while_waiting = True
+        self.pipeline.on_book_created = on_book_created
+        self.pipeline.start(inactivity_timeout=2, dir_in=self.dir_in, dir_out=self.dir_out, dir_reports=self.dir_reports, dir_base=self.dir_base)
+        time.sleep(1)
+
+        # Create two books; the second should be processed while the first is waiting
+        Path(os.path.join(self.dir_in, '1_book')).touch()
+        Path(os.path.join(self.dir_in, '2_book')).touch()
+
+        self.waitUntil(15, "two books being processed", lambda test: len(test.pipeline.get_active_books()) == 2)
+        self.assertEqual(len(self.pipeline._queue), 0)
+
+        # the extra worker should stop when the books are done
+        self.waitUntil(30, "back to one worker", lambda test: test.pipeline.get_status() == "Venter" and len(test.pipeline._workers) == 1)
+
+    def test_max_waiting_workers(self):
+        print("TEST: " + inspect.stack()[0][3])
+
+        def on_book_created():
+            with self.pipeline.waiting_for_external_job():
+                time.sleep(4)  # pretend like we're waiting for a Pipeline 2 job
+
+        self.pipeline.release_worker_while_waiting = True
+        self.pipeline.max_waiting_workers = 1
+        self.pipeline.on_book_created = on_book_created
+        self.pipeline.start(inactivity_timeout=2, dir_in=self.dir_in, dir_out=self.dir_out, dir_reports=self.dir_reports, dir_base=self.dir_base)
+        time.sleep(1)
+
+        # Create more books than there are workers; only one worker should be replaced while waiting
+        for i in range(4):
+            Path(os.path.join(self.dir_in, '{}_book'.format(i))).touch()
+
+        self.waitUntil(15, "two books being processed", lambda test: len(test.pipeline.get_active_books()) == 2)
+        time.sleep(1)
+        self.assertEqual(len(self.pipeline.get_active_books()), 2)
+        self.assertEqual(len(self.pipeline._workers), 2)
+        self.assertEqual(len(self.pipeline._queue), 2)
+
+        self.waitUntil(40, "all books processed", lambda test: len(test.pipeline._queue) == 0 and test.pipeline.get_status() == "Venter")
+        self.waitUntil(10, "back to one worker", lambda test: len(test.pipeline._workers) == 1)
+
+    def test_book_queue(self):
+        queue = BookQueue(Pipeline.get_main_event)
+        with mock.patch("core.utils.book_queue.time.time") as now:
+            now.return_value = 1000
+            queue.add("auto_1", "autotriggered")
+            queue.add("modified_1", "modified")
+            now.return_value = 1010
+            queue.add("auto_2", "autotriggered")
+            queue.add("modified_2", "modified")
+            queue.add("auto_1", "autotriggered")  # does not change the order of autotriggered books
+            now.return_value = 1012
+            queue.add("triggered", "triggered")
+
+            self.assertEqual(len(queue), 5)
+            self.assertEqual(queue.counts(), {"autotriggered": 2, "modified": 2, "triggered": 1})
+
+            # only books without recent filesystem events are ready, triggered books are ready immediately
+            now.return_value = 1015
+            self.assertEqual(queue.pop(10)["name"], "triggered")
+            self.assertEqual(queue.pop(10)["name"], "modified_1")
+            self.assertEqual(queue.seconds_until_ready(10), 6)
+
+            now.return_value = 1025
+            self.assertEqual(queue.pop(10)["name"], "modified_2")
+            self.assertEqual(queue.pop(10, include_autotriggered=False), None)
+            self.assertEqual(queue.pop(10, exclude=["auto_1"])["name"], "auto_2")
+
+            # a book that is modified is no longer autotriggered
+            queue.add("auto_1", "modified")
+            self.assertEqual(queue.counts(), {"modified": 1})
+            self.assertEqual(queue.pop(10), None)
+
+            now.return_value = 1040
+            self.assertEqual(queue.pop(10)["name"], "auto_1")
+            self.assertEqual(queue.pop(10), None)
+            self.assertEqual(len(queue), 0)
+            self.assertEqual(queue.counts(), {})
+
     def test_get_main_event(self):
         book = {}
 